@@ -1,30 +1,254 @@
-from numpy import percentile
+import math
+import statistics
 
-def iqr_filter(data, cutoff):
+# NumPy takes seconds to import on a Pi Zero, so it is only loaded
+# when a window too large for the pure Python routines is filtered.
+_numpy = None
+
+# Windows shorter than this are filtered in pure Python.
+NUMPY_MIN_WINDOW = 256
+
+# Sliding windows shorter than this are filtered with exact quartiles.
+P2_MIN_WINDOW = 100
+
+# The P-square quartiles lag a step change in the data, e.g. when cooking
+# starts, and can then reject much of a window. When streaming limits
+# reject more than this fraction of one, the exact limits are used instead.
+P2_MAX_OUTLIER_FRACTION = 0.05
+
+def numpy():
+  """
+  Return the numpy module, importing it on first use.
+  """
+  global _numpy
+  if _numpy is None:
+    import numpy
+    _numpy = numpy
+  return _numpy
+
+def quantile(data, p, is_sorted=False):
+  """
+  Pure Python quantile, with the same linear interpolation
+  as numpy.percentile().
+
+  Parameters:
+  data - A sequence of numbers
+  p - The quantile, 0 <= p <= 1
+  is_sorted - True if data is already in ascending order
+  """
+  s = data if is_sorted else sorted(data)
+  pos = p * (len(s) - 1)
+  lo = math.floor(pos)
+  hi = min(lo + 1, len(s) - 1)
+  return s[lo] + (s[hi] - s[lo]) * (pos - lo)
+
+def iqr_limits(data, cutoff):
+  """
+  Return the (lower, upper) IQR cutoff limits for the data.
+
+  Small windows are sorted once in pure Python. Otherwise both
+  quartiles are found with a single partition based percentile pass.
+  """
+  if len(data) < NUMPY_MIN_WINDOW:
+    s = sorted(data)
+    q25, q75 = quantile(s, 0.25, True), quantile(s, 0.75, True)
+  else:
+    q25, q75 = numpy().percentile(data, (25, 75))
+  # calculate interquartile range
+  iqr = q75 - q25
+  # calculate the outlier cutoff
+  cut_off = iqr * cutoff
+  return (q25 - cut_off, q75 + cut_off)
+
+def iqr_filter_array(data, cutoff, limits=None):
+  """
+  Perform IQR filtering on an ndarray.
+
+  Parameters:
+  data - The ndarray of data to be filtered
+  cutoff - The IQR factor that estiblishes the cutoff limits.
+  limits - Optional (lower, upper) limits, e.g. from WindowQuantiles.
+           If not given, they are calculated from data.
+
+  Returns: (kept data, removed data) as ndarrays. If nothing is removed,
+  the kept data is data itself, not a copy.
+  """
+  np = numpy()
+  data = np.asarray(data, dtype=np.float64)
+  if limits is None:
+    limits = iqr_limits(data, cutoff)
+  lower, upper = limits
+  # A single mask selects both outputs
+  keep = (data >= lower) & (data <= upper)
+  if keep.all():
+    return (data, data[:0])
+  return (data[keep], data[~keep])
+
+def iqr_filter(data, cutoff, limits=None):
   """
   Perfrom IQR filtering on a list of data.
 
+  Short lists are filtered in pure Python, without importing NumPy.
+
   Parameters:
   data - The list of data to be filtered
   cutoff - The IQR factor that estiblishes the cutoff limits.
            Use 1.5 for robust filtering; 3.0 to remove exterem outliers.
+  limits - Optional (lower, upper) limits. If not given, they are
+           calculated from data.
 
   Returns: ([kept data], [removed data])
   """
 
-  # calculate interquartile range
-  q25, q75 = percentile(data, 25), percentile(data, 75)
-  iqr = q75 - q25
-  # calculate the outlier cutoff
-  cut_off = iqr * cutoff
-  lower, upper = q25 - cut_off, q75 + cut_off
-  # identify outliers
-  outliers = [x for x in data if x < lower or x > upper]
-  # remove outliers
-  outliers_removed = [x for x in data if x >= lower and x <= upper]
+  if len(data) >= NUMPY_MIN_WINDOW:
+    (outliers_removed, outliers) = iqr_filter_array(data, cutoff, limits)
+    return (outliers_removed.tolist(), outliers.tolist())
+
+  if limits is None:
+    limits = iqr_limits(data, cutoff)
+  lower, upper = limits
+  outliers_removed = []
+  outliers = []
+  for x in data:
+    if lower <= x <= upper:
+      outliers_removed.append(x)
+    else:
+      outliers.append(x)
 
   return (outliers_removed, outliers)
 
+def summary(data):
+  """
+  Return the (median, mean, std dev) of a list or ndarray.
+  The std dev is zero if there are fewer than two values, and all three
+  are NaN if there are none.
+  """
+  if not len(data):
+    return (math.nan, math.nan, math.nan)
+  if isinstance(data, list):
+    stdev = statistics.stdev(data) if len(data) > 1 else 0.0
+    return (statistics.median(data), statistics.mean(data), stdev)
+  np = numpy()
+  stdev = float(data.std(ddof=1)) if len(data) > 1 else 0.0
+  return (float(np.median(data)), float(data.mean()), stdev)
+
+class P2Quantile(object):
+  """
+  Streaming estimate of a single quantile, using the P-square
+  algorithm of Jain and Chlamtac (1985). It keeps five markers,
+  so memory and time per sample are constant.
+
+  Parameters:
+  p - The quantile to estimate, 0 < p < 1.
+  """
+  def __init__(self, p):
+    self.p = p
+    self.count = 0
+    self._q = []
+    self._n = [0, 1, 2, 3, 4]
+    self._np = [0.0, 2*p, 4*p, 2 + 2*p, 4.0]
+    self._dn = (0.0, p/2, p, (1 + p)/2, 1.0)
+
+  def add(self, x):
+    self.count += 1
+    q = self._q
+    if self.count <= 5:
+      q.append(x)
+      q.sort()
+      return
+
+    n = self._n
+    if x < q[0]:
+      q[0] = x
+      k = 0
+    elif x >= q[4]:
+      q[4] = x
+      k = 3
+    else:
+      k = 0
+      while x >= q[k+1]:
+        k += 1
+    for i in range(k+1, 5):
+      n[i] += 1
+    np_ = self._np
+    dn = self._dn
+    for i in range(5):
+      np_[i] += dn[i]
+
+    # Adjust the three middle markers
+    for i in (1, 2, 3):
+      d = np_[i] - n[i]
+      if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+        d = 1 if d > 0 else -1
+        qp = q[i] + d / (n[i+1] - n[i-1]) * (
+          (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+          (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+        if not q[i-1] < qp < q[i+1]:
+          # Parabolic prediction is out of order, use linear
+          qp = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+        q[i] = qp
+        n[i] += d
+
+  def value(self):
+    """
+    Return the quantile estimate, or None if there is no data.
+    """
+    if not self.count:
+      return None
+    if self.count <= 5:
+      return quantile(self._q, self.p, True)
+    return self._q[2]
+
+class WindowQuantiles(object):
+  """
+  Approximate the quartiles of a sliding window with P-square
+  estimators, so that the window does not have to be sorted.
+
+  Two staggered sets of estimators are run, each restarted after
+  it has seen a full window. The older one is reported, so the
+  estimate always covers between half and all of the window.
+
+  Parameters:
+  window - The sliding window length
+  """
+  def __init__(self, window):
+    self.half = max(window // 2, 1)
+    self._count = 0
+    self._sets = [self._new_set()]
+
+  def _new_set(self):
+    return (P2Quantile(0.25), P2Quantile(0.75))
+
+  def add(self, x):
+    for q25, q75 in self._sets:
+      q25.add(x)
+      q75.add(x)
+    self._count += 1
+    if self._count % self.half == 0:
+      if len(self._sets) == 2:
+        self._sets.pop(0)
+      self._sets.append(self._new_set())
+
+  def quartiles(self):
+    """
+    Return (q25, q75), or None if there is no data yet.
+    """
+    q25, q75 = self._sets[0]
+    if not q25.count:
+      return None
+    return (q25.value(), q75.value())
+
+  def limits(self, cutoff):
+    """
+    Return the (lower, upper) IQR cutoff limits, or None if there is no data yet.
+    """
+    quartiles = self.quartiles()
+    if quartiles is None:
+      return None
+    q25, q75 = quartiles
+    cut_off = (q75 - q25) * cutoff
+    return (q25 - cut_off, q75 + cut_off)
+
 def test(data, cutoff):
   (clean_data, outliers) = iqr_filter(data, cutoff)
   print("--- Cutoff:", cutoff, "---")
@@ -49,3 +273,7 @@ if __name__ == '__main__':
   test(data, 1.5)
   test(data, 3.0)
 
+  window = WindowQuantiles(len(data))
+  for x in data:
+    window.add(x)
+  print("Streaming quartiles:", window.quartiles(), "exact:", (quantile(data, 0.25), quantile(data, 0.75)))
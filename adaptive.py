@@ -0,0 +1,181 @@
+"""
+Change driven reporting.
+
+Rather than reporting on a fixed interval, the readings are checked every
+min_interval_s, and a ReportGate decides whether each one is worth
+sending. It is sent at once when TVOC or eCO2 has moved by more than a
+delta since the last report, or is rising or falling faster than a slope
+(e.g. when cooking starts). Otherwise it is only sent as a heartbeat,
+whose interval starts at the base interval after a change, and doubles
+with each heartbeat while the readings are stable, up to max_interval_s.
+
+    gate = adaptive.ReportGate(60, min_interval_s=10, max_interval_s=900)
+    reason = gate.check(device.reading(), time.time())
+    if reason:
+        send(reading)           # reason is "first", "delta", "slope" or "heartbeat"
+
+A change smaller than noise_factor standard errors of its window's mean
+(from the window's standard deviation and sample count, where the
+Reading has them) never triggers a report, so a noisy sensor does not
+report on every check.
+"""
+import math
+
+import logutil
+import metrics
+
+log = logutil.get_logger("airq.reports")
+
+# The changes which trigger a report, by Reading attribute: since the
+# last report, and per minute between checks
+DELTAS = {"tvoc": 50.0, "eco2": 100.0}
+SLOPES = {"tvoc": 25.0, "eco2": 50.0}
+
+def _valid(value):
+    return value is not None and not math.isnan(value)
+
+class ReportGate(object):
+    """
+    Decide which readings of a sensor stack to report.
+
+        :param base_interval_s: The heartbeat interval after a change,
+                                usually chords_report_interval
+        :param min_interval_s: How often the readings are checked, and so
+                               the shortest interval between reports
+        :param max_interval_s: The longest heartbeat interval
+        :param deltas: The change since the last report which triggers
+                       one, by Reading attribute. The default is DELTAS.
+        :param slopes: The change per minute between checks which triggers
+                       a report, by Reading attribute. The default is SLOPES.
+        :param noise_factor: Changes smaller than this many standard errors
+                             are ignored
+        :param registry: The metrics.Registry
+        :param labels: The metric labels, e.g. instance=name for a fleet stack
+    """
+    reasons = ("first", "delta", "slope", "heartbeat")
+
+    def __init__(self, base_interval_s, min_interval_s=10.0, max_interval_s=900.0, deltas=None,
+                 slopes=None, noise_factor=3.0, registry=None, **labels):
+        if not 0 < min_interval_s <= base_interval_s <= max_interval_s:
+            raise ValueError("Report intervals must satisfy 0 < min ({}) <= base ({}) <= max ({})".format(
+                min_interval_s, base_interval_s, max_interval_s))
+        self.base_interval_s = base_interval_s
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.deltas = DELTAS if deltas is None else deltas
+        self.slopes = SLOPES if slopes is None else slopes
+        self.noise_factor = noise_factor
+        self.labels = labels
+        self.heartbeat_s = base_interval_s
+        self.last_time = None   # when the last report was made
+        self.last_values = {}   # the values last reported
+        self._previous = None   # the (time, values) of the last check
+
+        registry = registry if registry else metrics.REGISTRY
+        self.reports_total = dict((reason, registry.counter("airq_reports_total",
+            "Readings reported, by the reason", reason=reason, **labels)) for reason in self.reasons)
+        self.suppressed_total = registry.counter("airq_reports_suppressed_total",
+            "Readings checked and not reported, as nothing changed", **labels)
+        self.heartbeat = registry.gauge("airq_report_heartbeat_seconds",
+            "The current heartbeat interval", **labels)
+        self.heartbeat.set(self.heartbeat_s)
+
+    def _noise(self, reading, name):
+        std = getattr(reading, name + "_std", None)
+        n = getattr(reading, name + "_n", None)
+        if not _valid(std) or not n:
+            return 0.0
+        return self.noise_factor * std / math.sqrt(n)
+
+    def _changed(self, reading, values, now):
+        """
+        Return "delta" or "slope" if a value has changed enough to report,
+        otherwise None.
+        """
+        for name, delta in self.deltas.items():
+            value = values[name]
+            if not _valid(value):
+                continue
+            last = self.last_values.get(name)
+            # e.g. the CCS811 has produced its first results
+            if not _valid(last):
+                return "delta"
+            if abs(value - last) > max(delta, self._noise(reading, name)):
+                log.debug("report_delta", channel=name, value=value, last=last, **self.labels)
+                return "delta"
+
+        if self._previous is None:
+            return None
+        (prev_time, prev_values) = self._previous
+        if now <= prev_time:
+            return None
+        for name, slope in self.slopes.items():
+            value = values[name]
+            prev = prev_values.get(name)
+            if not _valid(value) or not _valid(prev):
+                continue
+            change = abs(value - prev)
+            if change > self._noise(reading, name) and change * 60.0 / (now - prev_time) > slope:
+                log.debug("report_slope", channel=name, value=value, previous=prev,
+                          per_minute=(value - prev) * 60.0 / (now - prev_time), **self.labels)
+                return "slope"
+        return None
+
+    def check(self, reading, now):
+        """
+        Check a reading, taken at now (a time.time()). Return the reason to
+        report it, or None if it should not be.
+        """
+        values = dict((name, getattr(reading, name, None)) for name in set(self.deltas) | set(self.slopes))
+        if self.last_time is None:
+            reason = "first"
+        else:
+            reason = self._changed(reading, values, now)
+            # Checks are min_interval_s apart, give or take scheduling jitter
+            if reason is None and now - self.last_time >= self.heartbeat_s - 0.5 * self.min_interval_s:
+                reason = "heartbeat"
+        self._previous = (now, values)
+
+        if reason is None:
+            self.suppressed_total.inc()
+            return None
+        if reason == "heartbeat":
+            # Stable, so back off
+            self.heartbeat_s = min(self.heartbeat_s * 2, self.max_interval_s)
+        else:
+            self.heartbeat_s = self.base_interval_s
+        self.heartbeat.set(self.heartbeat_s)
+        self.last_time = now
+        self.last_values = values
+        self.reports_total[reason].inc()
+        return reason
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    import airq
+    import simsensors
+
+    # An hour of simulated readings, checked every 10 s, with a cooking
+    # event half way through
+    logutil.configure("INFO")
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 60.0
+    start = time.time()
+    def tvoc(t):
+        m = (t - start) / 60.0 - minutes / 2
+        return 20.0 + (400.0 * math.exp(-m / 5.0) if m > 0 else 0.0)
+    backend = simsensors.SimBackend(speed=60.0, seed=1, sources={"tvoc": tvoc})
+    device = airq.airq(backend=backend, ccs811_n_samples=30)
+    registry = metrics.Registry()
+    gate = ReportGate(60, min_interval_s=10, max_interval_s=900, registry=registry)
+    t0 = backend.clock.time()
+    for i in range(int(minutes * 6)):
+        backend.clock.sleep(10)
+        reading = device.reading()
+        reason = gate.check(reading, backend.clock.time())
+        if reason:
+            print("{:6.1f} min {:9} tvoc={:6.1f} eco2={:6.1f} next heartbeat {} s".format(
+                (backend.clock.time() - t0) / 60, reason, reading.tvoc, reading.eco2, gate.heartbeat_s))
+    print(dict((reason, counter.value) for reason, counter in gate.reports_total.items()),
+          "suppressed", gate.suppressed_total.value)
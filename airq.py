@@ -1,12 +1,21 @@
-import qwiic_ccs811
-import qwiic_bme280
 import qwiic_tmp117
 import IQR
+import i2cbus
+import logutil
+import metrics
+import ringbuf
+import rollstats
+import sensorsched
+import snapshot
 import time
 import sys
 import _thread
-import statistics as stat
+import collections
+import contextlib
+import operator
+import logging
 
+log = logutil.get_logger("airq.sensors")
 
 """
 CCS811
@@ -25,6 +34,67 @@ chips, just by specifying the I2C adddresses for them.
 Code for this class was borrowed from the examples at
 https://qwiic-ccs811-py.readthedocs.io/en/latest/?
 """
+
+# An immutable view of the rolling statistics, published by the sampler.
+#   time - time.time() of the latest sample
+#   stats - dict of (median, mean, std dev, n) by parameter name
+Snapshot = collections.namedtuple("Snapshot", ("time", "stats"))
+
+class Reading(object):
+  """
+  A report of the sensor statistics, as numbers. Values are medians over
+  the sample windows; tvoc and eco2 are IQR filtered, and carry the
+  std dev, the number of samples used and the number of outliers removed.
+  n is the number of samples in the rh window. time is the time.time()
+  of the reading.
+
+  Values are only formatted when the reading is serialized, with a
+  function made once by serializer().
+  """
+  __slots__ = ("time",
+               "tvoc", "tvoc_std", "tvoc_n", "tvoc_outliers",
+               "eco2", "eco2_std", "eco2_n", "eco2_outliers",
+               "pres", "tdry", "rh", "n")
+
+  def __init__(self, **values):
+    for name in self.__slots__:
+      setattr(self, name, values.get(name))
+
+  def as_dict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  def __repr__(self):
+    return "Reading(" + ", ".join("{}={!r}".format(k, v) for k, v in self.as_dict().items()) + ")"
+
+  @staticmethod
+  def serializer(fields):
+    """
+    Return a function which converts a Reading to a dict of strings.
+
+    fields - A sequence of (attribute, output key, format function),
+             e.g. ("tvoc", "tvoc_ppb", "{:.2f}".format)
+    """
+    get = operator.attrgetter(*[f[0] for f in fields])
+    keys = tuple(f[1] for f in fields)
+    formats = tuple(f[2] for f in fields)
+    if len(fields) == 1:
+      return lambda reading: {keys[0]: formats[0](get(reading))}
+    def serialize(reading):
+      return dict(zip(keys, [fmt(v) for fmt, v in zip(formats, get(reading))]))
+    return serialize
+
+# The string fields of the readings returned before Reading was introduced
+legacy_fields = (
+  ("tvoc", "tvoc_ppb", "{:.2f}".format),
+  ("tvoc_std", "tvoc_std", "{:.2f}".format),
+  ("eco2", "eco2_ppm", "{:.2f}".format),
+  ("eco2_std", "eco2_std", "{:.2f}".format),
+  ("pres", "pres_mb", "{:.2f}".format),
+  ("tdry", "tdry_degc", "{:.2f}".format),
+  ("rh", "rh", "{:.2f}".format),
+  ("n", "n", "{:d}".format),
+)
+
 class airq(object):
   _deviceErrors = { \
     1 << 5 : "HeaterSupply",  \
@@ -36,157 +106,676 @@ class airq(object):
   }
 
 
-  def __init__(self, ccs811_address=0x5b, bme280_address=0x77, tmp117_address=0x48, ccs811_n_samples=1):
-    self.lock = _thread.allocate_lock()
+  # The sample queues, by parameter name
+  channels = ("tvoc", "eco2", "pres", "tdry", "rh")
+  # The parameters which are IQR filtered for reporting
+  iqr_channels = ("tvoc", "eco2")
+  # The IQR factor for outlier rejection
+  iqr_cutoff = 5.0
+  # The sensors, in the order they are first read
+  sensors = ("bme280", "tmp117", "ccs811")
+  # CCS811 measurement interval in seconds, by drive mode
+  ccs811_drive_periods = {1: 1.0, 2: 10.0, 3: 60.0, 4: 0.25}
+  # The CCS811 drive mode set by QwiicCcs811.begin(). It is never changed:
+  # mode 1 gives the densest TVOC and eCO2 results (mode 4 only produces
+  # raw data), and a sensor moved to a slower mode must first idle in mode
+  # 0 for 10 minutes, or it reads wrongly (see the CCS811 data sheet).
+  ccs811_drive_mode = 1
+  # How long to leave the CCS811 alone after an I/O error. The bus
+  # doubles the back off after each consecutive failure.
+  ccs811_backoff_s = 10.0
+  # How long to leave the BME280 or TMP117 alone after an I/O error
+  io_backoff_s = 1.0
+  # The BME280 pressure, temperature and humidity data registers, which
+  # are read in one block
+  bme280_data_block = (0xf7, 8)
+  # The CCS811 ALG_RESULT_DATA register: eCO2, TVOC, STATUS and ERROR_ID,
+  # so one read checks for and fetches a result, or the error
+  ccs811_result_block = (0x02, 6)
+  ccs811_status_error = 1 << 0
+  ccs811_status_data_ready = 1 << 3
+  # The CCS811 environmental compensation is only rewritten when the
+  # humidity (%) or temperature (C) has changed by more than these
+  ccs811_env_rh_threshold = 1.0
+  ccs811_env_tdry_threshold = 0.25
+  # The CCS811 baseline is restored, or if there is none to restore
+  # first saved, once the sensor has warmed up, and then saved hourly.
+  # AMS advise 20 minutes; a baseline restored sooner gives high eTVOC
+  # (see Docs/CCS811/Application-Note-Baseline-Save-and-Restore-on-CCS811.pdf).
+  ccs811_baseline_warmup_s = 20 * 60
+  ccs811_baseline_period_s = 3600.0
+  # The CCS811 HW_VERSION and FW_App_Version registers, which with the
+  # stack name and address identify the sensor a baseline belongs to
+  ccs811_hw_version = 0x21
+  ccs811_fw_app_version = 0x24
+  # The BME280 and TMP117 are read this often by default, in seconds, as
+  # they were by the original 2 s read loop, so that their n_samples
+  # windows span the same time. Both could be read much faster, at the
+  # cost of I2C traffic and CPU time, but pressure, temperature and
+  # humidity change slowly.
+  env_period = 2.0
+
+  def __init__(self, ccs811_address=0x5b, bme280_address=0x77, tmp117_address=0x48, ccs811_n_samples=1,
+    n_samples=None, tmp117_alert_pin=None, periods=None, archive=None, backend=None, registry=None,
+    name=None, i2c_driver=None, scheduler=None, ccs811_window_s=None, ccs811_baseline=None):
+    """
+    ccs811_n_samples - The default number of samples kept for each parameter.
+    n_samples - Optional dict of per parameter queue lengths, e.g. {"tvoc": 3600},
+                which override ccs811_n_samples.
+    tmp117_alert_pin - The BCM GPIO wired to the TMP117 ALERT pin, if any. When given,
+                the TMP117 signals data ready on it; otherwise its conversions are
+                scheduled from the conversion cycle time.
+    periods - Optional dict of sampling periods in seconds, by sensor name
+                ("bme280", "tmp117", "ccs811"). By default the CCS811 is read at
+                its drive mode rate, and the others every env_period (see
+                sample_periods()).
+    archive - Optional archive.ArchiveWriter, with a channel for each of
+                airq.channels, to which every raw sample is recorded, the
+                reads of the different sensors merged into rows.
+    backend - Optional simulated sensors, e.g. simsensors.SimBackend. Its clock
+                is used for all sampling and timestamps. By default the Qwiic
+                sensor drivers are used, with the time module as the clock.
+    registry - The metrics.Registry to record I2C, sampling and filtering
+                metrics in. The default is metrics.REGISTRY.
+    name - Optional name of this sensor stack, when a process drives several
+                (see fleet.py). Its metrics are labelled instance=name, and its
+                log messages carry the name.
+    i2c_driver - Optional i2cbus.BusDriver for the sensors, e.g. for one bus or
+                multiplexer channel of a fleet. By default one is made for the
+                default bus.
+    scheduler - Optional sensorsched.SensorScheduler shared with other stacks.
+                The sensor reads are added to it, and the caller runs it.
+                By default airq runs its own, in its own thread.
+    ccs811_window_s - Optional time the tvoc and eco2 windows should span, e.g.
+                the report interval. Unless n_samples gives their lengths, the
+                windows are made long enough to hold every CCS811 result in that
+                time (see ccs811_window_samples()).
+    ccs811_baseline - Optional baseline.BaselineCache. The CCS811 baseline is
+                restored from it after the warm up, if one was saved recently
+                for this sensor in the same drive mode, and is saved to it
+                periodically.
+    """
+    self.name = name
+    # The metric labels and log fields which identify this stack
+    self.labels = {"instance": name} if name else {}
+    # Only held while samples are added or the IQR windows are masked,
+    # never during sensor I/O.
+    self.lock = snapshot.TimedLock()
     self.ccs811_n_samples = ccs811_n_samples
+    self.n_samples = dict.fromkeys(self.channels, ccs811_n_samples)
+    if n_samples:
+      for channel, n in n_samples.items():
+        if channel not in self.n_samples:
+          raise ValueError("Unknown airq parameter: {}".format(channel))
+        self.n_samples[channel] = n
+    if ccs811_window_s:
+      for channel in self.iqr_channels:
+        if channel not in (n_samples or {}):
+          self.n_samples[channel] = self.ccs811_window_samples(ccs811_window_s)
+
+    if backend is None:
+      # Imported here, so that airq can run on a simulated backend
+      # where the Qwiic drivers are not installed
+      import qwiic_ccs811
+      import qwiic_bme280
+      import qwiic_i2c
+      self.clock = time
+      if i2c_driver is None:
+        i2c_driver = i2cbus.I2CBus(qwiic_i2c.getI2CDriver()).driver()
+      self.ccs811 = qwiic_ccs811.QwiicCcs811(address=ccs811_address, i2c_driver=i2c_driver)
+      self.bme280 = qwiic_bme280.QwiicBme280(address=bme280_address, i2c_driver=i2c_driver)
+      self.tmp117 = qwiic_tmp117.QwiicTmp117(address=tmp117_address, i2c_driver=i2c_driver)
+    else:
+      self.clock = backend.clock
+      (self.ccs811, self.bme280, self.tmp117) = backend.sensors(ccs811_address, bme280_address, tmp117_address)
+
+    self.addresses = {"ccs811": ccs811_address, "bme280": bme280_address, "tmp117": tmp117_address}
+    # All the sensor transactions go through the bus driver, which retries
+    # and backs off each sensor by its own policy
+    self.i2c = getattr(self.tmp117, "_i2c", None)
+    if isinstance(self.i2c, i2cbus.BusDriver):
+      self.i2c.set_policy(ccs811_address, i2cbus.RetryPolicy(backoff_s=self.ccs811_backoff_s))
+      self.i2c.set_policy(bme280_address, i2cbus.RetryPolicy(backoff_s=self.io_backoff_s))
+      self.i2c.set_policy(tmp117_address, i2cbus.RetryPolicy(backoff_s=self.io_backoff_s))
+    else:
+      self.i2c = None
 
-    self.ccs811 = qwiic_ccs811.QwiicCcs811(address=ccs811_address)
-    self.bme280 = qwiic_bme280.QwiicBme280(address=bme280_address)
-    self.tmp117 = qwiic_tmp117.QwiicTmp117(address=tmp117_address)
+    self.registry = registry if registry else metrics.REGISTRY
+    # Count and time every bus transaction, by sensor
+    for sensor_name in self.sensors:
+      sensor = getattr(self, sensor_name)
+      if getattr(sensor, "_i2c", None) is not None:
+        sensor._i2c = metrics.InstrumentedI2C(sensor._i2c, self.registry, sensor=sensor_name, **self.labels)
 
     self.ccs811.begin()
     self.bme280.begin()
     self.tmp117.begin()
 
-    # The conversion and averaging affect who long we will have to wait
-    # for a conversion. See the TMP117 data sheet.
-    self.tmp117.set_avg(qwiic_tmp117.QwiicTmp117.CONV_AVG_8)
-    self.tmp117.set_cycle(qwiic_tmp117.QwiicTmp117.CONV_CYCLE_2)
+    # The (rh, tdry) last written to the CCS811
+    self._ccs811_env = None
 
-    self.tvoc_q = []
-    self.eco2_q = []
-    self.pres_q = []
-    self.tdry_q = []
-    self.rh_q = []
+    # The CCS811 takes hours to learn its baseline from scratch, so restore
+    # the last one saved for this sensor, once it has warmed up
+    self.baseline_cache = ccs811_baseline
+    self.ccs811_identity = self.ccs811_id() if ccs811_baseline is not None else None
+    self._ccs811_restore_pending = self.ccs811_identity is not None
 
-    _thread.start_new_thread(self.read_loop, (None,))
-    # Sleep so that the measure thread can start
-    time.sleep(1)
+    # The conversion and averaging affect who long we will have to wait
+    # for a conversion. See the TMP117 data sheet.
+    self.tmp117.configure(cycle=qwiic_tmp117.QwiicTmp117.CONV_CYCLE_2, avg=qwiic_tmp117.QwiicTmp117.CONV_AVG_8)
+    # Wait for data ready on the ALERT pin, or sleep until each conversion
+    # is due, rather than polling the ready bit
+    if tmp117_alert_pin is not None:
+      self.tmp117.set_ready_mode(qwiic_tmp117.QwiicTmp117.READY_ALERT, alert_pin=tmp117_alert_pin)
+    else:
+      self.tmp117.set_ready_mode(qwiic_tmp117.QwiicTmp117.READY_SCHEDULED)
+
+    self.tvoc_q = ringbuf.RingBuffer(self.n_samples["tvoc"])
+    self.eco2_q = ringbuf.RingBuffer(self.n_samples["eco2"])
+    self.pres_q = ringbuf.RingBuffer(self.n_samples["pres"])
+    self.tdry_q = ringbuf.RingBuffer(self.n_samples["tdry"])
+    self.rh_q = ringbuf.RingBuffer(self.n_samples["rh"])
+
+    # Streaming statistics, updated by queue_add()
+    self.stats = {}
+    for channel in self.channels:
+      self.stats[channel] = rollstats.RollingStats(getattr(self, channel + "_q"))
+    # Streaming quartiles, for the IQR filtering of windows too long to sort
+    # cheaply in pure Python, but too short to be worth NumPy
+    self.quantiles = {}
+    for channel in self.iqr_channels:
+      if IQR.P2_MIN_WINDOW <= self.n_samples[channel] < IQR.NUMPY_MIN_WINDOW:
+        self.quantiles[channel] = IQR.WindowQuantiles(self.n_samples[channel])
+
+    self.archive = archive
+
+    # The latest statistics, which reading() can take without the lock
+    self.snapshot = snapshot.SnapshotCell()
+    self.publish(0.0)
+
+    # The time.perf_counter() when the first sample was taken
+    self.first_sample_time = None
+
+    # The latest values, for the CCS811 environmental compensation
+    self.rh = None
+    self.tdry = None
+
+    # Each sensor is read on its own schedule
+    self.periods = self.sample_periods()
+    if periods:
+      for sensor_name, period in periods.items():
+        if sensor_name not in self.periods:
+          raise ValueError("Unknown airq sensor: {}".format(sensor_name))
+        self.periods[sensor_name] = period
+    own_scheduler = scheduler is None
+    if own_scheduler:
+      scheduler = sensorsched.SensorScheduler(clock=self.clock.monotonic, sleep=self.clock.sleep)
+    self.scheduler = scheduler
+    # This stack's tasks, by sensor; task names are unique in a shared scheduler
+    self.tasks = {}
+    for sensor in self.sensors:
+      task_name = "{}.{}".format(self.name, sensor) if self.name else sensor
+      self.tasks[sensor] = scheduler.add(task_name, self.periods[sensor], self.timed_read(sensor))
+    if self.ccs811_identity:
+      task_name = "{}.ccs811_baseline".format(self.name) if self.name else "ccs811_baseline"
+      self.tasks["ccs811_baseline"] = scheduler.add(task_name, self.ccs811_baseline_period_s,
+        self.timed_read("ccs811_baseline"), delay=self.ccs811_baseline_warmup_s)
+
+    self.register_metrics()
+    if own_scheduler and self.i2c:
+      # A fleet exports the buses it shares
+      self.registry.register_stats("airq_i2c_bus", self.i2c.bus.stats, **self.labels)
+
+    if own_scheduler:
+      _thread.start_new_thread(self.read_loop, (None,))
+      # Sleep so that the measure thread can start
+      self.clock.sleep(1)
+
+  def register_metrics(self):
+    """
+    Create the metrics updated while sampling, and export the statistics
+    already kept by the lock, the scheduler and the TMP117 driver.
+    """
+    r = self.registry
+    labels = self.labels
+    self.samples_total = dict((name, r.counter("airq_samples_total",
+      "Samples added to the windows", channel=name, **labels)) for name in self.channels)
+    self.iqr_samples_total = dict((name, r.counter("airq_iqr_samples_total",
+      "Samples IQR filtered for readings", channel=name, **labels)) for name in self.iqr_channels)
+    self.iqr_outliers_total = dict((name, r.counter("airq_iqr_outliers_total",
+      "Samples removed from readings as outliers", channel=name, **labels)) for name in self.iqr_channels)
+    self.iqr_exact_total = dict((name, r.counter("airq_iqr_exact_fallbacks_total",
+      "Readings filtered with exact quartiles, as the streaming ones lagged", channel=name, **labels))
+      for name in self.iqr_channels)
+    self.ccs811_errors_total = r.counter("airq_ccs811_device_errors_total",
+      "CCS811 device errors reported by its status register", **labels)
+    self.ccs811_env_writes_total = r.counter("airq_ccs811_env_writes_total",
+      "CCS811 environmental compensation updates", **labels)
+    self.ccs811_baseline_saves_total = r.counter("airq_ccs811_baseline_saves_total",
+      "CCS811 baselines saved to the cache", **labels)
+
+    r.register_stats("airq_lock", self.lock_stats, **labels)
+    for name, task in self.tasks.items():
+      r.register_stats("airq_task", lambda task=task: {"runs": task.runs, "skipped": task.skipped,
+        "deferred": task.deferred, "rescheduled": task.rescheduled, "errors": task.errors,
+        "lateness_s": task.lateness}, sensor=name, **labels)
+    if self.i2c:
+      for name in self.sensors:
+        device = self.i2c._device(self.addresses[name])
+        r.register_stats("airq_i2c_device", device.stats, sensor=name, **labels)
+    tmp117 = self.tmp117
+    if hasattr(tmp117, "ready_polls"):
+      r.register_stats("airq_tmp117", lambda: {"ready_polls": tmp117.ready_polls,
+        "ready_timeouts": tmp117.ready_timeouts, "phase_searches": tmp117.phase_searches}, **labels)
+
+  def timed_read(self, name):
+    """
+    Return the scheduler task for a sensor: its read_ function, timed,
+    with the back offs after I/O errors counted.
+    """
+    read = getattr(self, "read_" + name)
+    read_seconds = self.registry.histogram("airq_read_seconds",
+      "Scheduled sensor read time", sensor=name, **self.labels)
+    backoffs_total = self.registry.counter("airq_backoffs_total",
+      "Sensor reads abandoned after an I/O error", sensor=name, **self.labels)
+    def timed():
+      start = time.perf_counter()
+      defer = read()
+      read_seconds.observe(time.perf_counter() - start)
+      if defer and not isinstance(defer, sensorsched.Reschedule):
+        backoffs_total.inc()
+      return defer
+    return timed
+
+  @staticmethod
+  def bme280_measurement_time(osrs_t=1, osrs_p=1, osrs_h=1, standby_s=0.0005):
+    """
+    Return the BME280 normal mode measurement period, in seconds, for the
+    oversampling and standby settings. See appendix B of the BME280 data sheet.
+    The defaults are the settings made by QwiicBme280.begin().
+    """
+    t_meas_ms = 1.25 + 2.3 * osrs_t + (2.3 * osrs_p + 0.575) + (2.3 * osrs_h + 0.575)
+    return t_meas_ms / 1000.0 + standby_s
 
+  def ccs811_window_samples(self, window_s):
+    """
+    Return the number of CCS811 results produced in window_s seconds,
+    in its drive mode.
+    """
+    return max(int(window_s / self.ccs811_drive_periods[self.ccs811_drive_mode]), 1)
 
-  def read_loop(self, arg):
-    while True:
-      self.lock.acquire()
-      self.read_bme280()
-      self.read_tmp117()
-      self.read_ccs811()
-      self.lock.release()
-      time.sleep(2)
+  def sample_periods(self):
+    """
+    Return the default sampling period of each sensor, in seconds:
+      tmp117 - env_period, or the conversion cycle time if longer
+      bme280 - env_period, or the normal mode measurement time if longer
+      ccs811 - the drive mode measurement interval
+    """
+    return {
+      "bme280": max(self.bme280_measurement_time(), self.env_period),
+      "tmp117": max(self.tmp117.conversion_time(), self.env_period),
+      "ccs811": self.ccs811_drive_periods[self.ccs811_drive_mode],
+    }
 
-  def reading(self):
+  def add_samples(self, samples):
     """
-    Return a hash containing sensor readings.
-    The hash will contain:
-        temp_C
-        press_mb
-        rh
+    Add the samples from a sensor read to their queues, and publish a new
+    snapshot. The sensor I/O must already be done, so that the lock is
+    never held while waiting on the bus.
+
+    samples - A sequence of (parameter name, value)
     """
-    self.lock.acquire()
-    retval = {}
+    t = self.clock.time()
+    with self.lock:
+      for name, val in samples:
+        self.queue_add(getattr(self, name + "_q"), val, name)
+        self.samples_total[name].inc()
+      self.publish(t)
 
-    tvoc = self.queue_avg(self.tvoc_q, "tvoc")
-    retval["tvoc_ppb"] = "{:.2f}".format(tvoc[0])
-    retval["tvoc_std"] = "{:.2f}".format(tvoc[2])
+    if self.archive:
+      self.archive.record(t, samples)
 
-    eco2 = self.queue_avg(self.eco2_q, "eco2")
-    retval["eco2_ppm"] = "{:.2f}".format(eco2[0])
-    retval["eco2_std"] = "{:.2f}".format(eco2[2])
+  def publish(self, t):
+    """
+    Publish a snapshot of the rolling statistics. Called with the lock held.
+    """
+    stats = {}
+    for name in self.channels:
+      stats[name] = self.stats[name].snapshot()
+    self.snapshot.publish(Snapshot(t, stats))
 
-    retval["pres_mb"] = "{:.2f}".format(self.queue_avg(self.pres_q, "pres", do_iqr=False)[0])
+  def lock_stats(self):
+    """
+    Return the lock wait and hold times, to confirm that reading()
+    is never blocked behind sensor I/O.
+    """
+    return self.lock.stats()
 
-    retval["tdry_degc"] = "{:.2f}".format(self.queue_avg(self.tdry_q, "tdry", do_iqr=False)[0])
+  def read_loop(self, arg):
+    self.scheduler.run()
 
-    retval["rh"] = "{:.2f}".format(self.queue_avg(self.rh_q, "rh", do_iqr=False)[0])
+  def reading(self):
+    """
+    Return a Reading of the sensor statistics.
 
-    retval["n"] = "{:d}".format(len(self.rh_q))
-    self.lock.release()
+    The statistics come from the latest published snapshot, without
+    locking. The lock is only taken to IQR filter the tvoc and eco2
+    windows (see iqr_filter()), which involves no I/O.
+    Only windows that actually contain outliers are copied, and their
+    statistics are calculated after the lock is released.
+    """
+    (version, snap) = self.snapshot.get()
+    snaps = dict(snap.stats)
+
+    filtered = {}
+    with self.lock:
+      for name in self.iqr_channels:
+        filtered[name] = self.iqr_filter(name)
+        # The statistics to use when there are no outliers, consistent with the window
+        snaps[name] = self.stats[name].snapshot()
+
+    retval = Reading(time=self.clock.time())
+
+    for name in self.iqr_channels:
+      (cleaned, outliers) = filtered[name]
+      (median, mean, std) = self.cleaned_avg(filtered[name], name, snapshot=snaps[name])
+      setattr(retval, name, median)
+      setattr(retval, name + "_std", std)
+      n = snaps[name][3] if cleaned is None else len(cleaned)
+      setattr(retval, name + "_n", n)
+      setattr(retval, name + "_outliers", len(outliers))
+      self.iqr_samples_total[name].inc(n + len(outliers))
+      self.iqr_outliers_total[name].inc(len(outliers))
+
+    retval.pres = snaps["pres"][0]
+    retval.tdry = snaps["tdry"][0]
+    retval.rh = snaps["rh"][0]
+    retval.n = snaps["rh"][3]
     return retval
 
   def queue_add(self, q, val, param):
-    q.append(val)
-    if len(q) > self.ccs811_n_samples:
-      q.pop(0)
+    """
+    Add a value to a queue, and update its rolling statistics
+    and streaming quartiles.
+    """
+    self.stats[param].append(val)
+    if self.first_sample_time is None:
+      self.first_sample_time = time.perf_counter()
+    quantiles = self.quantiles.get(param)
+    if quantiles:
+      quantiles.add(val)
+
+  def iqr_filter(self, name):
+    """
+    IQR filter a parameter's window. Must be called with the lock held.
 
-  def queue_avg(self, q, name, do_iqr=True):
+    Short windows are filtered in pure Python, so NumPy is not
+    imported until a window is long enough to benefit from it; the
+    streaming quartiles are used for those long enough to be slow to
+    sort, unless they reject too much of the window. Long windows
+    are filtered with exact quartiles, from one NumPy partition pass,
+    which costs no more than masking the window.
+
+    Returns: (kept, outliers). kept is None when there are no outliers,
+    since the rolling statistics already describe the whole window.
+    """
+    buf = self.stats[name].buffer
+    if not len(buf):
+      # No results yet, e.g. before the CCS811's first
+      return (None, [])
+    if len(buf) >= IQR.NUMPY_MIN_WINDOW:
+      # Boolean indexing makes copies, which stay valid after the lock is released
+      (cleaned, outliers) = IQR.iqr_filter_array(buf.ndarray(), self.iqr_cutoff)
+    else:
+      values = buf.values()
+      quantiles = self.quantiles.get(name)
+      limits = quantiles.limits(self.iqr_cutoff) if quantiles else None
+      (cleaned, outliers) = IQR.iqr_filter(values, self.iqr_cutoff, limits)
+      if limits is not None and len(outliers) > IQR.P2_MAX_OUTLIER_FRACTION * len(values):
+        (cleaned, outliers) = IQR.iqr_filter(values, self.iqr_cutoff)
+        self.iqr_exact_total[name].inc()
+    if not len(outliers):
+      return (None, outliers)
+    return (cleaned, outliers)
+
+  def queue_avg(self, q, name, do_iqr=True, snapshot=None):
     """
     Return a tuple of the q:
       (median, mean, std dev)
+
+    snapshot - The RollingStats snapshot taken with q. If given, it is
+               returned directly when there is nothing to filter out.
     """
     if do_iqr:
-      (cleaned, outliers) = IQR.iqr_filter(q, 5.0)
+      (cleaned, outliers) = IQR.iqr_filter(q, self.iqr_cutoff)
     else:
-      cleaned = q
+      cleaned = list(q)
       outliers = []
 
-    retval = (stat.median(cleaned), stat.mean(cleaned), stat.stdev(cleaned))
+    if snapshot and not len(outliers):
+      cleaned = None
+    return self.cleaned_avg((cleaned, outliers), name, snapshot)
+
+  def cleaned_avg(self, filtered, name, snapshot=None):
+    """
+    Return a tuple of the (median, mean, std dev) of IQR filtered data.
+
+    filtered - The (kept, outliers) tuple. If kept is None, snapshot
+               is used instead.
+    """
+    (cleaned, outliers) = filtered
+    if cleaned is None:
+      return snapshot[:3]
+
+    retval = IQR.summary(cleaned)
 
-    if len(outliers):
-      print(name, q)
-      print("*** Ignoring outliers in", name, outliers)
-      print(retval)
+    # The outliers are counted in airq_iqr_outliers_total; only summarize them here
+    if len(outliers) and log.enabled(logging.DEBUG):
+      log.debug("outliers", channel=name, n=len(outliers), min=min(outliers), max=max(outliers),
+        median=retval[0], kept=len(cleaned), **self.labels)
 
     return retval
 
+  def prefetch(self, sensor, block):
+    """
+    Return a context in which the sensor's reads of the (register, length)
+    block are served from one block read.
+
+    sensor - The sensor name
+    """
+    if self.i2c is None:
+      return contextlib.nullcontext()
+    return self.i2c.prefetch(self.addresses[sensor], *block)
+
+  @staticmethod
+  def backoff(error, default):
+    """
+    Return how long to back off after an I/O error: as long as the bus
+    backed the device off for, if it did.
+    """
+    return getattr(error, "backoff_s", default)
+
   def read_bme280(self):
-    self.rh = self.bme280.humidity
-    self.pres = self.bme280.pressure/100.0
-    self.queue_add(self.rh_q, self.rh, "rh")
-    self.queue_add(self.pres_q, self.pres, "pres")
+    try:
+      with self.prefetch("bme280", self.bme280_data_block):
+        rh = self.bme280.humidity
+        pres = self.bme280.pressure/100.0
+    except OSError as error:
+      backoff_s = self.backoff(error, self.io_backoff_s)
+      log.warning("bme280_io_error", error=error, backoff_s=backoff_s, **self.labels)
+      return backoff_s
+    self.rh = rh
+    self.pres = pres
+    self.add_samples((("rh", self.rh), ("pres", self.pres)))
 
   def read_tmp117(self):
-    n = 0
-    while not self.tmp117.is_ready():
-      time.sleep(0.05)
-      n += 1
-      if (n > 20):
-        print("tmp117 timeout, no meausrement")
-        return
-    self.tdry = self.tmp117.temperature_celsius
-    self.queue_add(self.tdry_q, self.tdry, "tdry")
+    """
+    Read the TMP117 if a conversion is complete. Otherwise reschedule the
+    task for when it will be, rather than wait in the scheduler thread,
+    which would hold up the other sensors and stacks.
+    """
+    try:
+      wait = self.tmp117.ready_in()
+      if wait is None:
+        log.warning("tmp117_timeout", **self.labels)
+        return sensorsched.Reschedule(self.tmp117.POLL_INTERVAL_S)
+      if wait > 0:
+        return sensorsched.Reschedule(wait)
+      tdry = self.tmp117.temperature_celsius
+    except OSError as error:
+      backoff_s = self.backoff(error, self.io_backoff_s)
+      log.warning("tmp117_io_error", error=error, backoff_s=backoff_s, **self.labels)
+      return backoff_s
+    self.tdry = tdry
+    self.add_samples((("tdry", self.tdry),))
+
+  def update_ccs811_env(self):
+    """
+    Write the humidity and temperature to the CCS811 for its environmental
+    compensation, if they have changed by more than the thresholds since
+    they were last written.
+    """
+    if self.rh is None or self.tdry is None:
+      return
+    last = self._ccs811_env
+    if (last is not None and abs(self.rh - last[0]) <= self.ccs811_env_rh_threshold
+        and abs(self.tdry - last[1]) <= self.ccs811_env_tdry_threshold):
+      return
+    self.ccs811.set_environmental_data(self.rh, self.tdry)
+    self._ccs811_env = (self.rh, self.tdry)
+    self.ccs811_env_writes_total.inc()
+
+  def ccs811_id(self):
+    """
+    Return the key of this CCS811 in the baseline cache, or None if its
+    versions cannot be read. The CCS811 has no serial number, so it is
+    identified by the stack name, its address and its hardware and
+    firmware versions; a replaced sensor of the same versions inherits
+    a baseline which is at worst a week old (see baseline.MAX_AGE_S).
+    Baselines are specific to the drive mode, so that is part of the key.
+    """
+    address = self.addresses["ccs811"]
+    try:
+      hw = self.ccs811._i2c.readByte(address, self.ccs811_hw_version)
+      fw = self.ccs811._i2c.readBlock(address, self.ccs811_fw_app_version, 2)
+    except OSError as error:
+      log.warning("ccs811_baseline_unavailable", error=error, **self.labels)
+      return None
+    return "{}:0x{:02x}:hw{:02x}:fw{:02x}{:02x}:mode{}".format(self.name or "airq", address, hw, fw[0], fw[1],
+      self.ccs811_drive_mode)
+
+  def restore_ccs811_baseline(self):
+    """
+    Write the cached baseline to the CCS811, if it is fresh enough.
 
-  def read_ccs811(self):
+    Returns: True if it was restored.
+    """
+    saved = self.baseline_cache.load(self.ccs811_identity, self.clock.time())
+    if saved is None:
+      log.always(logging.INFO, "ccs811_baseline_not_cached", key=self.ccs811_identity, **self.labels)
+      return False
+    (value, age_s) = saved
+    self.ccs811.set_baseline(value)
+    log.always(logging.INFO, "ccs811_baseline_restored", key=self.ccs811_identity,
+      baseline=hex(value), age_h=age_s / 3600.0, **self.labels)
+    return True
+
+  def read_ccs811_baseline(self):
+    """
+    The baseline task. Its first run, after the warm up, restores the
+    cached baseline; later runs, or the first if there was none to
+    restore, read the CCS811 baseline and save it to the cache.
 
-    while True:
-      try:
-        self.ccs811.set_environmental_data(self.rh, self.tdry)
-        while not self.ccs811.data_available():
-          print("CCS811 starting up")
-          time.sleep(1)
+    Returns: The seconds to back off after an I/O error, otherwise None.
+    """
+    try:
+      if self._ccs811_restore_pending:
+        restored = self.restore_ccs811_baseline()
+        self._ccs811_restore_pending = False
+        if restored:
+          return
+      value = self.ccs811.get_baseline()
+    except OSError as error:
+      backoff_s = self.backoff(error, self.ccs811_backoff_s)
+      log.warning("ccs811_baseline_io_error", error=error, backoff_s=backoff_s, **self.labels)
+      return backoff_s
+    try:
+      self.baseline_cache.save(self.ccs811_identity, value, self.clock.time())
+    except OSError as error:
+      # e.g. a read only or full file system; try again next period
+      log.warning("ccs811_baseline_save_failed", error=error, path=self.baseline_cache.path, **self.labels)
+      return
+    self.ccs811_baseline_saves_total.inc()
+    log.debug("ccs811_baseline_saved", key=self.ccs811_identity, baseline=hex(value), **self.labels)
 
-        if self.ccs811.data_available():
-          self.ccs811.read_algorithm_results()
-          self.eco2 = self.ccs811.CO2
-          self.tvoc = self.ccs811.TVOC
-          self.queue_add(self.eco2_q, self.eco2, "eco2")
-          self.queue_add(self.tvoc_q, self.tvoc, "tvoc")
+  def read_ccs811(self):
+    """
+    Read the CCS811 if a result is available. It is called at the drive
+    mode rate, so it does not wait for the sensor.
 
+    Returns: The seconds to back off after an I/O error, otherwise None.
+    """
+    try:
+      self.update_ccs811_env()
+
+      if self.i2c is not None:
+        # One block read, rather than reading STATUS and then the result.
+        # Through the CCS811's own driver, so that it is counted and timed.
+        data = self.ccs811._i2c.readBlock(self.addresses["ccs811"], *self.ccs811_result_block)
+        available = bool(data[4] & self.ccs811_status_data_ready)
+        status_error = not available and bool(data[4] & self.ccs811_status_error)
+        eco2 = (data[0] << 8) | data[1]
+        tvoc = (data[2] << 8) | data[3]
+        error_id = data[5]
+      else:
+        available = self.ccs811.data_available()
+        status_error = not available and self.ccs811.check_status_error()
+        error_id = None
+        if available:
+          self.ccs811.read_algorithm_results()
+          eco2 = self.ccs811.CO2
+          tvoc = self.ccs811.TVOC
+
+      if available:
+        self.eco2 = eco2
+        self.tvoc = tvoc
+        self.add_samples((("eco2", self.eco2), ("tvoc", self.tvoc)))
+
+      elif status_error:
+        # Reading ERROR_ID, alone or in the result block, clears the error
+        error = self.ccs811.get_error_register() if error_id is None else error_id
+        self.ccs811_errors_total.inc()
+        if error == 0xFF:
+          # communication error
+          log.error("ccs811_error_id_unreadable", **self.labels)
         else:
-          print("CCS811  data not available")
-          if self.ccs811.check_status_error():
-            error = self.ccs811.get_error_register();
-            if error == 0xFF:   
-              # communication error
-              print("CCS811 failed to get Error ID register from sensor")
-            else:
-              strErr = "CCS811 unknown error"
-              for code in self._deviceErrors.keys():
-                if error & code:
-                  strErr = self._deviceErrors[code]
-                  break
-              print("CCS811 device error: %s" % strErr)
-        break
-
-      except OSError as error:
-        print("***", error, "while accessing CCS811, sleeping for 10 seconds.")
-        time.sleep(10)
+          strErr = "CCS811 unknown error"
+          for code in self._deviceErrors.keys():
+            if error & code:
+              strErr = self._deviceErrors[code]
+              break
+          log.error("ccs811_device_error", error=strErr, error_id=hex(error), **self.labels)
+
+      elif not len(self.tvoc_q):
+        log.info("ccs811_starting", **self.labels)
+
+    except OSError as error:
+      # The CCS811 may have reset, so send the compensation again
+      self._ccs811_env = None
+      backoff_s = self.backoff(error, self.ccs811_backoff_s)
+      log.warning("ccs811_io_error", error=error, backoff_s=backoff_s, **self.labels)
+      return backoff_s
 
 if __name__ == '__main__':
     n_samples = 10
     if len(sys.argv) == 2:
       n_samples = int(sys.argv[1])
 
+    logutil.configure("DEBUG")
     device = airq(ccs811_n_samples=n_samples)
+    as_strings = Reading.serializer(legacy_fields)
     while True:
       # Sleep first so that a full series can be collected
       time.sleep(n_samples)
-      print(device.reading())
+      print(as_strings(device.reading()))
+      print(device.lock_stats())
@@ -8,11 +8,25 @@ Read ccs811 bme280 tmp117 sensors, and send to CHORDS.
 import time
 import sys
 import json
+import logging
+import os
+import signal
+
+import startup
+# Time the remaining imports if a startup report was requested
+if "--startup-report" in sys.argv:
+    startup.install()
 
 import iwconfig
 import pychords.tochords as tochords
 
 import airq
+import logutil
+import metrics
+import outbox
+import uploader
+
+log = logutil.get_logger("airq.chords")
 
 # A test config to be used in the absence of a configuration file
 test_config = """
@@ -34,35 +48,58 @@ test_config = """
 }
 """
 
-def make_chords_vars(old_hash, replace_keys):
+def timestamp(secs=None):
     """
-    Rename the keys in a hash. If an old key does not
-    exist in the new_keys, remove it.
+    Return an ISO formated timestamp, for secs since the epoch,
+    or for the current time if secs is not given.
     """
-    new_hash = {}
-    for old_key, old_val in old_hash.items():
-        if old_key in replace_keys:
-            new_hash[replace_keys[old_key]] = old_val
+    t = time.gmtime(secs)
+    ts = "{:04}-{:02}-{:02}T{:02}:{:02}:{:02}Z".format(t[0], t[1], t[2], t[3], t[4], t[5])
+    return ts
 
-    # The chords library wants the vars in a separate dict
-    new_hash = {"vars": new_hash}
-    return new_hash
+# The CHORDS variable name and format of each Reading attribute that is sent
+chords_fields = (
+    ("time", "at", timestamp),
+    ("tvoc", "tvoc", "{:.2f}".format),
+    ("tvoc_std", "tvoc_std", "{:.2f}".format),
+    ("eco2", "eco2", "{:.2f}".format),
+    ("eco2_std", "eco2_std", "{:.2f}".format),
+    ("pres", "pres", "{:.2f}".format),
+    ("tdry", "tdry", "{:.2f}".format),
+    ("rh", "rh", "{:.2f}".format),
+    ("n", "n", "{:d}".format),
+)
 
+# Format a Reading as CHORDS variables, without renaming keys per report
+make_chords_vars = airq.Reading.serializer(chords_fields)
 
-def timestamp():
+def airq_args(section):
     """
-    Return an ISO formated current timestamp
+    Return the airq.airq keyword arguments for an "airq" config section,
+    or for one of its stacks.
     """
-    t = time.gmtime()
-    ts = "{:04}-{:02}-{:02}T{:02}:{:02}:{:02}Z".format(t[0], t[1], t[2], t[3], t[4], t[5])
-    return ts
+    return {
+        "ccs811_address": section["ccs811_i2c"],
+        "bme280_address": section["bme280_i2c"],
+        "tmp117_address": section["tmp117_i2c"],
+        "ccs811_n_samples": section["ccs811_n_samples"],
+        # Optional per parameter queue lengths, e.g. {"tvoc": 3600}
+        "n_samples": section.get("n_samples", None),
+        # Optional BCM GPIO wired to the TMP117 ALERT pin
+        "tmp117_alert_pin": section.get("tmp117_alert_pin", None),
+        # Optional sampling periods by sensor, e.g. {"bme280": 2.0}
+        "periods": section.get("periods", None),
+        # Optional time the CCS811 windows should span, usually the report
+        # interval, which sizes them to hold every result in that time
+        "ccs811_window_s": section.get("ccs811_window_s", None),
+    }
 
 def get_iw():
     """
     Return iwconfig values that we want to send on to CHORDS.
     Possible returned hash values are "sig_dbm".
     """
-    iw = iwconfig.iwconfig()
+    iw = iwconfig.wifi()
     iwvars = {}
     if "sig_dbm" in iw.keys():
         iwvars["sig_dbm"] = iw["sig_dbm"]
@@ -70,30 +107,28 @@ def get_iw():
 
 if __name__ == '__main__':
 
-    new_keys = {
-        'time': 'at',
-        'tvoc_ppb': 'tvoc',
-        'tvoc_std': 'tvoc_std',
-        'eco2_ppm': 'eco2',
-        'eco2_std': 'eco2_std',
-        'pres_mb': 'pres',
-        'tdry_degc': 'tdry',
-        'rh': 'rh',
-        'n':'n'
-    }
-
-    print("Starting", sys.argv)
+    # --startup-report prints the import times, and the latency from
+    # launch to the first sample and the first report, to stderr.
+    startup_report = "--startup-report" in sys.argv
+    # --async runs the reading, wifi stats and upload as concurrent asyncio
+    # tasks, with report ticks aligned to the wall clock.
+    async_mode = "--async" in sys.argv
+    args = [a for a in sys.argv if a not in ("--startup-report", "--async")]
 
-    if len(sys.argv) > 2:
-        print("Usage:", sys.argv[0], "[config_file]")
+    if len(args) > 2:
+        print("Usage:", args[0], "[--startup-report] [--async] [config_file]")
         sys.exit(1)
 
-    if len(sys.argv) == 1:
+    if len(args) == 1:
         config = json.loads(test_config)
     else:
-        config = json.loads(open(sys.argv[1]).read())
+        config = json.loads(open(args[1]).read())
 
-    print(config['airq'])
+    # Optional logging level (default INFO; DEBUG logs each URI and the
+    # outliers removed), and JSON lines instead of key=value
+    logutil.configure(config["airq"].get("log_level", "INFO"), as_json=config["airq"].get("log_json", False))
+    log.always(logging.INFO, "starting", argv=sys.argv)
+    log.always(logging.INFO, "config", **config["airq"])
 
     # Extract some useful config values
     host = config["chords"]["host"]
@@ -108,52 +143,204 @@ if __name__ == '__main__':
         chords_options["api_email"] = config["chords"]["api_email"]
         chords_options["api_key"] = config["chords"]["api_key"]
 
-    ccs811_i2c = config["airq"]["ccs811_i2c"]
-    bme280_i2c = config["airq"]["bme280_i2c"]
-    tmp117_i2c = config["airq"]["tmp117_i2c"]
-    ccs811_n_samples = config["airq"]["ccs811_n_samples"]
     chords_report_interval = config["airq"]["chords_report_interval"]
+    # Optional directory for the raw sample archive. Each stack of a fleet
+    # has its own subdirectory. The oldest files are deleted beyond
+    # archive_max_mb (each stack's), or optionally archive_max_days, so
+    # that the archive cannot fill the SD card.
+    archive_dir = config["airq"].get("archive", None)
+    archive_max_mb = config["airq"].get("archive_max_mb", 512)
+    archive_max_days = config["airq"].get("archive_max_days", None)
+    sample_archives = []
+    if archive_dir:
+        import archive
+
+    def open_archive(directory, **labels):
+        sample_archive = archive.ArchiveWriter(directory, airq.airq.channels,
+            max_bytes=archive_max_mb * 1024 * 1024 if archive_max_mb else None,
+            max_age_s=archive_max_days * 86400 if archive_max_days else None)
+        sample_archives.append(sample_archive)
+        metrics.REGISTRY.register_stats("airq_archive", lambda: {"rows": sample_archive.rows,
+            "files": sample_archive.files, "expired": sample_archive.expired}, **labels)
+        return sample_archive
+
+    # Optional file in which the CCS811 baselines are cached across restarts.
+    # The stacks of a fleet share it, each keyed by its name.
+    baseline_path = config["airq"].get("ccs811_baseline", None)
+    baseline_cache = None
+    if baseline_path:
+        import baseline
+        baseline_cache = baseline.BaselineCache(baseline_path)
+        metrics.REGISTRY.register_stats("airq_ccs811_baseline_cache", baseline_cache.stats)
+
+    # Optional list of sensor stacks, driven by this one process. Each has a
+    # name, and optionally an inst_id, I2C bus, TCA9548A mux_channel (and
+    # mux_address), and any airq settings which differ from the airq section.
+    # Each stack reports to its own CHORDS instrument.
+    stack_configs = config["airq"].get("stacks", None)
+    if stack_configs:
+        import fleet
+        stack_args = []
+        stack_options = []
+        for stack in stack_configs:
+            section = dict(config["airq"])
+            section.update(stack)
+            kwargs = airq_args(section)
+            kwargs["name"] = stack["name"]
+            kwargs["ccs811_baseline"] = baseline_cache
+            for key in ("bus", "mux_channel", "mux_address"):
+                if key in stack:
+                    kwargs[key] = stack[key]
+            if archive_dir:
+                kwargs["archive"] = open_archive(os.path.join(archive_dir, stack["name"]), instance=stack["name"])
+            stack_args.append(kwargs)
+            stack_options.append(dict(chords_options, inst_id=stack.get("inst_id", chords_options["inst_id"])))
+        sensor_fleet = fleet.Fleet(stack_args)
+        stacks = list(zip(stack_options, sensor_fleet.devices))
+    else:
+        device = airq.airq(archive=open_archive(archive_dir) if archive_dir else None,
+                           ccs811_baseline=baseline_cache, **airq_args(config["airq"]))
+        stacks = [(chords_options, device)]
+    if startup_report:
+        startup.mark("airq initialized")
+
+    # Optional local port for the Prometheus metrics endpoint
+    metrics_port = config["airq"].get("metrics_port", None)
+    if metrics_port:
+        metrics.REGISTRY.serve(metrics_port)
+    metrics.REGISTRY.register_stats("airq_log", logutil.counts)
+    report_seconds = metrics.REGISTRY.histogram("airq_report_seconds",
+        "Time to build and queue a CHORDS report")
+
+    # With an outbox, submissions are queued on disk and survive restarts.
+    # Otherwise they are queued in memory, up to the 10 days (of one minute
+    # reports) that the pychords sender thread kept, and sent at once.
+    # Either way they are sent over pooled keep-alive connections.
+    outbox_path = config["chords"].get("outbox", None)
+    if outbox_path:
+        chords_outbox = outbox.Outbox(outbox_path)
+        log.always(logging.INFO, "outbox_opened", path=outbox_path, queued=len(chords_outbox))
+        flush_latency = config["chords"].get("flush_latency", 10.0)
+    else:
+        chords_outbox = outbox.Outbox(":memory:", max_entries=10*24*60)
+        flush_latency = 0.0
+    # Send the outbox in batches, each over one keep-alive connection
+    chords_uploader = uploader.BatchUploader(
+        chords_outbox,
+        batch_size=config["chords"].get("batch_size", 50),
+        flush_latency=flush_latency)
+    chords_uploader.start()
+
+    def outbox_stats():
+        stats = chords_outbox.stats()
+        stats["oldest_age_s"] = chords_outbox.oldest_age() or 0.0
+        return stats
+    metrics.REGISTRY.register_stats("airq_outbox", outbox_stats)
+    metrics.REGISTRY.register_stats("airq_uploader", chords_uploader.stats)
+
+    # Optional adaptive reporting. The readings are checked every
+    # min_interval_s, and each stack's are only reported when its TVOC or
+    # eCO2 changes (see adaptive.py), or as a heartbeat which backs off
+    # from chords_report_interval to max_interval_s while they are stable.
+    adaptive_config = config["airq"].get("adaptive_report", None)
+    if adaptive_config:
+        import adaptive
+        gates = [adaptive.ReportGate(chords_report_interval, registry=metrics.REGISTRY,
+                                     **dict(adaptive_config, **device.labels))
+                 for options, device in stacks]
+        tick_interval = gates[0].min_interval_s
+    else:
+        gates = None
+        tick_interval = chords_report_interval
+
+    def read_stacks():
+        """
+        Return a reading from each stack, with None for the stacks which
+        have nothing new to report; or None if none of them have.
+        """
+        readings = [device.reading() for options, device in stacks]
+        if gates:
+            now = time.time()
+            readings = [reading if gate.check(reading, now) else None
+                        for gate, reading in zip(gates, readings)]
+            if all(reading is None for reading in readings):
+                return None
+        return readings
+
+    def send_report(t, readings, iw_vars):
+        """
+        Send each stack's airq.Reading to CHORDS, timestamped t if given.
+        """
+        global startup_report
 
-    device = airq.airq(
-      ccs811_address=ccs811_i2c, 
-      bme280_address=bme280_i2c, 
-      tmp117_address=tmp117_i2c,
-      ccs811_n_samples=ccs811_n_samples)
+        for (options, device), reading in zip(stacks, readings):
+            if reading is None:
+                continue
+            start = time.perf_counter()
+            if t is not None:
+                reading.time = t
 
-    # Start the CHORDS sender thread
-    tochords.startSender()
+            # Make a chords variable dict to send to chords. The chords
+            # library wants the vars in a separate dict.
+            chords_vars = make_chords_vars(reading)
 
-    # Flush the outputs
-    sys.stdout.flush()
-    sys.stderr.flush()
+            # Add in other variables
+            chords_vars.update(iw_vars)
+            chords_record = {"vars": chords_vars}
 
-    while True:
-        # Sleep until the next measurement time
-        time.sleep(chords_report_interval)
+            # Merge in the chords options
+            chords_record.update(options)
 
-        # Get the CCS811 reading
-        ccs811_data = device.reading()
-        ccs811_data['time'] = timestamp()
+            # create the chords uri
+            uri = tochords.buildURI(host, chords_record)
+            log.always(logging.DEBUG, "report", uri=uri)
+            # Queue it for the uploader
+            chords_outbox.append(uri)
+            report_seconds.observe(time.perf_counter() - start)
 
-        # Make a chords variable dict to send to chords
-        chords_record = make_chords_vars(ccs811_data, new_keys)
+        if startup_report:
+            startup.mark("first sample", stacks[0][1].first_sample_time)
+            startup.mark("first report")
+            startup.report()
+            startup.uninstall()
+            startup_report = False
 
-        # Add in other variables
+    def stop(signum, frame):
+        # Only unwind the main thread. It may be inside chords_outbox.append(),
+        # holding the outbox lock, so the outbox is closed in the finally below.
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
 
-        # Get iwconfig details
-        iw_vars = get_iw()
-        chords_record["vars"].update(iw_vars)
+    pipeline = None
+    try:
+        if async_mode:
+            import asyncpipe
+            pipeline = asyncpipe.Pipeline(tick_interval, read_stacks, send_report, get_aux=get_iw,
+                                          aux_interval=chords_report_interval)
+            metrics.REGISTRY.register_stats("airq_pipeline", pipeline.stats)
+            pipeline.run()
 
-        # Merge in the chords options
-        chords_record.update(chords_options)
+        while True:
+            # Sleep until the next measurement time
+            time.sleep(tick_interval)
 
-        # create the chords uri
-        uri = tochords.buildURI(host, chords_record)
-        print(uri)
-        # Send it to chords
-        tochords.submitURI(uri, 10*24*60)
+            # Get the sensor readings
+            readings = read_stacks()
+            if readings is None:
+                continue
 
-        # Flush the outputs
-        sys.stdout.flush()
-        sys.stderr.flush()
+            # Get iwconfig details
+            iw_vars = get_iw()
 
+            send_report(None, readings, iw_vars)
+    finally:
+        # Commit the pending submissions and archive rows, e.g. when systemd
+        # stops us. The uploader finishes its batch first, so that it does
+        # not use the outbox once it is closed.
+        if pipeline:
+            pipeline.shutdown()
+        if not chords_uploader.stop(timeout=5.0):
+            log.warning("uploader_not_stopped")
+        chords_outbox.close()
+        for sample_archive in sample_archives:
+            sample_archive.close()
@@ -0,0 +1,298 @@
+"""
+A compact binary archive of raw samples.
+
+Each archive file holds fixed width rows of a float64 timestamp followed
+by one float32 per channel, after a fixed size header:
+
+    offset  type      field
+    0       8s        magic, b"AIRQARC1"
+    8       uint16    format version
+    10      uint16    number of channels
+    12      uint32    row size, bytes
+    16      uint32    header size, bytes (the data offset)
+    20      uint32    reserved
+    24      float64   timestamp of the first row
+    32      float64   timestamp of the last flushed row
+    40      16s * n   channel names, NUL padded
+
+All values are little endian. The data starts on a page boundary, so files
+can be memory mapped as NumPy structured arrays without copying. The row
+count comes from the file size, so a file cut short by a crash is still
+readable up to its last complete row.
+
+Files are named airq-YYYYmmddTHHMMSS.arc, after their first row, and are
+rotated at each UTC midnight or when they reach rotate_rows rows. At each
+rotation the oldest files are deleted, while the directory holds more
+than max_bytes, or their last row is older than max_age_s. Writing needs
+only the standard library; NumPy is imported when a file is read.
+
+The sensors are read separately, so record() merges the samples of
+successive reads into one row, until a channel repeats; a row only has
+NaNs for channels not read in that time.
+"""
+import math
+import os
+import struct
+import time
+
+MAGIC = b"AIRQARC1"
+VERSION = 1
+HEADER_SIZE = 4096
+NAME_SIZE = 16
+_FIXED = struct.Struct("<8sHHIII dd")
+_TIMES_OFFSET = 24
+_TIMES = struct.Struct("<dd")
+SUFFIX = ".arc"
+
+class ArchiveWriter(object):
+    """
+    Append rows of samples to rotating archive files.
+
+        :param directory: Where to write the files
+        :param channels: The channel names
+        :param rotate_rows: Start a new file after this many rows
+        :param rotate_seconds: Start a new file at each multiple of this many
+                               seconds since the epoch, so that files hold
+                               whole days (or hours, etc.)
+        :param flush_rows: Flush to the file system after this many rows
+        :param max_bytes: Optional limit on the size of the directory's
+                          archive files, beyond which the oldest are deleted
+        :param max_age_s: Optional age beyond which files are deleted
+    """
+    def __init__(self, directory, channels, rotate_rows=4*1024*1024, rotate_seconds=86400, flush_rows=64,
+                 max_bytes=None, max_age_s=None):
+        if _FIXED.size + len(channels) * NAME_SIZE > HEADER_SIZE:
+            raise ValueError("Too many archive channels")
+        self.directory = directory
+        self.channels = tuple(channels)
+        self.rotate_rows = rotate_rows
+        self.rotate_seconds = rotate_seconds
+        self.flush_rows = flush_rows
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.row = struct.Struct("<d{}f".format(len(self.channels)))
+        self._file = None
+        self.path = None
+        self._index = dict((channel, i) for i, channel in enumerate(self.channels))
+        # The row being merged by record(), and its time
+        self._pending = None
+        self._pending_time = None
+        os.makedirs(directory, exist_ok=True)
+
+        self.rows = 0       # rows written, all files
+        self.files = 0      # files created
+        self.expired = 0    # files deleted by the size and age limits
+
+    def _open(self, t):
+        name = "airq-" + time.strftime("%Y%m%dT%H%M%S", time.gmtime(t)) + SUFFIX
+        path = os.path.join(self.directory, name)
+        # Two files starting in the same second
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, "{}.{}{}".format(name[:-len(SUFFIX)], n, SUFFIX))
+            n += 1
+        header = bytearray(HEADER_SIZE)
+        _FIXED.pack_into(header, 0, MAGIC, VERSION, len(self.channels), self.row.size, HEADER_SIZE, 0, t, t)
+        for i, channel in enumerate(self.channels):
+            struct.pack_into("16s", header, _FIXED.size + i * NAME_SIZE, channel.encode()[:NAME_SIZE])
+        self._file = open(path, "wb")
+        self._file.write(header)
+        self.path = path
+        self._first = t
+        self._last = t
+        self._rotate_at = (math.floor(t / self.rotate_seconds) + 1) * self.rotate_seconds
+        self._file_rows = 0
+        self._unflushed = 0
+        self.files += 1
+        self.expire(t)
+
+    def expire(self, now):
+        """
+        Delete the oldest files, other than the current one, while the
+        archive is over max_bytes, or their last row is older than max_age_s.
+        """
+        if self.max_bytes is None and self.max_age_s is None:
+            return
+        paths = [path for path in files(self.directory) if path != self.path]
+        sizes = dict((path, os.path.getsize(path)) for path in paths)
+        total = sum(sizes.values()) + (os.path.getsize(self.path) if self.path else 0)
+        for path in paths:
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not too_big and self.max_age_s is not None:
+                try:
+                    too_old = read_header(path)["last_time"] < now - self.max_age_s
+                except ValueError:
+                    # Not ours to delete
+                    continue
+            else:
+                too_old = False
+            if not (too_big or too_old):
+                break
+            os.remove(path)
+            total -= sizes[path]
+            self.expired += 1
+
+    def append(self, t, values):
+        """
+        Append a row.
+
+            :param t: The time.time() of the samples
+            :param values: One value per channel, NaN for none
+        """
+        if self._file is None:
+            self._open(t)
+        elif self._file_rows >= self.rotate_rows or t >= self._rotate_at:
+            self.close()
+            self._open(t)
+        self._file.write(self.row.pack(t, *values))
+        self._last = t
+        self._file_rows += 1
+        self.rows += 1
+        self._unflushed += 1
+        if self._unflushed >= self.flush_rows:
+            self.flush()
+
+    def record(self, t, samples):
+        """
+        Add the samples of a sensor read to the pending row, first writing
+        it if it already has a value for one of their channels.
+
+            :param t: The time.time() of the read
+            :param samples: A sequence of (channel, value)
+        """
+        row = self._pending
+        if row is not None and any(not math.isnan(row[self._index[name]]) for name, val in samples):
+            self.append(self._pending_time, row)
+            row = None
+        if row is None:
+            row = self._pending = [math.nan] * len(self.channels)
+            self._pending_time = t
+        for name, val in samples:
+            row[self._index[name]] = val
+
+    def flush(self):
+        """
+        Write the buffered rows, and the last timestamp in the header.
+        """
+        if self._file is None:
+            return
+        f = self._file
+        f.flush()
+        end = f.tell()
+        f.seek(_TIMES_OFFSET)
+        f.write(_TIMES.pack(self._first, self._last))
+        f.seek(end)
+        f.flush()
+        self._unflushed = 0
+
+    def close(self):
+        if self._pending is not None:
+            self.append(self._pending_time, self._pending)
+            self._pending = None
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+def read_header(path):
+    """
+    Return the header of an archive file as a dict with "channels",
+    "row_size", "header_size", "first_time", "last_time" and "rows".
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+        size = os.fstat(f.fileno()).st_size
+    (magic, version, nchan, row_size, header_size, reserved, first, last) = _FIXED.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError("{} is not an airq archive".format(path))
+    if version != VERSION:
+        raise ValueError("{} is archive version {}, not {}".format(path, version, VERSION))
+    channels = []
+    for i in range(nchan):
+        (name,) = struct.unpack_from("16s", header, _FIXED.size + i * NAME_SIZE)
+        channels.append(name.rstrip(b"\0").decode())
+    return {
+        "channels": channels,
+        "row_size": row_size,
+        "header_size": header_size,
+        "first_time": first,
+        "last_time": last,
+        "rows": (size - header_size) // row_size,
+    }
+
+def row_dtype(channels):
+    """
+    Return the NumPy structured dtype of an archive row.
+    """
+    import numpy
+    return numpy.dtype([("time", "<f8")] + [(c, "<f4") for c in channels])
+
+def open_file(path, header=None):
+    """
+    Memory map an archive file.
+
+        :return: A read only NumPy structured array, with a "time" field
+                 and a field per channel. No data is copied.
+    """
+    import numpy
+    if header is None:
+        header = read_header(path)
+    if not header["rows"]:
+        return numpy.zeros(0, dtype=row_dtype(header["channels"]))
+    return numpy.memmap(path, dtype=row_dtype(header["channels"]), mode="r",
+                        offset=header["header_size"], shape=(header["rows"],))
+
+def files(directory):
+    """
+    Return the archive files in a directory, oldest first.
+    """
+    names = sorted(n for n in os.listdir(directory) if n.endswith(SUFFIX))
+    return [os.path.join(directory, n) for n in names]
+
+def read(directory, start=None, end=None):
+    """
+    Return the rows with start <= time < end, as a list of structured
+    arrays, one per file. Only files whose time range overlaps are
+    opened, and the arrays are zero-copy slices of the memory maps.
+
+        :param start: The start time.time(), or None for the beginning
+        :param end: The end time.time(), or None for the end
+    """
+    start = -math.inf if start is None else start
+    end = math.inf if end is None else end
+    headers = [(read_header(path), path) for path in files(directory)]
+    headers.sort(key=lambda h: h[0]["first_time"])
+    retval = []
+    for header, path in headers:
+        if header["first_time"] >= end:
+            continue
+        rows = open_file(path, header)
+        if not len(rows) or rows["time"][-1] < start:
+            continue
+        times = rows["time"]
+        i = times.searchsorted(start, "left")
+        j = times.searchsorted(end, "left")
+        if j > i:
+            retval.append(rows[i:j])
+    return retval
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    channels = ("tvoc", "eco2", "pres", "tdry", "rh")
+    n = 30 * 24 * 60 * 30   # a month of 2 s samples
+    t0 = time.time() - 2 * n
+    writer = ArchiveWriter(directory, channels)
+    start = time.perf_counter()
+    for i in range(n):
+        writer.append(t0 + 2 * i, (i % 50, 400 + i % 50, 850.0, 20.0, 40.0))
+    writer.close()
+    print("Wrote {} rows to {} files in {:.1f} s".format(writer.rows, writer.files, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    blocks = read(directory)
+    total = sum(float(b["tvoc"].sum(dtype="f8")) for b in blocks)
+    print("Scanned {} rows in {:.3f} s, mean tvoc {:.2f}".format(
+        sum(len(b) for b in blocks), time.perf_counter() - start, total / n))
@@ -0,0 +1,174 @@
+"""
+An asyncio acquisition and upload pipeline.
+
+Report ticks are aligned to wall clock multiples of the interval. At each
+tick the reading is taken in an executor thread and put on a bounded queue,
+from which an uploader task sends it. Auxiliary values (e.g. wifi stats)
+are refreshed by their own task, and the latest ones are attached to each
+report. A slow reading, auxiliary refresh or upload never delays a tick.
+"""
+import asyncio
+import concurrent.futures
+import math
+import time
+
+import logutil
+
+log = logutil.get_logger("airq.pipeline")
+
+class Pipeline(object):
+    """
+        :param interval: The report interval, in seconds.
+        :param read: A blocking function returning the reading for a report,
+                     or None if there is nothing to report at this tick.
+        :param send: A blocking function send(t, reading, aux), where t is the
+                     tick's time.time() and aux the latest auxiliary values.
+        :param get_aux: Optional blocking function returning a dict of
+                        auxiliary values.
+        :param aux_interval: How often to call get_aux(), in seconds. The
+                             default is interval.
+        :param aux_timeout: How long to wait for get_aux() before carrying
+                            on with the previous values.
+        :param queue_size: The maximum number of readings waiting to be sent.
+                           When full, the oldest is dropped.
+    """
+    def __init__(self, interval, read, send, get_aux=None, aux_interval=None, aux_timeout=10.0, queue_size=16):
+        self.interval = interval
+        self.read = read
+        self.send = send
+        self.get_aux = get_aux
+        self.aux_interval = aux_interval if aux_interval else interval
+        self.aux_timeout = aux_timeout
+        self.queue_size = queue_size
+        self.aux = {}
+        # One thread each for reading, auxiliary and sending, so that
+        # none of them can hold up the others. A shared pool would let a
+        # slow send take the thread the next tick's read needs.
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.aux_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.send_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._tasks = set()
+
+        self.ticks = 0
+        self.skipped = 0          # ticks with nothing to report
+        self.sent = 0
+        self.dropped = 0          # readings dropped from a full queue
+        self.send_failures = 0
+        self.aux_failures = 0
+        self.late_ticks = 0       # ticks which woke more than 10% of an interval late
+        self.upload_latency = 0.0 # seconds from tick to send complete, for the latest report
+
+    @staticmethod
+    def next_boundary(now, interval):
+        """
+        Return the next wall clock multiple of interval after now.
+        """
+        return (math.floor(now / interval) + 1) * interval
+
+    async def _run_blocking(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def ticker(self, readings):
+        while True:
+            t = self.next_boundary(time.time(), self.interval)
+            await asyncio.sleep(t - time.time())
+            self.ticks += 1
+            if time.time() - t > 0.1 * self.interval:
+                self.late_ticks += 1
+            # Don't wait for the reading; the next tick must not be delayed
+            self._spawn(self.acquire(t, readings))
+
+    async def acquire(self, t, readings):
+        reading = await self._run_blocking(self.read_executor, self.read)
+        if reading is None:
+            self.skipped += 1
+            return
+        if readings.full():
+            readings.get_nowait()
+            self.dropped += 1
+        readings.put_nowait((t, reading))
+
+    async def aux_loop(self):
+        pending = None
+        while True:
+            # A call which timed out may still be running in its thread
+            if pending is None or pending.done():
+                pending = asyncio.ensure_future(self._run_blocking(self.aux_executor, self.get_aux))
+            try:
+                self.aux = await asyncio.wait_for(asyncio.shield(pending), self.aux_timeout)
+            except Exception as error:
+                self.aux_failures += 1
+                log.warning("aux_not_updated", error=repr(error))
+            await asyncio.sleep(self.next_boundary(time.time(), self.aux_interval) - time.time())
+
+    async def uploader(self, readings):
+        while True:
+            t, reading = await readings.get()
+            try:
+                await self._run_blocking(self.send_executor, self.send, t, reading, dict(self.aux))
+                self.sent += 1
+                self.upload_latency = time.time() - t
+            except Exception as error:
+                self.send_failures += 1
+                log.error("send_failed", error=repr(error))
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "late_ticks": self.late_ticks,
+            "skipped": self.skipped,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "send_failures": self.send_failures,
+            "aux_failures": self.aux_failures,
+            "upload_latency_s": self.upload_latency,
+        }
+
+    async def run_async(self):
+        readings = asyncio.Queue(maxsize=self.queue_size)
+        coros = [self.ticker(readings), self.uploader(readings)]
+        if self.get_aux:
+            coros.append(self.aux_loop())
+        await asyncio.gather(*coros)
+
+    def run(self):
+        """
+        Run the pipeline forever.
+        """
+        asyncio.run(self.run_async())
+
+    def shutdown(self):
+        """
+        Stop the executor threads, without waiting for calls in progress.
+        """
+        for executor in (self.read_executor, self.aux_executor, self.send_executor):
+            executor.shutdown(wait=False)
+
+if __name__ == '__main__':
+    import random
+
+    def read():
+        time.sleep(random.random())
+        return {"x": random.random()}
+
+    def slow_aux():
+        time.sleep(random.choice((0.1, 3.0)))
+        return {"sig_dbm": -70}
+
+    def send(t, reading, aux):
+        time.sleep(random.random() * 2)
+        print(time.strftime("%H:%M:%S", time.gmtime(t)), reading, aux)
+
+    pipe = Pipeline(1, read, send, get_aux=slow_aux, aux_timeout=0.5)
+    try:
+        asyncio.run(asyncio.wait_for(pipe.run_async(), 6))
+    except asyncio.TimeoutError:
+        pass
+    print(pipe.stats())
+    pipe.shutdown()
@@ -0,0 +1,95 @@
+"""
+A persistent cache of CCS811 baselines.
+
+The CCS811 works out its clean air baseline over hours of running, and
+starts again from scratch whenever it is powered up or reset. Saving the
+baseline register periodically, and writing it back once a restarted
+sensor has warmed up (20 minutes), lets it report meaningful TVOC and
+eCO2 within minutes rather than hours.
+
+The cache is a small JSON file, shared by all the sensors of a process,
+of the latest baseline of each sensor, keyed by the sensor's identity and
+drive mode (see airq.airq.ccs811_id()), with the time it was saved:
+
+    {"airq:0x5b:hw12:fw2000:mode1": {"baseline": 41253, "time": 1792290000.0}}
+
+A baseline older than max_age_s is not restored, since the sensor has
+probably drifted, or been moved, in the meantime.
+"""
+import json
+import os
+import threading
+
+# AMS recommend saving the baseline weekly once a sensor is run in, so a
+# week old one is still better than starting from scratch
+MAX_AGE_S = 7 * 86400
+
+class BaselineCache(object):
+    """
+        :param path: The JSON file
+        :param max_age_s: The age beyond which a baseline is not restored
+    """
+    def __init__(self, path, max_age_s=MAX_AGE_S):
+        self.path = path
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+        self.saves = 0
+        self.restores = 0
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # A corrupt file is replaced by the next save
+            return {}
+
+    def load(self, key, now):
+        """
+        Return the (baseline, age in seconds) saved for key, or None if
+        there is none, or it is too old.
+        """
+        with self._lock:
+            entry = self._read().get(key)
+        if entry is None:
+            return None
+        age = now - entry["time"]
+        # A negative age means the clock has gone back, e.g. a Pi without
+        # a real time clock booting before NTP sync, so the age is unknown
+        if not 0 <= age <= self.max_age_s:
+            return None
+        self.restores += 1
+        return (entry["baseline"], age)
+
+    def save(self, key, baseline, now):
+        """
+        Save the baseline for key. The file is replaced atomically, so a
+        power failure leaves the old or the new one.
+        """
+        with self._lock:
+            entries = self._read()
+            entries[key] = {"baseline": baseline, "time": now}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.saves += 1
+
+    def stats(self):
+        return {"saves": self.saves, "restores": self.restores}
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    # Print the cached baselines and their ages
+    cache = BaselineCache(sys.argv[1] if len(sys.argv) > 1 else "ccs811_baseline.json")
+    now = time.time()
+    for key, entry in sorted(cache._read().items()):
+        age = now - entry["time"]
+        print("{:38} 0x{:04x} {:8.1f} h{}".format(key, entry["baseline"], age / 3600,
+              "" if age <= cache.max_age_s else " (too old)"))
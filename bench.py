@@ -0,0 +1,252 @@
+"""
+Benchmarks of the sampling, statistics and reporting hot paths.
+
+The sensors are simulated (see simsensors.py), so the suite runs the same
+way on a Pi and on a development machine. Results are printed as JSON,
+with the host details, so that runs on different hosts and revisions can
+be compared:
+
+    python3 bench.py [--quick] [--only name] [--out results.json]
+    python3 bench.py --compare before.json after.json
+
+Each benchmark is timed with timeit, in several repeats of a calibrated
+number of calls; the best and median times per call are reported. The
+peak memory allocated by one call is measured separately, with
+tracemalloc, since tracing slows the calls down.
+"""
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+import tracemalloc
+
+import IQR
+import logutil
+
+# Window sizes, for the IQR filter and the airq sample windows
+SIZES = (10, 100, 1000, 10000, 100000)
+QUICK_SIZES = (10, 100, 1000)
+
+IWCONFIG_TEXT = """
+wlan0     IEEE 802.11  ESSID:"Kitchen"
+          Mode:Managed  Frequency:2.417 GHz  Access Point: 28:C6:8E:76:5B:70
+          Bit Rate=5.5 Mb/s   Tx-Power=31 dBm
+          Retry short limit:7   RTS thr:off   Fragment thr:off
+          Power Management:on
+          Link Quality=31/70  Signal level=-79 dBm
+          Rx invalid nwid:0  Rx invalid crypt:0  Rx invalid frag:0
+          Tx excessive retries:451  Invalid misc:0   Missed beacon:0
+
+lo        no wireless extensions.
+"""
+
+PROC_WIRELESS_TEXT = """Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+ face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+ wlan0: 0000   31.  -79.  -256        0      0      0    451      0        0
+"""
+
+def host_info():
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "numpy": IQR.numpy().__version__,
+    }
+
+def measure(name, func, repeat=5, **params):
+    """
+    Time func(), and measure the peak memory it allocates.
+
+        :return: A result dict
+    """
+    timer = timeit.Timer(func)
+    # Enough calls to take at least 0.2 s
+    number, t = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+
+    tracemalloc.start()
+    func()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "params": params,
+        "calls": number * repeat,
+        "best_s": min(times),
+        "median_s": statistics.median(times),
+        "ops_per_s": 1.0 / min(times),
+        "peak_bytes": peak,
+    }
+
+def sample_data(n, rng):
+    """
+    TVOC like samples, with 1% spikes.
+    """
+    return [rng.gauss(20.0, 2.0) if rng.random() > 0.01 else 32768.0 for i in range(n)]
+
+def bench_iqr(sizes, seed):
+    np = IQR.numpy()
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        data = sample_data(n, rng)
+        results.append(measure("iqr_filter", lambda: IQR.iqr_filter(data, 1.5), n=n))
+        if n >= IQR.NUMPY_MIN_WINDOW:
+            array = np.array(data)
+            results.append(measure("iqr_filter_array", lambda: IQR.iqr_filter_array(array, 1.5), n=n))
+    return results
+
+def make_airq(n, seed):
+    """
+    An airq on simulated sensors, with n samples in every window, and
+    its sampling thread stopped so it does not disturb the timings.
+    """
+    import airq
+    import simsensors
+    backend = simsensors.SimBackend(speed=1000.0, latency_s=0.0, seed=seed)
+    device = airq.airq(n_samples=dict.fromkeys(airq.airq.channels, n), backend=backend)
+    device.scheduler.stop()
+    # Let the task in progress finish
+    time.sleep(0.05)
+    # The thread used some random numbers; start the windows from a known state
+    backend.rng.seed(seed)
+    sources = backend.sources
+    t = backend.clock.time()
+    for i in range(n):
+        device.add_samples([(name, sources[name](t + i)) for name in airq.airq.channels])
+    return device
+
+def bench_airq(sizes, seed):
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        device = make_airq(n, seed + n)
+        values = sample_data(1000, rng)
+        it = iter(range(1 << 62))
+
+        def queue_add():
+            device.queue_add(device.tvoc_q, values[next(it) % 1000], "tvoc")
+
+        def queue_avg():
+            device.queue_avg(device.tvoc_q.values(), "tvoc")
+
+        # queue_add() changes the windows, so it is timed last
+        results.append(measure("airq.reading", device.reading, n=n))
+        results.append(measure("airq.queue_avg", queue_avg, n=n))
+        results.append(measure("airq.queue_add", queue_add, n=n))
+    return results
+
+def bench_iwconfig():
+    import iwconfig
+    return [
+        measure("iwconfig.iwconfig", lambda: iwconfig.iwconfig(IWCONFIG_TEXT)),
+        measure("iwconfig.proc_wireless", lambda: iwconfig.proc_wireless(PROC_WIRELESS_TEXT)),
+    ]
+
+def bench_chords(seed):
+    import airq
+    device = make_airq(100, seed)
+    reading = device.reading()
+    results = []
+    try:
+        import airqtochords
+        import pychords.tochords as tochords
+    except ImportError as error:
+        # The pychords submodule is not checked out
+        serialize = airq.Reading.serializer(airq.legacy_fields)
+        results.append(measure("reading.serialize", lambda: serialize(reading)))
+        results.append({"name": "make_chords_vars+buildURI", "skipped": str(error)})
+        return results
+
+    options = {"inst_id": "1", "skey": "secret_key", "test": False}
+
+    def report():
+        record = {"vars": airqtochords.make_chords_vars(reading)}
+        record.update(options)
+        return tochords.buildURI("chords_host.com", record)
+
+    results.append(measure("make_chords_vars", lambda: airqtochords.make_chords_vars(reading)))
+    results.append(measure("make_chords_vars+buildURI", report))
+    return results
+
+def run(quick=False, only=None, seed=1):
+    sizes = QUICK_SIZES if quick else SIZES
+    # Each suite has its own seed, so that it sees the same data when run alone
+    suites = (
+        ("iqr", lambda: bench_iqr(sizes, seed)),
+        ("airq", lambda: bench_airq(sizes, seed)),
+        ("iwconfig", bench_iwconfig),
+        ("chords", lambda: bench_chords(seed)),
+    )
+    start = time.perf_counter()
+    results = []
+    for name, suite in suites:
+        if only and name != only:
+            continue
+        print("Running", name, file=sys.stderr)
+        results.extend(suite())
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": host_info(),
+        "seed": seed,
+        "quick": quick,
+        "elapsed_s": time.perf_counter() - start,
+        "max_rss_kb": max_rss_kb(),
+        "results": results,
+    }
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def compare(before, after):
+    """
+    Print the change in best time and peak memory of each benchmark.
+    """
+    def key(r):
+        return (r["name"], json.dumps(r.get("params", {}), sort_keys=True))
+    old = dict((key(r), r) for r in before["results"] if "best_s" in r)
+    print("{:32} {:>16} {:>12} {:>12} {:>8} {:>10}".format(
+        "benchmark", "params", "before_us", "after_us", "ratio", "peak_kb"))
+    for r in after["results"]:
+        o = old.get(key(r))
+        if o is None or "best_s" not in r:
+            continue
+        print("{:32} {:>16} {:12.2f} {:12.2f} {:8.2f} {:10.1f}".format(
+            r["name"], " ".join("{}={}".format(k, v) for k, v in r["params"].items()),
+            o["best_s"] * 1e6, r["best_s"] * 1e6, r["best_s"] / o["best_s"], r["peak_bytes"] / 1024))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == "--compare":
+        if len(args) != 3:
+            print("Usage:", sys.argv[0], "--compare before.json after.json")
+            sys.exit(1)
+        compare(json.load(open(args[1])), json.load(open(args[2])))
+        sys.exit(0)
+
+    # Time the paths as deployed, with debug logging off; keep warnings out of the results
+    logutil.configure("WARNING", stream=sys.stderr)
+    quick = "--quick" in args
+    only = args[args.index("--only") + 1] if "--only" in args else None
+    out = args[args.index("--out") + 1] if "--out" in args else None
+
+    results = run(quick=quick, only=only)
+    text = json.dumps(results, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
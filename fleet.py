@@ -0,0 +1,115 @@
+"""
+Several airq sensor stacks, driven by one process.
+
+Each stack is a CCS811/BME280/TMP117 set on its own I2C bus, or on a
+channel of a TCA9548A multiplexer. The stacks share one sampling thread
+and scheduler, the statistics code (with NumPy, once loaded) and the
+caller's reporting pipeline, so that N stacks cost little more memory
+than one.
+
+    stacks = fleet.Fleet([
+        {"name": "kitchen", "bus": 1, "mux_channel": 0},
+        {"name": "garage", "bus": 1, "mux_channel": 1, "ccs811_n_samples": 60},
+    ])
+    for name, device in zip(stacks.names, stacks.devices):
+        print(name, device.reading())
+
+Each bus is an i2cbus.I2CBus, which runs the transactions of all its
+stacks in turn. For a stack behind a multiplexer, its channel is selected
+within the same transaction, and only when another channel was selected
+last, so that a stack never talks to another stack's sensors.
+"""
+import _thread
+import time
+
+import airq
+import i2cbus
+import metrics
+import sensorsched
+
+def open_bus(number):
+    """
+    Return a qwiic_i2c driver for /dev/i2c-<number>.
+    """
+    # qwiic_i2c.getI2CDriver() always returns the same driver, for the default bus
+    from qwiic_i2c import linux_i2c
+    return linux_i2c.LinuxI2C(iBus=number)
+
+class Fleet(object):
+    """
+    Sensor stacks sharing one scheduler thread.
+
+        :param stacks: A list of dicts, one per stack, of airq.airq keyword
+                       arguments plus:
+                         name - The stack name, used to label its metrics and
+                                log messages. Required, and unique.
+                         bus - The I2C bus number (default 1)
+                         mux_channel - The TCA9548A channel, if the stack is
+                                behind one
+                         mux_address - The TCA9548A address (default 0x70)
+        :param backend: Optional simulated sensors (simsensors.SimBackend),
+                        shared by all the stacks
+        :param registry: The metrics.Registry
+        :param open_bus: The function returning the driver for a bus number
+    """
+    def __init__(self, stacks, backend=None, registry=None, open_bus=open_bus):
+        self.clock = backend.clock if backend else time
+        self.scheduler = sensorsched.SensorScheduler(clock=self.clock.monotonic, sleep=self.clock.sleep)
+        self.buses = {}         # bus number -> i2cbus.I2CBus
+        self.names = []
+        self.devices = []
+        registry = registry if registry else metrics.REGISTRY
+
+        for stack in stacks:
+            kwargs = dict(stack)
+            name = kwargs.pop("name")
+            if name in self.names:
+                raise ValueError("Duplicate stack name: {}".format(name))
+            number = kwargs.pop("bus", 1)
+            channel = kwargs.pop("mux_channel", None)
+            mux_address = kwargs.pop("mux_address", i2cbus.MUX_ADDRESS)
+
+            bus = self.buses.get(number)
+            if bus is None:
+                driver = backend.i2c_bus(number) if backend else open_bus(number)
+                bus = self.buses[number] = i2cbus.I2CBus(driver, self.clock)
+                registry.register_stats("airq_i2c_bus", bus.stats, bus=number)
+            i2c_driver = bus.driver(mux_address, channel)
+
+            if backend:
+                kwargs["backend"] = backend.stack(i2c_driver=i2c_driver, bus=number,
+                                                  mux_address=mux_address, mux_channel=channel)
+            else:
+                kwargs["i2c_driver"] = i2c_driver
+            device = airq.airq(name=name, scheduler=self.scheduler, registry=registry, **kwargs)
+            self.names.append(name)
+            self.devices.append(device)
+
+        _thread.start_new_thread(self.scheduler.run, ())
+        # Sleep so that the measure thread can start
+        self.clock.sleep(1)
+
+    def readings(self):
+        """
+        Return a Reading from each stack, in order.
+        """
+        return [device.reading() for device in self.devices]
+
+if __name__ == '__main__':
+    import logutil
+    import simsensors
+
+    # Three simulated stacks: two behind a multiplexer on bus 1, one on bus 3
+    logutil.configure("INFO")
+    backend = simsensors.SimBackend(speed=60.0, seed=1)
+    stacks = Fleet([
+        {"name": "kitchen", "mux_channel": 0, "ccs811_n_samples": 60},
+        {"name": "lounge", "mux_channel": 1, "ccs811_n_samples": 60},
+        {"name": "garage", "bus": 3, "ccs811_n_samples": 60},
+    ], backend=backend)
+    for i in range(5):
+        backend.clock.sleep(60)
+        for name, reading in zip(stacks.names, stacks.readings()):
+            print(name, reading)
+    print(dict((n, b.stats()) for n, b in stacks.buses.items()))
+    print(list(stacks.scheduler.tasks.values()))
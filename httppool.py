@@ -0,0 +1,179 @@
+"""
+A keep-alive HTTP(S) connection pool, with TLS session resumption.
+"""
+import http.client
+import ssl
+import threading
+import time
+import urllib.parse
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    """
+    An HTTPSConnection which resumes the pool's last TLS session for its
+    host, so that reconnecting skips the full handshake.
+    """
+    def __init__(self, host, pool, timeout):
+        http.client.HTTPSConnection.__init__(self, host, timeout=timeout, context=pool.ssl_context)
+        self._pool = pool
+
+    def connect(self):
+        # Make the TCP connection, then wrap it ourselves to pass the session
+        http.client.HTTPConnection.connect(self)
+        session = self._pool._sessions.get(self.host)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+        self._pool._count_handshake(self.sock.session_reused)
+
+class ConnectionPool(object):
+    """
+    Reuse HTTP/1.1 keep-alive connections across requests.
+
+    Idle connections are kept per host, and at most max_per_host
+    connections to a host are open at once; further requests wait for
+    one to be released. A reused connection that the server has closed
+    is replaced and the request retried once.
+
+        :param max_per_host: The maximum connections per host
+        :param timeout: The socket timeout, in seconds
+        :param ssl_context: The ssl.SSLContext for https. The default
+                            verifies certificates.
+    """
+    def __init__(self, max_per_host=2, timeout=30.0, ssl_context=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.ssl_context = ssl_context if ssl_context else ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = {}         # (scheme, netloc) -> [connection]
+        self._limits = {}       # (scheme, netloc) -> BoundedSemaphore
+        self._sessions = {}     # host -> ssl.SSLSession
+
+        self.requests = 0
+        self.failures = 0
+        self.connections = 0    # connections opened
+        self.reused = 0         # requests sent on an already open connection
+        self.handshakes = 0     # TLS handshakes
+        self.resumed = 0        # TLS handshakes which resumed a session
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _count_handshake(self, resumed):
+        with self._lock:
+            self.handshakes += 1
+            if resumed:
+                self.resumed += 1
+
+    def _limit(self, key):
+        with self._lock:
+            limit = self._limits.get(key)
+            if limit is None:
+                limit = self._limits[key] = threading.BoundedSemaphore(self.max_per_host)
+            return limit
+
+    def _get(self, key):
+        """
+        Return (connection, reused).
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+            self.connections += 1
+        return (self._new(key), False)
+
+    def _new(self, key):
+        scheme, netloc = key
+        if scheme == "https":
+            return _PooledHTTPSConnection(netloc, self, self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _save_session(self, conn):
+        if isinstance(conn, _PooledHTTPSConnection) and conn.sock is not None:
+            # TLS 1.3 session tickets arrive after the handshake, so save it
+            # once a response has been read
+            self._sessions[conn.host] = conn.sock.session
+
+    def _put(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, method, uri, body=None, headers=None):
+        """
+        Make a request.
+
+            :return: (status, reason, response body)
+            :raises: OSError or http.client.HTTPException on failure
+        """
+        parts = urllib.parse.urlsplit(uri)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        headers = headers if headers else {}
+
+        start = time.perf_counter()
+        limit = self._limit(key)
+        limit.acquire()
+        try:
+            conn, reused = self._get(key)
+            try:
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection; try a new one
+                    conn.close()
+                    with self._lock:
+                        self.connections += 1
+                    conn, reused = self._new(key), False
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                data = response.read()
+            except Exception:
+                conn.close()
+                with self._lock:
+                    self.failures += 1
+                raise
+            self._save_session(conn)
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+        finally:
+            limit.release()
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+        return (response.status, response.reason, data)
+
+    def get(self, uri):
+        return self.request("GET", uri)
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        n = self.requests
+        return {
+            "requests": n,
+            "failures": self.failures,
+            "connections": self.connections,
+            "reused": self.reused,
+            "reuse_ratio": self.reused / n if n else 0.0,
+            "tls_handshakes": self.handshakes,
+            "tls_resumed": self.resumed,
+            "latency_mean_s": self.latency_total / n if n else 0.0,
+            "latency_max_s": self.latency_max,
+        }
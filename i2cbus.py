@@ -0,0 +1,331 @@
+"""
+Coordinated access to an I2C bus shared by several sensors.
+
+The sensors are clock stretched onto a slow bus, so a transaction which
+fails or waits holds up everything else on it. I2CBus runs each
+transaction in turn under the bus lock (threads wanting the bus queue on
+it), and keeps the accounting needed to size the sampling rates to the
+bus: the time it is busy, the time spent waiting for it, and the errors
+and retries.
+
+Each sensor driver is given a BusDriver, which has the interface of a
+qwiic_i2c driver, so that the Qwiic drivers run on it unchanged:
+
+    bus = i2cbus.I2CBus(qwiic_i2c.getI2CDriver())
+    driver = bus.driver()
+    driver.set_policy(0x5b, i2cbus.RetryPolicy(backoff_s=10.0))
+    ccs811 = qwiic_ccs811.QwiicCcs811(address=0x5b, i2c_driver=driver)
+
+A failed transaction is retried according to the device's RetryPolicy,
+releasing the bus between attempts. When the retries are used up, the
+device is backed off: its transactions fail at once, without touching
+the bus, until the back off (which doubles with each consecutive failure)
+expires. Other devices carry on meanwhile. The BusError raised says how
+long the device is backed off for.
+
+Reads of neighbouring registers, which the drivers make one at a time,
+can be merged into one block read with prefetch():
+
+    with driver.prefetch(0x77, 0xf7, 8):
+        rh = bme280.humidity        # served from the block read
+        pres = bme280.pressure
+
+A BusDriver can also select a TCA9548A multiplexer channel before each
+transaction, when another one was selected last, so that several stacks
+with the same sensor addresses can share a bus (see fleet.py).
+"""
+import contextlib
+import errno
+import threading
+import time
+
+# The default TCA9548A address
+MUX_ADDRESS = 0x70
+
+class BusError(OSError):
+    """
+    An I2C transaction failed after its retries, or was not attempted
+    because the device is backed off.
+
+        :param backoff_s: How long the device is backed off for
+    """
+    def __init__(self, code, message, address, backoff_s):
+        OSError.__init__(self, code, message)
+        self.address = address
+        self.backoff_s = backoff_s
+
+    def __str__(self):
+        return "{} (device 0x{:02x}, backed off for {:.3g} s)".format(
+            OSError.__str__(self), self.address, self.backoff_s)
+
+class RetryPolicy(object):
+    """
+    How a device's failed transactions are retried, and then backed off.
+
+        :param retries: Immediate retries of a failed transaction
+        :param retry_delay_s: The wait before each retry, with the bus released
+        :param backoff_s: The back off after the retries fail
+        :param max_backoff_s: The limit of the back off, which doubles with
+                              each consecutive failure
+    """
+    __slots__ = ("retries", "retry_delay_s", "backoff_s", "max_backoff_s")
+
+    def __init__(self, retries=1, retry_delay_s=0.002, backoff_s=1.0, max_backoff_s=60.0):
+        self.retries = retries
+        self.retry_delay_s = retry_delay_s
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+
+    def backoff(self, failures):
+        return min(self.backoff_s * 2 ** (failures - 1), self.max_backoff_s)
+
+DEFAULT_POLICY = RetryPolicy()
+
+class _Device(object):
+    """
+    The retry state and statistics of one device.
+    """
+    __slots__ = ("address", "policy", "failures", "until", "transactions", "errors",
+                 "retries", "backoffs", "refused", "prefetched")
+
+    def __init__(self, address, policy):
+        self.address = address
+        self.policy = policy
+        self.failures = 0       # consecutive failed transactions
+        self.until = 0.0        # the clock.monotonic() when the back off ends
+        self.transactions = 0
+        self.errors = 0
+        self.retries = 0
+        self.backoffs = 0
+        self.refused = 0        # transactions failed while backed off
+        self.prefetched = 0     # reads served from a prefetched block
+
+    def stats(self):
+        return {
+            "transactions": self.transactions,
+            "errors": self.errors,
+            "retries": self.retries,
+            "backoffs": self.backoffs,
+            "refused": self.refused,
+            "prefetched": self.prefetched,
+        }
+
+class I2CBus(object):
+    """
+    An I2C bus, shared by the drivers returned by driver().
+
+        :param driver: The qwiic_i2c driver for the bus
+        :param clock: The clock to time back offs with, and sleep on (the
+                      time module, or a simulated clock)
+    """
+    def __init__(self, driver, clock=time):
+        self.bus_driver = driver
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.selected = None    # the (mux address, channel) last selected
+        self.transactions = 0
+        self.errors = 0
+        self.selects = 0
+        self.busy_s = 0.0       # time spent in transactions
+        self.wait_s = 0.0       # time spent waiting for the bus
+        self._start = time.perf_counter()
+
+    def driver(self, mux_address=MUX_ADDRESS, channel=None):
+        """
+        Return a BusDriver for sensors on the bus, or on a multiplexer channel.
+        """
+        return BusDriver(self, mux_address, channel)
+
+    def _select(self, mux_address, channel):
+        # Called with the lock held
+        if self.selected != (mux_address, channel):
+            # Unknown until the write succeeds
+            self.selected = None
+            self.bus_driver.writeCommand(mux_address, 1 << channel)
+            self.selected = (mux_address, channel)
+            self.selects += 1
+
+    def _transact(self, mux_address, channel, method, args):
+        """
+        Run one transaction under the lock, selecting the channel first.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            locked = time.perf_counter()
+            self.wait_s += locked - start
+            self.transactions += 1
+            try:
+                if channel is not None:
+                    self._select(mux_address, channel)
+                return getattr(self.bus_driver, method)(*args)
+            except OSError:
+                self.errors += 1
+                raise
+            finally:
+                self.busy_s += time.perf_counter() - locked
+
+    def call(self, device, mux_address, channel, method, args):
+        """
+        Run a transaction with a device, retrying and backing off
+        according to its policy.
+        """
+        now = self.clock.monotonic()
+        if device.until > now:
+            device.refused += 1
+            raise BusError(errno.EAGAIN, "Device backed off", device.address, device.until - now)
+        policy = device.policy
+        attempt = 0
+        while True:
+            device.transactions += 1
+            try:
+                result = self._transact(mux_address, channel, method, args)
+            except OSError as error:
+                device.errors += 1
+                if attempt < policy.retries:
+                    attempt += 1
+                    device.retries += 1
+                    self.clock.sleep(policy.retry_delay_s)
+                    continue
+                device.failures += 1
+                device.backoffs += 1
+                backoff = policy.backoff(device.failures)
+                device.until = self.clock.monotonic() + backoff
+                raise BusError(error.errno or errno.EIO, error.strerror or str(error),
+                               device.address, backoff) from error
+            device.failures = 0
+            return result
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._start
+        return {
+            "transactions": self.transactions,
+            "errors": self.errors,
+            "selects": self.selects,
+            "busy_s": self.busy_s,
+            "wait_s": self.wait_s,
+            "utilisation": self.busy_s / elapsed if elapsed > 0 else 0.0,
+        }
+
+def _bus_method(method):
+    def call(self, address, *args):
+        return self.bus.call(self._device(address), self.mux_address, self.channel, method, (address,) + args)
+    call.__name__ = method
+    return call
+
+class BusDriver(object):
+    """
+    A qwiic_i2c driver which runs its transactions on an I2CBus. Use
+    I2CBus.driver() to create one. Other attributes are passed through to
+    the bus's qwiic_i2c driver.
+    """
+    def __init__(self, bus, mux_address=MUX_ADDRESS, channel=None):
+        self.bus = bus
+        self.mux_address = mux_address
+        self.channel = channel
+        self.devices = {}       # address -> _Device
+        self._prefetch = {}     # address -> (first register, data)
+
+    def __getattr__(self, name):
+        return getattr(self.bus.bus_driver, name)
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            device = self.devices[address] = _Device(address, DEFAULT_POLICY)
+        return device
+
+    def set_policy(self, address, policy):
+        """
+        Set the RetryPolicy of the device at address.
+        """
+        self._device(address).policy = policy
+
+    def backoff_remaining(self, address):
+        """
+        Return how long the device at address is still backed off for.
+        """
+        return max(self._device(address).until - self.bus.clock.monotonic(), 0.0)
+
+    @contextlib.contextmanager
+    def prefetch(self, address, register, n):
+        """
+        Read n registers from register in one block read, and serve the
+        reads of any of them from it until the with block exits.
+        """
+        data = self.bus.call(self._device(address), self.mux_address, self.channel,
+                             "readBlock", (address, register, n))
+        self._prefetch[address] = (register, data)
+        try:
+            yield data
+        finally:
+            self._prefetch.pop(address, None)
+
+    def _prefetched(self, address, register, n):
+        block = self._prefetch.get(address)
+        if block is None:
+            return None
+        first, data = block
+        offset = register - first
+        if offset < 0 or offset + n > len(data):
+            return None
+        self._device(address).prefetched += 1
+        return data[offset:offset + n]
+
+    def readByte(self, address, commandCode):
+        data = self._prefetched(address, commandCode, 1)
+        if data is not None:
+            return data[0]
+        return self.bus.call(self._device(address), self.mux_address, self.channel,
+                             "readByte", (address, commandCode))
+
+    def readWord(self, address, commandCode):
+        data = self._prefetched(address, commandCode, 2)
+        if data is not None:
+            # SMBus words are little endian
+            return data[0] | (data[1] << 8)
+        return self.bus.call(self._device(address), self.mux_address, self.channel,
+                             "readWord", (address, commandCode))
+
+    def readBlock(self, address, commandCode, nBytes):
+        data = self._prefetched(address, commandCode, nBytes)
+        if data is not None:
+            return data
+        return self.bus.call(self._device(address), self.mux_address, self.channel,
+                             "readBlock", (address, commandCode, nBytes))
+
+    def isDeviceConnected(self, devAddress):
+        # A probe, so not retried or backed off
+        return self.bus._transact(self.mux_address, self.channel, "isDeviceConnected", (devAddress,))
+
+    def stats(self):
+        return dict(("0x{:02x}".format(address), device.stats()) for address, device in self.devices.items())
+
+for _method in ("writeCommand", "writeByte", "writeWord", "writeBlock"):
+    setattr(BusDriver, _method, _bus_method(_method))
+
+if __name__ == '__main__':
+    import simsensors
+
+    # A TMP117 and a CCS811 on a simulated bus which drops 5% of transactions
+    backend = simsensors.SimBackend(speed=10.0, bus_error_rate=0.05, seed=1)
+    bus = I2CBus(backend.bus, backend.clock)
+    driver = bus.driver()
+    driver.set_policy(0x5b, RetryPolicy(retries=0, backoff_s=10.0))
+    (ccs811, bme280, tmp117) = backend.sensors(0x5b, 0x77, 0x48, i2c_driver=driver)
+    tmp117.begin()
+    ccs811.begin()
+    for i in range(100):
+        backend.clock.sleep(0.25)
+        for name, read in (("bme280", lambda: (bme280.humidity, bme280.pressure)),
+                           ("tmp117", lambda: tmp117.temperature_celsius),
+                           ("ccs811", ccs811.data_available)):
+            try:
+                if name == "bme280":
+                    with driver.prefetch(0x77, 0xf7, 8):
+                        read()
+                else:
+                    read()
+            except BusError as error:
+                print(name, error)
+    print(bus.stats())
+    print(driver.stats())
@@ -1,9 +1,29 @@
 """
-Access iwconfig command.
+Access iwconfig command, or the wireless statistics in /proc/net/wireless.
 """
+import array
+import fcntl
+import socket
+import struct
 import subprocess
 import re
 
+PROC_WIRELESS = "/proc/net/wireless"
+
+# The iwconfig token separators
+_SEPARATORS = re.compile('  *|,|=|:')
+
+# A /proc/net/wireless interface line:
+#  face | tus | link level noise | ...
+#  wlan0: 0000   31.  -79.  -256        0      0      0    451      0        0
+_WIRELESS_LINE = re.compile(r'\s*([^\s:]+):\s+[0-9a-fA-F]+\s+(-?\d+)\.?\s+(-?\d+)\.?\s+(-?\d+)\.?')
+
+# Wireless extensions ioctl to get the ESSID, from linux/wireless.h
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+# sizeof(struct iwreq): the interface name, and the 16 byte union iwreq_data
+_IWREQ_SIZE = 32
+
 def iwconfig(teststring=None):
     """
     Run iwconfig and return the wifi characteristics as a hash.
@@ -25,26 +45,19 @@ def iwconfig(teststring=None):
     if teststring:
         lines = teststring
     else:
-        lines = ''
         process = subprocess.Popen('/sbin/iwconfig', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while True:
-            line = process.stdout.read().decode('utf-8')
-            if line == '':
-                break
-            lines = lines + line
+        (stdout, stderr) = process.communicate()
+        lines = stdout.decode('utf-8')
 
     lines = lines.split("\n")
 
     retval = {}
 
-    # Create one long list of all of the tokens in the output
+    # Create one long list of all of the tokens in the output,
+    # breaking them apart using the separators, without empty tokens
     tokens = []
     for l in lines:
-        ll = l.strip()
-        # Break them apart using these separators:
-        tokens = tokens + re.split('  *|,|=|:', ll)
-    # Remove empty toekns
-    tokens.remove('')
+        tokens.extend(t for t in _SEPARATORS.split(l.strip()) if t)
 
     # Find "ESSID" followed by a value
     try:
@@ -67,6 +80,75 @@ def iwconfig(teststring=None):
 
     return retval
 
+def proc_wireless(teststring=None, interface=None):
+    """
+    Return the wifi link quality and signal level from /proc/net/wireless,
+    without running a subprocess.
+
+    /proc/net/wireless has this form:
+    Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+     face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+     wlan0: 0000   31.  -79.  -256        0      0      0    451      0        0
+
+    Parameters:
+    teststring - Text to parse instead of /proc/net/wireless
+    interface - The interface to report. The first one listed if None.
+
+    Returns: a hash with "interface", "link_quality", "sig_dbm" and "noise_dbm",
+    or an empty hash if there are no wireless interfaces.
+    """
+    if teststring is None:
+        with open(PROC_WIRELESS) as f:
+            teststring = f.read()
+
+    for line in teststring.split("\n")[2:]:
+        match = _WIRELESS_LINE.match(line)
+        if match and (interface is None or match.group(1) == interface):
+            return {
+                "interface": match.group(1),
+                "link_quality": match.group(2),
+                "sig_dbm": match.group(3),
+                "noise_dbm": match.group(4),
+            }
+    return {}
+
+def essid(interface):
+    """
+    Return the ESSID of an interface, using the SIOCGIWESSID ioctl.
+    """
+    buf = array.array('B', bytes(IW_ESSID_MAX_SIZE + 1))
+    addr, length = buf.buffer_info()
+    request = struct.pack("16sPHH", interface.encode(), addr, length, 0).ljust(_IWREQ_SIZE, b'\0')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        result = fcntl.ioctl(sock.fileno(), SIOCGIWESSID, request)
+    length = struct.unpack_from("16sPHH", result)[2]
+    return buf.tobytes()[:length].decode('utf-8', 'replace')
+
+def wifi(interface=None):
+    """
+    Return the wifi characteristics as a hash, with the same keys as iwconfig().
+    /proc/net/wireless and an ioctl are used if possible, and iwconfig only
+    if /proc/net/wireless is unavailable. The hash is empty if there is no
+    wireless interface, e.g. wifi is down or the unit is wired, or neither
+    source is available.
+    """
+    try:
+        retval = proc_wireless(interface=interface)
+    except OSError:
+        try:
+            return iwconfig()
+        except OSError:
+            # No /sbin/iwconfig either
+            return {}
+    if not retval:
+        return retval
+    try:
+        retval["ssid"] = essid(retval["interface"])
+    except OSError:
+        # Not associated, or no wireless extensions ioctl support
+        pass
+    return retval
+
 if __name__ == '__main__':
 
     test = """
@@ -82,4 +164,11 @@ if __name__ == '__main__':
     lo        no wireless extensions.
     """
 
-    print(iwconfig(test))
\ No newline at end of file
+    print(iwconfig(test))
+
+    test = """Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+ face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+ wlan0: 0000   31.  -79.  -256        0      0      0    451      0        0
+"""
+
+    print(proc_wireless(test))
@@ -0,0 +1,189 @@
+"""
+Structured, level filtered, rate limited logging.
+
+A message is an event name with key=value fields, so that journald
+entries can be grepped and parsed:
+
+    log = logutil.get_logger("airq")
+    log.warning("ccs811_io_error", error=error, backoff_s=10.0)
+
+    WARNING airq ccs811_io_error error="[Errno 121] Remote I/O error" backoff_s=10.0
+
+Each event is rate limited with a token bucket, so a fault which repeats
+every second does not flood the journal or wear the SD card. The next
+message emitted for an event reports how many were suppressed, and every
+event is counted (see counts()), whether it was emitted or not.
+
+A call below the configured level returns after a single level check,
+before any fields are formatted.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+
+# The default token bucket for each event: burst messages, refilled at rate per second
+RATE = 1.0 / 60
+BURST = 5
+
+_counts = {}            # "logger_event" -> number of calls, emitted or not
+_counts_lock = threading.Lock()
+
+def counts():
+    """
+    Return the number of times each event has been logged (at an enabled
+    level), keyed by logger and event name, e.g. "sensors_ccs811_io_error"
+    for the airq.sensors logger. It can be exported with
+    metrics.Registry.register_stats().
+    """
+    with _counts_lock:
+        return dict(_counts)
+
+class StructuredLogger(object):
+    """
+    A logger of events with fields, rate limited per event.
+
+        :param name: The logging.Logger name
+        :param rate: Messages per second allowed for an event, after the burst
+        :param burst: Messages allowed for an event before limiting starts
+    """
+    __slots__ = ("logger", "name", "rate", "burst", "_prefix", "_buckets", "_lock")
+
+    def __init__(self, name, rate=RATE, burst=BURST):
+        self.logger = logging.getLogger(name)
+        self.name = name
+        self._prefix = name.split(".", 1)[-1].replace(".", "_") + "_"
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}      # (event, instance) -> [tokens, last refill, suppressed]
+        self._lock = threading.Lock()
+
+    def _allow(self, key):
+        """
+        Take a token from the bucket for key, an (event, instance) tuple.
+        Return the number of messages suppressed since the last one
+        allowed, or None if this one is suppressed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return None
+            bucket[0] -= 1.0
+            suppressed = bucket[2]
+            bucket[2] = 0
+            return suppressed
+
+    def enabled(self, level=logging.DEBUG):
+        """
+        Return True if messages at level are logged, to skip building
+        fields which are costly.
+        """
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, fields, limit=True):
+        if not self.logger.isEnabledFor(level):
+            return
+        key = self._prefix + event
+        with _counts_lock:
+            _counts[key] = _counts.get(key, 0) + 1
+        # Each sensor stack of a fleet has its own limit
+        suppressed = self._allow((event, fields.get("instance"))) if limit else 0
+        if suppressed is None:
+            return
+        if suppressed:
+            fields["suppressed"] = suppressed
+        self.logger.log(level, event, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, fields)
+
+    def always(self, level, event, **fields):
+        """
+        Log without rate limiting, e.g. for start up messages.
+        """
+        self.log(level, event, fields, limit=False)
+
+def get_logger(name, rate=RATE, burst=BURST):
+    return StructuredLogger(name, rate, burst)
+
+def _format_field(value):
+    if isinstance(value, float):
+        return "{:.6g}".format(value)
+    if isinstance(value, (int, bool)) or value is None:
+        return str(value)
+    text = str(value)
+    if not text or any(c in text for c in ' "='):
+        return json.dumps(text)
+    return text
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format records as "LEVEL logger event key=value ...", or as one JSON
+    object per line.
+
+        :param as_json: Write JSON lines
+        :param timestamps: Start each line with the UTC time. journald
+                           adds its own, so the default is not to.
+    """
+    def __init__(self, as_json=False, timestamps=False):
+        logging.Formatter.__init__(self)
+        self.as_json = as_json
+        self.timestamps = timestamps
+
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        if self.as_json:
+            entry = {"level": record.levelname, "logger": record.name, "event": record.getMessage()}
+            if self.timestamps:
+                entry["time"] = record.created
+            entry.update((k, v if isinstance(v, (int, float, bool, type(None))) else str(v))
+                         for k, v in fields.items())
+            return json.dumps(entry)
+        parts = [record.levelname, record.name, record.getMessage()]
+        parts.extend("{}={}".format(k, _format_field(v)) for k, v in fields.items())
+        if self.timestamps:
+            parts.insert(0, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(record.created)))
+        return " ".join(parts)
+
+def configure(level="INFO", as_json=False, timestamps=False, stream=None):
+    """
+    Send the airq loggers to stream (stdout by default), at level and above.
+    """
+    root = logging.getLogger("airq")
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream if stream else sys.stdout)
+    handler.setFormatter(StructuredFormatter(as_json, timestamps))
+    root.addHandler(handler)
+    root.propagate = False
+    return root
+
+if __name__ == '__main__':
+    import timeit
+
+    configure("INFO")
+    log = get_logger("airq.demo", burst=3)
+    for i in range(10):
+        log.warning("bus_error", error=OSError(121, "Remote I/O error"), attempt=i)
+    log.always(logging.INFO, "started", argv=sys.argv)
+    n = 1000000
+    t = timeit.timeit(lambda: log.debug("sample", value=1.0), number=n)
+    print("Disabled debug call: {:.3f} us".format(t / n * 1e6))
+    print(counts())
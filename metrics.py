@@ -0,0 +1,280 @@
+"""
+A lightweight metrics registry, served in the Prometheus text format.
+
+Counters, gauges and histograms are plain Python objects; updating one is
+an attribute increment (plus a bisect for a histogram), with no locking,
+so they can be left on in the sampling path. Components which already
+keep statistics (e.g. outbox.Outbox.stats()) are registered as
+collectors, and are only read when the metrics are scraped.
+
+    registry = metrics.REGISTRY
+    reads = registry.counter("airq_reads_total", "Sensor reads", sensor="tmp117")
+    reads.inc()
+    registry.register_stats("airq_outbox", box.stats)
+    registry.serve(9101)      # http://127.0.0.1:9101/metrics
+"""
+import bisect
+import http.server
+import math
+import threading
+import time
+
+# Latency buckets, in seconds, for I2C transactions and sensor reads
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+class Counter(object):
+    """
+    A monotonically increasing count.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge(object):
+    """
+    A value which can go up and down.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Histogram(object):
+    """
+    Counts of observations in cumulative buckets, with their sum.
+
+        :param buckets: The ascending bucket upper bounds
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        retval = []
+        total = 0
+        for bound, n in zip(self.buckets + (math.inf,), self.counts):
+            total += n
+            retval.append((name + "_bucket", labels + (("le", _format_value(float(bound))),), total))
+        retval.append((name + "_sum", labels, self.sum))
+        retval.append((name + "_count", labels, self.count))
+        return retval
+
+class Registry(object):
+    """
+    A set of metrics, and the collectors which are read at each scrape.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}     # name -> [type, help, {labels: metric}]
+        self._collectors = []   # (prefix, func, labels)
+        self._server = None
+
+    def _get(self, kind, cls, name, help, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = [kind, help, {}]
+            elif family[0] != kind:
+                raise ValueError("Metric {} is a {}, not a {}".format(name, family[0], kind))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*args)
+            return metric
+
+    def counter(self, name, help="", **labels):
+        """
+        Return the Counter with this name and labels, creating it if needed.
+        """
+        return self._get("counter", Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self._get("gauge", Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get("histogram", Histogram, name, help, labels, buckets)
+
+    def register_stats(self, prefix, func, **labels):
+        """
+        Export a stats function as gauges. func() returns a dict of numbers,
+        each of which becomes the gauge prefix_key; nested dicts are
+        flattened, and other values are ignored.
+        """
+        with self._lock:
+            self._collectors.append((prefix, func, tuple(sorted(labels.items()))))
+
+    def unregister_stats(self, prefix):
+        with self._lock:
+            self._collectors = [c for c in self._collectors if c[0] != prefix]
+
+    def _collect(self, prefix, stats, labels, out):
+        for key, value in stats.items():
+            name = prefix + "_" + key
+            if isinstance(value, dict):
+                self._collect(name, value, labels, out)
+            elif isinstance(value, (int, float)):
+                out.append((name, labels, value))
+
+    def exposition(self):
+        """
+        Return all the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            families = [(name, f[0], f[1], list(f[2].items())) for name, f in sorted(self._families.items())]
+            collectors = list(self._collectors)
+        lines = []
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    lines.append(sample_name + _format_labels(sample_labels) + " " + _format_value(value))
+        # Collected gauges, grouped by name so that each has one TYPE line
+        collected = {}
+        for prefix, func, labels in collectors:
+            samples = []
+            try:
+                self._collect(prefix, func(), labels, samples)
+            except Exception as error:
+                lines.append("# {} failed: {!r}".format(prefix, error))
+                continue
+            for sample_name, sample_labels, value in samples:
+                collected.setdefault(sample_name, []).append((sample_labels, value))
+        for name, samples in sorted(collected.items()):
+            lines.append("# TYPE {} gauge".format(name))
+            for sample_labels, value in samples:
+                lines.append(name + _format_labels(sample_labels) + " " + _format_value(value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics at http://host:port/metrics, from a daemon thread.
+        Only the local host can connect, by default.
+
+            :return: The http.server.HTTPServer
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        self._server = server
+        return server
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# The registry used unless another one is given
+REGISTRY = Registry()
+
+# The qwiic_i2c driver methods which make a bus transaction
+I2C_METHODS = ("readByte", "readWord", "readBlock", "writeCommand", "writeByte", "writeWord", "writeBlock")
+
+def _timed(method):
+    def call(self, *args):
+        start = time.perf_counter()
+        try:
+            return getattr(self._driver, method)(*args)
+        except OSError:
+            self._errors.inc()
+            raise
+        finally:
+            self._latency.observe(time.perf_counter() - start)
+    call.__name__ = method
+    return call
+
+class InstrumentedI2C(object):
+    """
+    Wrap a qwiic_i2c driver, to count and time the transactions of one
+    sensor. Other attributes are passed through to the driver.
+
+        :param driver: The driver to wrap
+        :param registry: The Registry
+        :param labels: The labels of the metrics, e.g. sensor="tmp117"
+    """
+    def __init__(self, driver, registry=REGISTRY, **labels):
+        self._driver = driver
+        self._latency = registry.histogram("airq_i2c_seconds", "I2C transaction latency", **labels)
+        self._errors = registry.counter("airq_i2c_errors_total", "I2C transactions which failed", **labels)
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+for _method in I2C_METHODS:
+    setattr(InstrumentedI2C, _method, _timed(_method))
+
+if __name__ == '__main__':
+    import timeit
+    import urllib.request
+
+    registry = Registry()
+    counter = registry.counter("demo_total", "A counter", sensor="x")
+    hist = registry.histogram("demo_seconds", "A histogram", sensor="x")
+    n = 1000000
+    print("Counter.inc: {:.3f} us".format(timeit.timeit(counter.inc, number=n) / n * 1e6))
+    print("Histogram.observe: {:.3f} us".format(timeit.timeit(lambda: hist.observe(0.0003), number=n) / n * 1e6))
+    registry.register_stats("demo_stats", lambda: {"queued": 3, "pool": {"reused": 7}, "name": "x"})
+
+    server = registry.serve(0)
+    url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+    print(urllib.request.urlopen(url).read().decode())
+    registry.stop()
@@ -0,0 +1,204 @@
+"""
+A durable store-and-forward queue for CHORDS submissions.
+
+URIs are appended to an SQLite database in WAL mode, so that they survive
+service restarts and power loss, and are deleted once they have been sent.
+See uploader.BatchUploader for the sending side.
+"""
+import _thread
+import math
+import sqlite3
+import time
+
+class Outbox(object):
+    """
+    An on-disk FIFO of URIs waiting to be sent.
+
+    Appends are grouped into transactions, and each commit is one fsync,
+    so an SD card is not written for every record. A crash loses at most
+    the uncommitted appends: sync_every records or sync_interval seconds.
+
+    The queue is bounded by max_entries and max_bytes; when either is
+    exceeded the oldest entries are dropped. Sent entries are deleted,
+    and the freed pages are returned to the file system periodically.
+
+        :param path: The database file
+        :param max_entries: The maximum number of queued URIs
+        :param max_bytes: The maximum database size
+        :param sync_every: Commit after this many appends
+        :param sync_interval: Commit appends at least this often, in seconds
+    """
+    # Reclaim free pages and truncate the WAL after this many acknowledgements
+    COMPACT_EVERY = 1000
+
+    def __init__(self, path, max_entries=100000, max_bytes=50*1024*1024, sync_every=10, sync_interval=60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = _thread.allocate_lock()
+
+        # Transactions are managed explicitly
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # auto_vacuum must be set before the table is created
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Sync the WAL on every commit; commits are batched
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created REAL NOT NULL,"
+            " uri TEXT NOT NULL)")
+        self._page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        self._count = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._acked_since_compact = 0
+
+        self.appended = 0
+        self.acked = 0
+        self.dropped = 0
+        self.commits = 0
+
+    def __len__(self):
+        return self._count
+
+    def _begin(self):
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN")
+
+    def _commit(self):
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+            self.commits += 1
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def append(self, uri):
+        """
+        Queue a URI. It is durable after the next commit.
+        """
+        with self.lock:
+            self._begin()
+            self._db.execute("INSERT INTO outbox (created, uri) VALUES (?, ?)", (time.time(), uri))
+            self._count += 1
+            self.appended += 1
+            self._uncommitted += 1
+            self._enforce_limits()
+            if (self._uncommitted >= self.sync_every or
+                    time.monotonic() - self._last_commit >= self.sync_interval):
+                self._commit()
+
+    def flush(self):
+        """
+        Commit any pending appends.
+        """
+        with self.lock:
+            self._commit()
+
+    def peek(self, n=1):
+        """
+        Return up to n of the oldest entries, as a list of (id, uri).
+        They stay queued until ack() is called.
+        """
+        with self.lock:
+            return self._db.execute("SELECT id, uri FROM outbox ORDER BY id LIMIT ?", (n,)).fetchall()
+
+    def oldest_age(self):
+        """
+        Return how long the oldest entry has been queued, in seconds,
+        or None if the outbox is empty.
+        """
+        with self.lock:
+            row = self._db.execute("SELECT created FROM outbox ORDER BY id LIMIT 1").fetchone()
+        return time.time() - row[0] if row else None
+
+    def ack(self, ids):
+        """
+        Remove sent entries.
+
+            :param ids: The ids of the entries, from peek()
+        """
+        if not ids:
+            return
+        with self.lock:
+            self._begin()
+            deleted = self._db.executemany("DELETE FROM outbox WHERE id = ?", ((i,) for i in ids)).rowcount
+            self._count -= deleted
+            self.acked += deleted
+            self._acked_since_compact += deleted
+            self._commit()
+            if self._acked_since_compact >= self.COMPACT_EVERY:
+                self._compact()
+
+    def _size(self):
+        """
+        Return the size of the live data. Deleted entries leave free pages,
+        which the file keeps until _compact(), but which new entries reuse.
+        """
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        free_count = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_count) * self._page_size
+
+    def _enforce_limits(self):
+        """
+        Drop the oldest entries if the queue is over its limits.
+        Called with the lock held, in a transaction.
+        """
+        excess = self._count - self.max_entries
+        # Checking the size is cheap, but not free
+        if excess <= 0 and self.appended % 100 == 0 and self._count:
+            size = self._size()
+            if size > self.max_bytes:
+                # Drop as many entries as the excess holds, at the average size
+                excess = max(int(math.ceil((size - self.max_bytes) * self._count / size)), 1)
+        if excess > 0:
+            deleted = self._db.execute(
+                "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)",
+                (excess,)).rowcount
+            self._count -= deleted
+            self.dropped += deleted
+
+    def _compact(self):
+        """
+        Return free pages to the file system and truncate the WAL.
+        Called with the lock held, outside a transaction.
+        """
+        self._db.execute("PRAGMA incremental_vacuum")
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._acked_since_compact = 0
+
+    def stats(self):
+        return {
+            "queued": self._count,
+            "appended": self.appended,
+            "acked": self.acked,
+            "dropped": self.dropped,
+            "commits": self.commits,
+        }
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self._db.close()
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "outbox.db")
+    box = Outbox(path, max_entries=50)
+    for i in range(60):
+        box.append("http://example.com/measurements/url_create?n={}".format(i))
+    box.flush()
+    print("Queued", len(box), "oldest", box.peek(2))
+    box.close()
+
+    # Reopen, as after a restart
+    box = Outbox(path, max_entries=50)
+    entries = box.peek(5)
+    box.ack([entry_id for entry_id, uri in entries])
+    print("After restart and ack:", box.stats(), "size", os.path.getsize(path))
+    box.close()
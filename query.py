@@ -0,0 +1,362 @@
+"""
+Time range queries and downsampled rollups over the sample archive.
+
+A sparse index of the archive (the time of the first row of every block
+of BLOCK_ROWS rows, per file) lets a range query open only the files,
+and read only the blocks, which overlap it.
+
+Rollups hold the mean, median, min, max and count of each channel for
+every 1 minute, 1 hour and 1 day bucket. They are computed with
+vectorized NumPy operations, once per archive file: the rollups of a
+file which is no longer being written are saved beside it, as
+<file>.rollup.npz, and the current file's are recomputed only when it
+has grown. Optionally, outliers are removed from each bucket before it
+is summarized, with the same IQR limits as IQR.iqr_filter().
+"""
+import math
+import os
+
+import IQR
+import archive
+
+# Rollup bucket lengths, in seconds
+RESOLUTIONS = (60, 3600, 86400)
+
+# Rows per block of the sparse time index
+BLOCK_ROWS = 4096
+
+ROLLUP_SUFFIX = ".rollup.npz"
+
+def rollup_dtype():
+    np = IQR.numpy()
+    return np.dtype([("time", "<f8"), ("mean", "<f8"), ("median", "<f8"),
+                     ("min", "<f8"), ("max", "<f8"), ("count", "<i8")])
+
+def _groups(buckets):
+    """
+    Return the (starts, counts) of the runs of equal values in buckets.
+    """
+    np = IQR.numpy()
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(buckets)])
+    return (starts, counts)
+
+def _grouped_quantile(s, starts, counts, p):
+    """
+    The quantile of each group of the sorted values s, with the same
+    linear interpolation as IQR.quantile().
+    """
+    np = IQR.numpy()
+    pos = p * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts - 1)
+    return s[starts + lo] + (s[starts + hi] - s[starts + lo]) * (pos - lo)
+
+def aggregate(times, values, resolution, cutoff=None):
+    """
+    Summarize values into buckets of resolution seconds.
+
+        :param times: The ascending sample times
+        :param values: The sample values; NaNs are ignored
+        :param resolution: The bucket length, in seconds
+        :param cutoff: If given, values outside the IQR cutoff limits of
+                       their bucket are removed first (see IQR.iqr_limits())
+
+        :return: A structured array (see rollup_dtype()) with a row for each
+                 bucket which has values. "time" is the bucket start.
+    """
+    np = IQR.numpy()
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    buckets = np.floor(np.asarray(times)[valid] / resolution)
+    values = values[valid]
+    if not len(values):
+        return np.zeros(0, dtype=rollup_dtype())
+
+    # The times are ascending, so the buckets are already grouped;
+    # sort the values within each bucket for the order statistics.
+    order = np.lexsort((values, buckets))
+    buckets = buckets[order]
+    s = values[order]
+    starts, counts = _groups(buckets)
+
+    if cutoff is not None:
+        q25 = _grouped_quantile(s, starts, counts, 0.25)
+        q75 = _grouped_quantile(s, starts, counts, 0.75)
+        cut_off = (q75 - q25) * cutoff
+        keep = ((s >= np.repeat(q25 - cut_off, counts)) &
+                (s <= np.repeat(q75 + cut_off, counts)))
+        if not keep.all():
+            # Every bucket keeps its quartiles, so none become empty
+            buckets = buckets[keep]
+            s = s[keep]
+            starts, counts = _groups(buckets)
+
+    result = np.empty(len(starts), dtype=rollup_dtype())
+    result["time"] = buckets[starts] * resolution
+    result["count"] = counts
+    result["mean"] = np.add.reduceat(s, starts) / counts
+    result["median"] = _grouped_quantile(s, starts, counts, 0.5)
+    result["min"] = s[starts]
+    result["max"] = s[starts + counts - 1]
+    return result
+
+class _FileIndex(object):
+    """
+    The sparse time index of one archive file.
+    """
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.rows = 0
+        self.block_first = None     # time of the first row of each block
+        self.last_time = header["first_time"]
+        self.rollups = None         # (rows, {(channel, resolution): array}) of the live file
+        self.update(header)
+
+    def update(self, header):
+        """
+        Index the rows added since the last update.
+        """
+        np = IQR.numpy()
+        self.header = header
+        if header["rows"] == self.rows:
+            return
+        times = archive.open_file(self.path, header)["time"]
+        # Only the blocks from the last, partial one on need indexing
+        first_block = self.rows // BLOCK_ROWS
+        added = times[first_block * BLOCK_ROWS::BLOCK_ROWS]
+        if self.block_first is None:
+            self.block_first = np.array(added)
+        else:
+            self.block_first = np.concatenate((self.block_first[:first_block], added))
+        self.rows = header["rows"]
+        self.last_time = float(times[-1]) if self.rows else header["first_time"]
+
+    def row_range(self, rows, start, end):
+        """
+        Return the (i, j) row slice of start <= time < end, searching
+        only the blocks which overlap it.
+        """
+        block_first = self.block_first
+        b0 = max(int(block_first.searchsorted(start, "right")) - 1, 0)
+        b1 = int(block_first.searchsorted(end, "left"))
+        lo = b0 * BLOCK_ROWS
+        hi = min(b1 * BLOCK_ROWS, self.rows)
+        times = rows["time"][lo:hi]
+        return (lo + int(times.searchsorted(start, "left")), lo + int(times.searchsorted(end, "left")))
+
+class ArchiveQuery(object):
+    """
+    Query an archive directory written by archive.ArchiveWriter.
+
+        :param directory: The archive directory
+        :param cutoffs: Optional dict of IQR cutoff factors by channel, e.g.
+                        {"tvoc": 5.0}. Outliers in these channels are
+                        removed from each rollup bucket.
+    """
+    def __init__(self, directory, cutoffs=None):
+        self.directory = directory
+        self.cutoffs = dict(cutoffs) if cutoffs else {}
+        self._index = {}            # path -> _FileIndex, oldest first after refresh()
+
+        self.files_opened = 0       # files read by the latest query
+        self.rollups_computed = 0   # file rollups computed, rather than loaded
+
+    def refresh(self):
+        """
+        Pick up new archive files, and rows appended to the current one.
+        """
+        index = {}
+        for path in archive.files(self.directory):
+            header = archive.read_header(path)
+            entry = self._index.get(path)
+            if entry is None:
+                entry = _FileIndex(path, header)
+            else:
+                entry.update(header)
+            index[path] = entry
+        self._index = dict(sorted(index.items(), key=lambda e: e[1].header["first_time"]))
+
+    def channels(self):
+        for entry in self._index.values():
+            return list(entry.header["channels"])
+        return []
+
+    def _overlapping(self, start, end):
+        """
+        The index entries of files with rows in start <= time < end.
+        """
+        return [e for e in self._index.values()
+                if e.rows and e.header["first_time"] < end and e.last_time >= start]
+
+    def select(self, start=None, end=None, channels=None):
+        """
+        Return the raw samples with start <= time < end.
+
+            :param channels: The channels to return; all by default.
+
+            :return: A dict of ndarrays, with "time" and one per channel.
+        """
+        np = IQR.numpy()
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        channels = channels if channels else self.channels()
+        entries = self._overlapping(start, end)
+        self.files_opened = len(entries)
+        parts = []
+        for entry in entries:
+            rows = archive.open_file(entry.path, entry.header)
+            i, j = entry.row_range(rows, start, end)
+            if j > i:
+                parts.append(rows[i:j])
+        result = {}
+        for name in ["time"] + list(channels):
+            if parts:
+                result[name] = np.concatenate([p[name] for p in parts])
+            else:
+                result[name] = np.zeros(0)
+        return result
+
+    def filtered(self, channel, start=None, end=None, cutoff=None):
+        """
+        Return the (kept, removed) values of a channel with start <= time < end,
+        filtered with IQR.iqr_filter_array(). NaNs are dropped.
+        """
+        np = IQR.numpy()
+        values = self.select(start, end, [channel])[channel].astype(np.float64)
+        values = values[~np.isnan(values)]
+        if cutoff is None:
+            cutoff = self.cutoffs.get(channel)
+        if cutoff is None or not len(values):
+            return (values, values[:0])
+        return IQR.iqr_filter_array(values, cutoff)
+
+    def _file_rollups(self, entry, live):
+        """
+        Return {(channel, resolution): rollup} for an archive file.
+        """
+        np = IQR.numpy()
+        channels = entry.header["channels"]
+        cutoffs = np.array([self.cutoffs.get(c, math.nan) for c in channels], dtype=np.float64)
+        saved = entry.path + ROLLUP_SUFFIX
+        if live:
+            if entry.rollups is not None and entry.rollups[0] == entry.rows:
+                return entry.rollups[1]
+        elif os.path.exists(saved):
+            with np.load(saved) as f:
+                if f["rows"] == entry.rows and np.array_equal(f["cutoffs"], cutoffs, equal_nan=True):
+                    return dict(((c, r), f["{}_{}".format(c, r)]) for c in channels for r in RESOLUTIONS)
+
+        rows = archive.open_file(entry.path, entry.header)
+        rollups = {}
+        for i, channel in enumerate(channels):
+            cutoff = None if math.isnan(cutoffs[i]) else float(cutoffs[i])
+            for resolution in RESOLUTIONS:
+                rollups[(channel, resolution)] = aggregate(rows["time"], rows[channel], resolution, cutoff)
+        self.rollups_computed += 1
+
+        if live:
+            entry.rollups = (entry.rows, rollups)
+        else:
+            arrays = dict(("{}_{}".format(c, r), a) for (c, r), a in rollups.items())
+            tmp = saved + ".tmp.npz"
+            np.savez(tmp, rows=entry.rows, cutoffs=cutoffs, **arrays)
+            os.replace(tmp, saved)
+        return rollups
+
+    def rollup(self, channel, resolution, start=None, end=None):
+        """
+        Return the rollup of a channel for the buckets starting in
+        start <= time < end. Only whole buckets are summarized: a bucket
+        that starts before start is included in full.
+
+            :param resolution: One of RESOLUTIONS
+
+            :return: A structured array (see rollup_dtype()), in time order.
+        """
+        np = IQR.numpy()
+        if resolution not in RESOLUTIONS:
+            raise ValueError("resolution must be one of {}".format(RESOLUTIONS))
+        start = -math.inf if start is None else math.floor(start / resolution) * resolution
+        end = math.inf if end is None else end
+        entries = self._overlapping(start, end)
+        newest = list(self._index.values())[-1] if self._index else None
+        parts = []
+        for entry in entries:
+            r = self._file_rollups(entry, entry is newest)[(channel, resolution)]
+            i = r["time"].searchsorted(start, "left")
+            j = r["time"].searchsorted(end, "left")
+            parts.append(r[i:j])
+        self.files_opened = len(entries)
+        if not parts:
+            return np.zeros(0, dtype=rollup_dtype())
+        result = np.concatenate(parts)
+
+        # A bucket split between files (after a restart, say) has to be
+        # summarized again from the samples of both.
+        split = np.flatnonzero(result["time"][1:] == result["time"][:-1])
+        if len(split):
+            keep = np.ones(len(result), dtype=bool)
+            keep[split + 1] = False
+            for i in split:
+                t = result["time"][i]
+                samples = self.select(t, t + resolution, [channel])
+                merged = aggregate(samples["time"], samples[channel], resolution, self.cutoffs.get(channel))
+                result[i] = merged[0]
+            result = result[keep]
+        self.files_opened = len(entries)
+        return result
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    import time
+
+    if len(sys.argv) > 1:
+        # query.py directory [channel] [resolution] [hours]
+        directory = sys.argv[1]
+        channel = sys.argv[2] if len(sys.argv) > 2 else "tvoc"
+        resolution = int(sys.argv[3]) if len(sys.argv) > 3 else 3600
+        hours = float(sys.argv[4]) if len(sys.argv) > 4 else 7 * 24
+    else:
+        # A week of synthetic 2 s samples, with TVOC spikes and a restart
+        directory = tempfile.mkdtemp()
+        channel, resolution, hours = "tvoc", 3600, 7 * 24
+        np = IQR.numpy()
+        n = 7 * 24 * 1800
+        t = time.time() - 2 * n + 2 * np.arange(n)
+        tvoc = 20 + 10 * np.sin(t / 3600) + np.random.normal(0, 1, n)
+        tvoc[np.random.randint(0, n, n // 1000)] = 65000
+        nan = np.full(n, np.nan)
+        writer = archive.ArchiveWriter(directory, ("tvoc", "eco2", "pres", "tdry", "rh"))
+        for i in range(n):
+            if i == n // 2:
+                writer.close()
+                writer = archive.ArchiveWriter(directory, writer.channels)
+            writer.append(t[i], (tvoc[i], nan[i], 850.0, 20.0, 40.0))
+        writer.close()
+
+    query = ArchiveQuery(directory, cutoffs={"tvoc": 1.5, "eco2": 1.5})
+    start = time.perf_counter()
+    query.refresh()
+    print("Indexed {} files in {:.3f} s".format(len(query._index), time.perf_counter() - start))
+
+    end = time.time()
+    for attempt in ("computed", "saved"):
+        start = time.perf_counter()
+        result = query.rollup(channel, resolution, end - hours * 3600, end)
+        print("{} {} s rollups of {} over {} h, from {} files ({}) in {:.3f} s".format(
+            len(result), resolution, channel, hours, query.files_opened, attempt, time.perf_counter() - start))
+
+    for row in result[-5:]:
+        print("{}  median {:8.2f}  mean {:8.2f}  min {:8.2f}  max {:8.2f}  n {}".format(
+            time.strftime("%Y-%m-%d %H:%M", time.gmtime(row["time"])),
+            row["median"], row["mean"], row["min"], row["max"], row["count"]))
+
+    # The last hour, checked against IQR.iqr_filter()
+    t0 = math.floor(end / 3600) * 3600 - 3600
+    kept, removed = query.filtered(channel, t0, t0 + 3600, 1.5)
+    bucket = query.rollup(channel, 3600, t0, t0 + 1)
+    print("Last full hour: rollup n {} mean {:.4f}, iqr_filter n {} mean {:.4f}, {} outliers".format(
+        bucket["count"][0], bucket["mean"][0], len(kept), kept.mean(), len(removed)))
@@ -2,7 +2,19 @@
 from __future__ import print_function
 import math
 import time
-import qwiic_i2c
+import threading
+
+# qwiic_i2c is only needed if no i2c_driver is given, e.g. by a simulator
+try:
+    import qwiic_i2c
+except ImportError:
+    qwiic_i2c = None
+
+# The ALERT pin is only used if RPi.GPIO is available
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
 
 # Define the device name and I2C addresses. These are set in the class defintion
 # as class variables, making them avilable without having to create a class instance.
@@ -37,6 +49,8 @@ class QwiicTmp117(object):
                         If not provided, the default address is used.
         :param i2c_driver: An existing i2c driver object. If not provided
                         a driver object is created.
+        :param clock: An object with monotonic() and sleep() functions, used
+                        to wait for conversions. The default is the time module.
         :return: The TMP117 device object.
         :rtype: Object
     """
@@ -55,12 +69,20 @@ class QwiicTmp117(object):
     CONFIG_MODE_BIT    = 10
     CONFIG_CYCLE_BIT   = 7
     CONFIG_AVG_BIT     = 5
+    CONFIG_TNA_BIT     = 4
+    CONFIG_POL_BIT     = 3
+    CONFIG_DRALERT_BIT = 2
     CONFIG_RESET_BIT   = 1
 
     CONFIG_READY_MASK = 0b1  << CONFIG_READY_BIT
     CONFIG_MODE_MASK  = 0b11  << CONFIG_MODE_BIT
     CONFIG_CYCLE_MASK = 0b111 << CONFIG_CYCLE_BIT
     CONFIG_AVG_MASK   = 0b11  << CONFIG_AVG_BIT
+    CONFIG_POL_MASK     = 0b1 << CONFIG_POL_BIT
+    CONFIG_DRALERT_MASK = 0b1 << CONFIG_DRALERT_BIT
+    # The config bits that hold their written value. The alert, data ready
+    # and EEPROM busy flags are status, and soft reset self clears.
+    CONFIG_WRITABLE_MASK = 0b0000111111111100
 
     MODE_CONTINUOUS = 0b00 << CONFIG_MODE_BIT
     MODE_SHUTDOWN   = 0b01 << CONFIG_MODE_BIT
@@ -83,8 +105,30 @@ class QwiicTmp117(object):
     # degC / bit
     TEMP_RESOLUTION_DEGC = 7.8125e-3
 
+    # Conversion cycle time in seconds, indexed by [cycle][avg].
+    # See Table 7 in the TMP117 data sheet.
+    CYCLE_TIME_S = (
+        (0.0155, 0.125, 0.5, 1.0),
+        (0.125,  0.125, 0.5, 1.0),
+        (0.25,   0.25,  0.5, 1.0),
+        (0.5,    0.5,   0.5, 1.0),
+        (1.0,    1.0,   1.0, 1.0),
+        (4.0,    4.0,   4.0, 4.0),
+        (8.0,    8.0,   8.0, 8.0),
+        (16.0,  16.0,  16.0, 16.0),
+    )
+
+    # How wait_ready() finds out that a conversion is complete
+    READY_POLL      = 0   # Poll the data ready bit
+    READY_SCHEDULED = 1   # Sleep until the conversion is due
+    READY_ALERT     = 2   # Wait for the ALERT pin, configured as data ready
+
+    # Poll interval and limit for READY_POLL, and for finding the conversion phase
+    POLL_INTERVAL_S = 0.05
+    POLL_LIMIT      = 20
+
     # Constructor
-    def __init__(self, address=None, i2c_driver=None):
+    def __init__(self, address=None, i2c_driver=None, clock=None):
 
         # Did the user specify an I2C address?
         self.address = self.available_addresses[0] if address is None else address
@@ -99,6 +143,24 @@ class QwiicTmp117(object):
         else:
             self._i2c = i2c_driver
 
+        self._clock = clock if clock else time
+
+        # Shadow copies of the writable register bits, by register
+        self._shadow = {}
+
+        self._ready_mode   = self.READY_POLL
+        self._cycle_s      = None   # conversion cycle time, for READY_SCHEDULED and READY_ALERT
+        self._next_ready   = None   # time.monotonic() when the next conversion is due
+        self._verify_every = 0
+        self._n_scheduled  = 0
+        self._alert_pin    = None
+        self._alert_event  = None
+        self._waiting_since = None  # time.monotonic() of the first ready_in() which found none ready
+
+        self.ready_polls    = 0   # data ready bit reads
+        self.ready_timeouts = 0   # wait_ready() calls which timed out
+        self.phase_searches = 0   # times the conversion phase was (re)found
+
     # ----------------------------------
     # is_connected()
     #
@@ -112,7 +174,7 @@ class QwiicTmp117(object):
             :rtype: bool
 
         """
-        return qwiic_i2c.isDeviceConnected(self.address)
+        return self._i2c.isDeviceConnected(self.address)
 
     connected = property(is_connected)
 
@@ -141,23 +203,84 @@ class QwiicTmp117(object):
             return False
 
         self.reset()
-        self.set_mode(self.MODE_CONTINUOUS)
-        self.set_cycle(self.CONV_CYCLE_4)
-        self.set_avg(self.CONV_AVG_8)
+        self.configure(self.MODE_CONTINUOUS, self.CONV_CYCLE_4, self.CONV_AVG_8)
 
         return True
 
     def get_reg(self, reg):
-      value = self._i2c.readWord(self.address, reg)
-      value = ((value & 0xff) << 8) | ((value >> 8) & 0xff)
+      # The registers are big endian; a block read gives the bytes in order,
+      # where an SMBus word read would need them swapping.
+      data = self._i2c.readBlock(self.address, reg, 2)
+      value = (data[0] << 8) | data[1]
       #print("Register {0} is: {1:016b}".format(reg, value))
       return value
 
-    def set_reg(self, reg, value):
+    def set_reg(self, reg, value, verify=False):
+      """
+      Write a register, and update its shadow copy.
+
+      :param verify: Read the register back, and compare the writable bits.
+
+      :return: False if verify was requested and the read back differs, otherwise True.
+      :rtype: bool
+      """
       #print("Writing register {0} with: {1:016b}".format(reg, value))
-      value = ((value & 0xff) << 8) | ((value >> 8) & 0xff)
-      self._i2c.writeWord(self.address, reg, value)
-      self.get_reg(reg)
+      self._i2c.writeBlock(self.address, reg, [(value >> 8) & 0xff, value & 0xff])
+      if reg == self.TMP117_CONFIG_REG:
+        self._shadow[reg] = value & self.CONFIG_WRITABLE_MASK
+      if verify:
+        readback = self.get_reg(reg)
+        if reg == self.TMP117_CONFIG_REG:
+          readback &= self.CONFIG_WRITABLE_MASK
+          value &= self.CONFIG_WRITABLE_MASK
+        if readback != value:
+          self._shadow.pop(reg, None)
+          return False
+      return True
+
+    def get_config(self):
+      """
+      Return the writable bits of the config register, from the shadow
+      copy if there is one, so that configuration costs no bus reads.
+      The status flags are not included; see is_ready().
+
+      :return: The config register value
+      :rtype: int
+      """
+      config = self._shadow.get(self.TMP117_CONFIG_REG)
+      if config is None:
+        config = self.get_reg(self.TMP117_CONFIG_REG) & self.CONFIG_WRITABLE_MASK
+        self._shadow[self.TMP117_CONFIG_REG] = config
+      return config
+
+    def invalidate_shadow(self):
+      """
+      Forget the shadow register copies, so the next access reads the device.
+      """
+      self._shadow.clear()
+
+    def configure(self, mode=None, cycle=None, avg=None, verify=False):
+        """
+        Set the mode, conversion cycle and averaging with a single register write.
+        Settings that are None are left unchanged.
+
+        :param mode: MODE_CONTINUOUS, MODE_SHUTDOWN or MODE_ONESHOT
+        :param cycle: One of the CONV_CYCLE_n values
+        :param avg: One of the CONV_AVG_n values
+        :param verify: Read the config register back to check the write
+
+        :return: False if the verify failed, otherwise True
+        :rtype: bool
+
+        """
+        config = self.get_config()
+        if mode is not None:
+            config = (config & ~self.CONFIG_MODE_MASK) | mode
+        if cycle is not None:
+            config = (config & ~self.CONFIG_CYCLE_MASK) | cycle
+        if avg is not None:
+            config = (config & ~self.CONFIG_AVG_MASK) | avg
+        return self.set_reg(self.TMP117_CONFIG_REG, config, verify)
 
     def set_mode(self, mode):
         """
@@ -176,7 +299,7 @@ class QwiicTmp117(object):
             mode = MODE_SHUTDOWN  # Error check. Default to shutdown mode
             print("Illegal TMP117 mode selected (", mode, "), device placed in shutdown mode.")
 
-        config = self.get_reg(self.TMP117_CONFIG_REG)
+        config = self.get_config()
         config &=  ~self.CONFIG_MODE_MASK
         config |=   mode
         self.set_reg(self.TMP117_CONFIG_REG, config)
@@ -189,7 +312,7 @@ class QwiicTmp117(object):
             :rtype: MODE_CONTINUOUS, MODE_SHUTDOWN, MODE_ONESHOT
 
         """
-        config = self.get_reg(self.TMP117_CONFIG_REG)
+        config = self.get_config()
         config = config & self.CONFIG_MODE_MASK
         return config
 
@@ -212,7 +335,7 @@ class QwiicTmp117(object):
         :return: No return value
 
         """
-        config = self.get_reg(self.TMP117_CONFIG_REG)
+        config = self.get_config()
         config &= ~self.CONFIG_CYCLE_MASK
         config |= cycleSetting
         self.set_reg(self.TMP117_CONFIG_REG, config)
@@ -225,7 +348,7 @@ class QwiicTmp117(object):
 
         """
 
-        cycle = self.get_reg(self.TMP117_CONFIG_REG)
+        cycle = self.get_config()
         cycle &= self.CONFIG_CYCLE_MASK
         return cycle
 
@@ -244,7 +367,7 @@ class QwiicTmp117(object):
         :return: No return value
 
         """
-        config = self.get_reg(self.TMP117_CONFIG_REG)
+        config = self.get_config()
         config &= ~ self.CONFIG_AVG_MASK
         config |= avgSetting
         self.set_reg(self.TMP117_CONFIG_REG, config)
@@ -256,7 +379,7 @@ class QwiicTmp117(object):
         :return: The avg value
         """
 
-        avg = self.get_reg(self.TMP117_CONFIG_REG)
+        avg = self.get_config()
         avg &= self.CONFIG_AVG_MASK
         return avg
 
@@ -272,9 +395,213 @@ class QwiicTmp117(object):
         :rvalue: boolean
         """
 
+        self.ready_polls += 1
         ready = self.get_reg(self.TMP117_CONFIG_REG)
+        # Refresh the shadow copy while we have the register
+        self._shadow[self.TMP117_CONFIG_REG] = ready & self.CONFIG_WRITABLE_MASK
         return  True if ready & self.CONFIG_READY_MASK else False
 
+    def conversion_time(self):
+        """
+        Return the conversion cycle time in seconds, for the current
+        conversion cycle and averaging settings.
+
+        :return: The time between conversions in continuous mode.
+        :rtype: float
+        """
+        config = self.get_config()
+        cycle = (config & self.CONFIG_CYCLE_MASK) >> self.CONFIG_CYCLE_BIT
+        avg = (config & self.CONFIG_AVG_MASK) >> self.CONFIG_AVG_BIT
+        return self.CYCLE_TIME_S[cycle][avg]
+
+    def set_ready_mode(self, mode, alert_pin=None, verify_every=16):
+        """
+        Choose how wait_ready() waits for a conversion. Call this after
+        the conversion cycle and averaging have been set.
+
+        :param mode: One of:
+            READY_POLL - Poll the data ready bit every POLL_INTERVAL_S. Each
+                poll is an I2C transaction.
+            READY_SCHEDULED - Find the conversion phase once, then sleep until
+                each conversion is due, calculated from the conversion cycle
+                time. Only the temperature read touches the bus.
+            READY_ALERT - Configure the ALERT pin as data ready, and wait for
+                its falling edge. Requires RPi.GPIO.
+        :param alert_pin: The BCM GPIO number wired to ALERT, for READY_ALERT.
+        :param verify_every: For READY_SCHEDULED, check the data ready bit every
+            this many conversions, and find the phase again if it has drifted.
+            Zero to never check.
+
+        :return: No return value
+
+        """
+        if self._alert_pin is not None:
+            GPIO.remove_event_detect(self._alert_pin)
+            self._alert_pin = None
+
+        if mode == self.READY_ALERT:
+            if GPIO is None:
+                raise RuntimeError("READY_ALERT requires the RPi.GPIO module")
+            if alert_pin is None:
+                raise ValueError("READY_ALERT requires an alert_pin")
+            # ALERT is open drain and active low, so pull it up
+            config = self.get_config()
+            config &= ~self.CONFIG_POL_MASK
+            config |= self.CONFIG_DRALERT_MASK
+            self.set_reg(self.TMP117_CONFIG_REG, config)
+            self._alert_event = threading.Event()
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(alert_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(alert_pin, GPIO.FALLING, callback=lambda channel: self._alert_event.set())
+            self._alert_pin = alert_pin
+
+        self._cycle_s = self.conversion_time() if mode != self.READY_POLL else None
+        self._next_ready = None
+        self._waiting_since = None
+        self._verify_every = verify_every
+        self._n_scheduled = 0
+        self._ready_mode = mode
+
+    def _find_phase(self, timeout):
+        """
+        Poll the data ready bit until a conversion completes.
+
+        :return: True if one did, False if timeout elapsed first.
+        """
+        self.phase_searches += 1
+        deadline = self._clock.monotonic() + timeout
+        while not self.is_ready():
+            if self._clock.monotonic() >= deadline:
+                return False
+            self._clock.sleep(self.POLL_INTERVAL_S)
+        return True
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until a new temperature is available, using the mode
+        selected by set_ready_mode().
+
+        :param timeout: Seconds to wait. The default is POLL_INTERVAL_S*POLL_LIMIT,
+            or two conversion cycles when scheduled.
+
+        :return: True if a temperature is available, False on timeout.
+        :rvalue: boolean
+        """
+        ready = self._wait_ready(timeout)
+        if not ready:
+            self.ready_timeouts += 1
+        return ready
+
+    def ready_in(self):
+        """
+        Return how long until a new temperature is available, without
+        waiting, so that a scheduler can come back then rather than block.
+        The mode selected by set_ready_mode() is used, but a READY_SCHEDULED
+        phase search or a READY_POLL wait is one poll per call.
+
+        :return: 0.0 if a temperature is available now, otherwise the seconds
+            until it is worth calling again, or None if none has become
+            available within the wait_ready() timeout.
+        :rvalue: float
+        """
+        now = self._clock.monotonic()
+        if self._ready_mode == self.READY_ALERT:
+            if self._alert_event.is_set():
+                self._alert_event.clear()
+                self._next_ready = now + self._cycle_s
+                return self._ready()
+            if self._next_ready is not None and self._next_ready > now:
+                return self._next_ready - now
+            return self._not_ready(now)
+
+        if self._ready_mode == self.READY_SCHEDULED:
+            if self._next_ready is None:
+                # Find the conversion phase, a poll at a time
+                if self._waiting_since is None:
+                    self.phase_searches += 1
+                if not self.is_ready():
+                    return self._not_ready(now)
+                self._next_ready = now + self._cycle_s
+                return self._ready()
+            # Skip any conversions that were missed
+            if self._next_ready < now - self._cycle_s:
+                missed = (now - self._next_ready) // self._cycle_s
+                self._next_ready += missed * self._cycle_s
+            if self._next_ready > now:
+                return self._next_ready - now
+            self._next_ready += self._cycle_s
+            self._n_scheduled += 1
+            if self._verify_every and self._n_scheduled % self._verify_every == 0:
+                # Our clock and the TMP117 oscillator drift apart, so check
+                # that the conversion really is complete.
+                if not self.is_ready():
+                    self._next_ready = None
+                    self.phase_searches += 1
+                    return self._not_ready(now)
+            return self._ready()
+
+        if self.is_ready():
+            return self._ready()
+        return self._not_ready(now)
+
+    def _ready(self):
+        self._waiting_since = None
+        return 0.0
+
+    def _not_ready(self, now):
+        # The same limit as wait_ready()
+        timeout = 2 * self._cycle_s if self._cycle_s else self.POLL_INTERVAL_S * self.POLL_LIMIT
+        if self._waiting_since is None:
+            self._waiting_since = now
+        elif now - self._waiting_since > timeout:
+            self._waiting_since = None
+            self.ready_timeouts += 1
+            return None
+        return self.POLL_INTERVAL_S
+
+    def _wait_ready(self, timeout):
+        if self._ready_mode == self.READY_ALERT:
+            if timeout is None:
+                timeout = 2 * self.conversion_time()
+            ready = self._alert_event.wait(timeout)
+            self._alert_event.clear()
+            return ready
+
+        if self._ready_mode == self.READY_SCHEDULED:
+            if timeout is None:
+                timeout = 2 * self._cycle_s
+            now = self._clock.monotonic()
+            if self._next_ready is None:
+                if not self._find_phase(timeout):
+                    return False
+                self._next_ready = self._clock.monotonic() + self._cycle_s
+                return True
+            # Skip any conversions that were missed
+            if self._next_ready < now - self._cycle_s:
+                missed = (now - self._next_ready) // self._cycle_s
+                self._next_ready += missed * self._cycle_s
+            if self._next_ready > now:
+                self._clock.sleep(self._next_ready - now)
+            self._next_ready += self._cycle_s
+            self._n_scheduled += 1
+            if self._verify_every and self._n_scheduled % self._verify_every == 0:
+                # Our clock and the TMP117 oscillator drift apart, so check
+                # that the conversion really is complete.
+                if not self.is_ready():
+                    self._next_ready = None
+                    if not self._find_phase(timeout):
+                        return False
+                    self._next_ready = self._clock.monotonic() + self._cycle_s
+            return True
+
+        n = 0
+        while not self.is_ready():
+            self._clock.sleep(self.POLL_INTERVAL_S)
+            n += 1
+            if (n > self.POLL_LIMIT):
+                return False
+        return True
+
     # Strictly resets.  Run .begin() afterwards
     def reset(self):
         """
@@ -283,6 +610,8 @@ class QwiicTmp117(object):
 
         """
         self.set_reg(self.TMP117_CONFIG_REG, 0x1 << self.CONFIG_RESET_BIT)
+        # The register now holds its power up (EEPROM) value
+        self.invalidate_shadow()
 
     def twos_complement(self, value, bitWidth):
       """
@@ -337,8 +666,7 @@ class QwiicTmp117(object):
 if __name__ == '__main__':
   device = QwiicTmp117()
   device.begin()
-  device.set_avg(QwiicTmp117.CONV_AVG_8)
-  device.set_cycle(QwiicTmp117.CONV_CYCLE_2)
+  device.configure(cycle=QwiicTmp117.CONV_CYCLE_2, avg=QwiicTmp117.CONV_AVG_8, verify=True)
   print("Mode is {0:016b}".format(device.mode))
   print("Conversion cycle is {0:016b}".format(device.cycle))
   print("Conversion average is {0:016b}".format(device.average))  
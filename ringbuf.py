@@ -0,0 +1,87 @@
+"""
+Fixed capacity circular buffers for sensor samples.
+"""
+from array import array
+
+class RingBuffer(object):
+    """
+    A preallocated, float64 circular buffer.
+
+    The storage is twice the capacity, and every value is written
+    to both halves. The most recent samples are therefore always
+    contiguous in memory, so readers can get a zero-copy view of
+    the window in time order.
+
+    Inserts are O(1), and nothing is allocated after construction.
+
+        :param capacity: The maximum number of samples held.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1, not {}".format(capacity))
+        self.capacity = capacity
+        self._buf = array('d', bytes(16 * capacity))
+        self._head = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, val):
+        """
+        Add a value, discarding the oldest one if the buffer is full.
+
+        :return: The value that was discarded, or None.
+        """
+        cap = self.capacity
+        i = (self._head + self._len) % cap
+        if self._len == cap:
+            evicted = self._buf[i]
+            self._head = (self._head + 1) % cap
+        else:
+            evicted = None
+            self._len += 1
+        self._buf[i] = val
+        self._buf[i + cap] = val
+        return evicted
+
+    def clear(self):
+        self._head = 0
+        self._len = 0
+
+    def values(self):
+        """
+        Return a zero-copy memoryview of the samples, oldest first.
+        The view is only valid until the next append().
+        """
+        return memoryview(self._buf)[self._head:self._head + self._len]
+
+    def ndarray(self):
+        """
+        Return a zero-copy float64 ndarray of the samples, oldest first.
+        The view is only valid until the next append().
+        NumPy is imported on the first call.
+        """
+        import numpy
+        return numpy.frombuffer(self._buf, dtype=numpy.float64,
+                                count=self._len, offset=8 * self._head)
+
+    def last(self):
+        """
+        Return the most recent value, or None if empty.
+        """
+        if not self._len:
+            return None
+        return self._buf[self._head + self._len - 1]
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __repr__(self):
+        return "RingBuffer({}, {})".format(self.capacity, list(self.values()))
+
+if __name__ == '__main__':
+    rb = RingBuffer(4)
+    for v in range(7):
+        print("append", v, "evicted", rb.append(v), rb.ndarray())
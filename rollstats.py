@@ -0,0 +1,174 @@
+"""
+Streaming statistics over a sliding window of samples.
+"""
+import heapq
+import math
+
+class RollingStats(object):
+    """
+    Maintain the median, mean and standard deviation of the samples
+    held in a ringbuf.RingBuffer, updating them as samples are added
+    and evicted.
+
+    The mean and variance use Welford's algorithm, with the evicted
+    sample removed by running the update backwards. They are recomputed
+    exactly from the window each time it turns over, so rounding errors
+    cannot accumulate.
+
+    The median uses a max-heap of the lower half and a min-heap of the
+    upper half of the window. Evicted samples are deleted lazily, when
+    they reach the top of a heap.
+
+        :param buffer: The RingBuffer holding the window. All appends must
+                       go through RollingStats.append().
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._lo = []       # max-heap of the lower half, negated
+        self._hi = []       # min-heap of the upper half
+        self._lo_n = 0      # number of live values in _lo
+        self._hi_n = 0      # number of live values in _hi
+        self._delayed = {}  # value -> count of pending lazy deletions
+        self._rebuild()
+
+    def append(self, val):
+        """
+        Add a value to the buffer and update the statistics.
+
+        :return: The value evicted from the buffer, or None.
+        """
+        val = float(val)
+        evicted = self.buffer.append(val)
+        if evicted is None:
+            self._welford_add(val)
+        else:
+            self._welford_replace(evicted, val)
+        self._heap_add(val)
+        if evicted is not None:
+            self._heap_remove(evicted)
+            self._evictions += 1
+            if self._evictions >= self.buffer.capacity:
+                self._rebuild()
+        return evicted
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._mean if self._n else math.nan
+
+    @property
+    def stdev(self):
+        """
+        The sample standard deviation, as statistics.stdev().
+        Zero if there are fewer than two samples.
+        """
+        if self._n < 2:
+            return 0.0
+        return math.sqrt(max(self._m2, 0.0) / (self._n - 1))
+
+    @property
+    def median(self):
+        if not self._n:
+            return math.nan
+        if self._lo_n > self._hi_n:
+            return -self._lo[0]
+        return (-self._lo[0] + self._hi[0]) / 2.0
+
+    def snapshot(self):
+        """
+        Return a tuple of the window statistics:
+          (median, mean, std dev, n)
+        """
+        return (self.median, self.mean, self.stdev, self._n)
+
+    # Welford updates
+    def _welford_add(self, val):
+        self._n += 1
+        delta = val - self._mean
+        self._mean += delta / self._n
+        self._m2 += delta * (val - self._mean)
+
+    def _welford_replace(self, old, new):
+        # Equivalent to removing old then adding new, with n unchanged.
+        old_mean = self._mean
+        self._mean += (new - old) / self._n
+        self._m2 += (new - old) * (new - self._mean + old - old_mean)
+
+    def _rebuild(self):
+        """
+        Recompute everything exactly from the window contents.
+        """
+        vals = sorted(self.buffer.values())
+        n = len(vals)
+        self._n = n
+        self._mean = math.fsum(vals) / n if n else 0.0
+        self._m2 = math.fsum((v - self._mean) ** 2 for v in vals)
+        half = (n + 1) // 2
+        self._lo = [-v for v in reversed(vals[:half])]
+        self._hi = vals[half:]
+        self._lo_n = half
+        self._hi_n = n - half
+        self._delayed = {}
+        self._evictions = 0
+
+    # Two heap median
+    def _heap_add(self, val):
+        if not self._lo or val <= -self._lo[0]:
+            heapq.heappush(self._lo, -val)
+            self._lo_n += 1
+        else:
+            heapq.heappush(self._hi, val)
+            self._hi_n += 1
+        self._balance()
+
+    def _heap_remove(self, val):
+        self._delayed[val] = self._delayed.get(val, 0) + 1
+        if val <= -self._lo[0]:
+            self._lo_n -= 1
+            if val == -self._lo[0]:
+                self._prune(self._lo, -1.0)
+        else:
+            self._hi_n -= 1
+            if self._hi and val == self._hi[0]:
+                self._prune(self._hi, 1.0)
+        self._balance()
+
+    def _balance(self):
+        if self._lo_n > self._hi_n + 1:
+            heapq.heappush(self._hi, -heapq.heappop(self._lo))
+            self._lo_n -= 1
+            self._hi_n += 1
+            self._prune(self._lo, -1.0)
+        elif self._lo_n < self._hi_n:
+            heapq.heappush(self._lo, -heapq.heappop(self._hi))
+            self._hi_n -= 1
+            self._lo_n += 1
+            self._prune(self._hi, 1.0)
+
+    def _prune(self, heap, sign):
+        delayed = self._delayed
+        while heap:
+            val = sign * heap[0]
+            count = delayed.get(val)
+            if not count:
+                break
+            if count == 1:
+                del delayed[val]
+            else:
+                delayed[val] = count - 1
+            heapq.heappop(heap)
+
+if __name__ == '__main__':
+    import random
+    import statistics as stat
+    import ringbuf
+
+    stats = RollingStats(ringbuf.RingBuffer(100))
+    for i in range(1000):
+        stats.append(random.gauss(400, 20))
+    vals = list(stats.buffer.values())
+    print("Rolling:", stats.snapshot())
+    print("Exact:  ", (stat.median(vals), stat.mean(vals), stat.stdev(vals), len(vals)))
@@ -0,0 +1,148 @@
+"""
+Deadline based scheduling of periodic sensor reads.
+"""
+import heapq
+import time
+
+import logutil
+
+log = logutil.get_logger("airq.scheduler")
+
+class Reschedule(float):
+    """
+    Returned by a task function to run it again after this many seconds,
+    e.g. when a sensor's next conversion is due, rather than waiting for
+    it and holding up the other tasks. Unlike a deferral, it is not a
+    back off, and is counted separately.
+    """
+
+class Task(object):
+    """
+    A periodic task. Use SensorScheduler.add() to create one.
+
+    Each run is due one period after the previous deadline, not after
+    the previous run finished, so varying read times do not cause drift.
+    """
+    def __init__(self, name, period, func, due):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.due = due
+        self.runs = 0
+        self.skipped = 0      # deadlines missed because a run was late
+        self.deferred = 0     # runs which asked to be deferred
+        self.rescheduled = 0  # runs which returned a Reschedule
+        self.errors = 0       # runs which raised an exception
+        self.lateness = 0.0   # how late the last run started, in seconds
+
+    def __repr__(self):
+        return "Task({}, period={}, runs={}, skipped={}, deferred={}, rescheduled={}, errors={})".format(
+            self.name, self.period, self.runs, self.skipped, self.deferred, self.rescheduled, self.errors)
+
+class SensorScheduler(object):
+    """
+    Run several periodic tasks from one thread, each at its own rate.
+
+    A task function may return a number of seconds to defer its next run,
+    e.g. to back off after an I/O error, without delaying the other tasks,
+    or a Reschedule. Otherwise it returns None, and is next run at its
+    following deadline. An exception raised by a task is logged, and the
+    task is run again at its next deadline; it does not stop the others.
+
+        :param clock: A monotonic clock function.
+        :param sleep: A sleep function.
+    """
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = {}
+        self._heap = []
+        self._seq = 0
+        self._running = False
+
+    def add(self, name, period, func, delay=0.0):
+        """
+        Add a periodic task. Tasks which are due at the same time run
+        in the order they were added.
+
+            :param name: The task name
+            :param period: The interval between runs, in seconds
+            :param func: The function to call. It takes no arguments.
+            :param delay: Seconds until the first run
+
+            :return: The Task
+        """
+        if period <= 0:
+            raise ValueError("Task {} period must be positive, not {}".format(name, period))
+        task = Task(name, period, func, self.clock() + delay)
+        self.tasks[name] = task
+        self._push(task)
+        return task
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (task.due, self._seq, task))
+        self._seq += 1
+
+    def run_once(self):
+        """
+        Sleep until the next task is due, and run it.
+
+            :return: The Task that was run
+        """
+        due, seq, task = heapq.heappop(self._heap)
+        now = self.clock()
+        if due > now:
+            self.sleep(due - now)
+            now = self.clock()
+        task.lateness = now - due
+
+        try:
+            defer = task.func()
+        except Exception as error:
+            task.errors += 1
+            log.error("task_failed", task=task.name, error=repr(error))
+            defer = None
+        task.runs += 1
+
+        now = self.clock()
+        if isinstance(defer, Reschedule):
+            task.rescheduled += 1
+            task.due = now + defer
+        elif defer:
+            task.deferred += 1
+            task.due = now + defer
+        else:
+            task.due = due + task.period
+            if task.due <= now:
+                # Overran one or more deadlines; skip them rather than
+                # running back to back to catch up.
+                missed = int((now - task.due) // task.period) + 1
+                task.skipped += missed
+                task.due += missed * task.period
+        self._push(task)
+        return task
+
+    def run(self):
+        """
+        Run the tasks until stop() is called.
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        """
+        Stop run(), after the current task.
+        """
+        self._running = False
+
+if __name__ == '__main__':
+    sched = SensorScheduler()
+    t0 = time.monotonic()
+    def report(name):
+        return lambda: print("{:6.3f} {}".format(time.monotonic() - t0, name))
+    sched.add("fast", 0.25, report("fast"))
+    sched.add("slow", 1.0, report("slow"))
+    for i in range(12):
+        sched.run_once()
+    print(list(sched.tasks.values()))
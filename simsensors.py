@@ -0,0 +1,665 @@
+"""
+A simulated sensor backend, so that airq can be run, tested and profiled
+without the hardware or the Qwiic drivers.
+
+    device = airq.airq(backend=simsensors.SimBackend(speed=60))
+
+SimI2CBus has the interface of a qwiic_i2c driver, and routes each
+transaction to a register level model of the device at its address. It
+adds a configurable latency to every transaction, and can inject OSErrors
+as a real bus does when a device NAKs or is unplugged.
+
+    SimTmp117Device - the config register's data ready flag, conversion
+        cycle timing (with oscillator drift), reset and the temperature
+        register. The real qwiic_tmp117 driver runs on it.
+    SimCcs811Device - the STATUS, MEAS_MODE, ALG_RESULT_DATA (with its
+        STATUS and ERROR_ID bytes), ENV_DATA, BASELINE, HW_ID, HW_VERSION,
+        FW_App_Version and ERROR_ID registers,
+        with results becoming ready at the drive mode rate, and injectable
+        device errors (including the 0xFF that airq treats as a
+        communication failure). Ccs811Driver drives it with the subset of
+        the Sparkfun QwiicCcs811 interface airq uses.
+    SimBme280 - compensated humidity and pressure, at the sensor level.
+    SimTca9548aDevice - an I2C multiplexer, so that several stacks with the
+        same addresses can share a bus (see fleet.py).
+
+Sample values come from sources: functions of time. Signal makes a
+synthetic diurnal signal with noise and spikes, and Replay plays back a
+channel of a recorded archive (see archive.py).
+
+SimClock runs the simulation faster than real time, so that hours of
+sampling and reporting take minutes.
+"""
+import math
+import random
+import threading
+import time
+
+import IQR
+import i2cbus
+import qwiic_tmp117
+
+class SimClock(object):
+    """
+    A clock with the time(), monotonic(), perf_counter() and sleep()
+    functions of the time module, running speed times faster than real
+    time. Sleeps are shortened to match, so it works across threads.
+
+        :param speed: The simulated seconds per real second
+        :param start: The simulated time.time() at creation. The default is now.
+    """
+    def __init__(self, speed=1.0, start=None):
+        self.speed = float(speed)
+        self._real0 = time.perf_counter()
+        self._time0 = time.time() if start is None else start
+        self._monotonic0 = time.monotonic()
+
+    def _elapsed(self):
+        return (time.perf_counter() - self._real0) * self.speed
+
+    def time(self):
+        return self._time0 + self._elapsed()
+
+    def monotonic(self):
+        return self._monotonic0 + self._elapsed()
+
+    def perf_counter(self):
+        return self._monotonic0 + self._elapsed()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+class Signal(object):
+    """
+    A synthetic source: a sinusoid with gaussian noise and occasional spikes.
+
+        :param base: The mean value
+        :param amplitude: The sinusoid amplitude
+        :param period: The sinusoid period, in seconds
+        :param noise: The noise standard deviation
+        :param spike_rate: The probability that a value is a spike
+        :param spike: The spike value
+        :param rng: A random.Random, for reproducible runs
+    """
+    def __init__(self, base, amplitude=0.0, period=86400.0, noise=0.0, spike_rate=0.0, spike=None, rng=None):
+        self.base = base
+        self.amplitude = amplitude
+        self.period = period
+        self.noise = noise
+        self.spike_rate = spike_rate
+        self.spike = spike
+        self.rng = rng if rng else random.Random()
+
+    def __call__(self, t):
+        if self.spike_rate and self.rng.random() < self.spike_rate:
+            return self.spike
+        value = self.base + self.amplitude * math.sin(2 * math.pi * t / self.period)
+        if self.noise:
+            value += self.rng.gauss(0.0, self.noise)
+        return value
+
+class Replay(object):
+    """
+    Replay recorded samples from an archive directory. The recording is
+    played from its start at the first call, and loops.
+
+        :param directory: The archive directory
+        :param start: The time.time() of the first sample to replay
+        :param end: The time.time() to stop replaying at
+    """
+    def __init__(self, directory, start=None, end=None):
+        import archive
+        np = IQR.numpy()
+        blocks = archive.read(directory, start, end)
+        if not blocks:
+            raise ValueError("No archived samples in {}".format(directory))
+        self._times = np.concatenate([b["time"] for b in blocks])
+        self._blocks = blocks
+        self._t0 = self._times[0]
+        self._duration = max(self._times[-1] - self._t0, 1.0)
+        self._lock = threading.Lock()
+        self._clock_t0 = None
+
+    def source(self, channel):
+        """
+        Return a source function for a channel.
+        """
+        np = IQR.numpy()
+        values = np.concatenate([b[channel] for b in self._blocks]).astype(np.float64)
+        valid = ~np.isnan(values)
+        times = self._times[valid]
+        values = values[valid]
+        if not len(values):
+            raise ValueError("No archived {} samples".format(channel))
+
+        def replay(t):
+            with self._lock:
+                if self._clock_t0 is None:
+                    self._clock_t0 = t
+            trace_t = self._t0 + (t - self._clock_t0) % self._duration
+            # The latest recorded value at trace_t
+            i = max(int(times.searchsorted(trace_t, "right")) - 1, 0)
+            return float(values[i])
+        return replay
+
+class SimI2CBus(object):
+    """
+    A simulated I2C bus, with the interface of a qwiic_i2c driver.
+
+        :param clock: The SimClock (or time module) to take latency from
+        :param latency_s: The time taken by each transaction
+        :param error_rate: The probability that a transaction raises OSError
+        :param rng: A random.Random, for reproducible runs
+    """
+    def __init__(self, clock=time, latency_s=0.0005, error_rate=0.0, rng=None):
+        self.clock = clock
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.rng = rng if rng else random.Random()
+        self.devices = {}
+        self.mux = None         # a SimTca9548aDevice, for devices behind one
+        self._fail = {}         # address -> transactions left to fail
+        self._lock = threading.Lock()
+
+        self.transactions = 0
+        self.errors = 0
+
+    def attach(self, address, device):
+        self.devices[address] = device
+        return device
+
+    def attach_mux(self, address):
+        """
+        Return the multiplexer at address, attaching one if needed.
+        """
+        if self.mux is None:
+            self.mux = self.attach(address, SimTca9548aDevice())
+        return self.mux
+
+    def _route(self, address):
+        device = self.devices.get(address)
+        if device is None and self.mux is not None:
+            device = self.mux.route(address)
+        return device
+
+    def fail(self, address, n=1):
+        """
+        Make the next n transactions with a device raise OSError.
+        """
+        self._fail[address] = n
+
+    def _device(self, address):
+        # One transaction at a time, as on a real bus
+        with self._lock:
+            self.transactions += 1
+            if self.latency_s:
+                self.clock.sleep(self.latency_s)
+            device = self._route(address)
+            failing = self._fail.get(address, 0)
+            if failing:
+                self._fail[address] = failing - 1
+            if device is None or failing or (self.error_rate and self.rng.random() < self.error_rate):
+                self.errors += 1
+                raise OSError(121, "Remote I/O error")
+            return device
+
+    def isDeviceConnected(self, devAddress):
+        return self._route(devAddress) is not None
+
+    def readByte(self, address, commandCode):
+        return self._device(address).read(commandCode, 1)[0]
+
+    def readWord(self, address, commandCode):
+        # SMBus words are little endian, the register big endian
+        data = self._device(address).read(commandCode, 2)
+        return data[0] | (data[1] << 8)
+
+    def readBlock(self, address, commandCode, nBytes):
+        return self._device(address).read(commandCode, nBytes)
+
+    def writeCommand(self, address, commandCode):
+        self._device(address).write(commandCode, [])
+
+    def writeByte(self, address, commandCode, value):
+        self._device(address).write(commandCode, [value & 0xff])
+
+    def writeWord(self, address, commandCode, value):
+        self._device(address).write(commandCode, [value & 0xff, (value >> 8) & 0xff])
+
+    def writeBlock(self, address, commandCode, value):
+        self._device(address).write(commandCode, list(value))
+
+    def stats(self):
+        return {"transactions": self.transactions, "errors": self.errors}
+
+class SimTca9548aDevice(object):
+    """
+    A TCA9548A I2C multiplexer. Writing a byte to it connects the
+    channels whose bits are set to the bus.
+    """
+    def __init__(self):
+        self.selected = 0
+        self.selects = 0
+        self.channels = {}      # channel -> {address: device}
+
+    def attach(self, channel, address, device):
+        self.channels.setdefault(channel, {})[address] = device
+        return device
+
+    def route(self, address):
+        for channel, devices in self.channels.items():
+            if self.selected & (1 << channel) and address in devices:
+                return devices[address]
+        return None
+
+    def read(self, reg, n):
+        return [self.selected] * n
+
+    def write(self, reg, data):
+        # A plain byte write, i.e. writeCommand(), sets the control register
+        self.selected = reg
+        self.selects += 1
+
+class SimTmp117Device(object):
+    """
+    A register level TMP117.
+
+        :param clock: The simulation clock
+        :param source: The temperature source, in degC
+        :param drift_ppm: How much slower the conversion oscillator runs
+                          than its nominal rate, in parts per million
+    """
+    T = qwiic_tmp117.QwiicTmp117
+    POWER_UP_CONFIG = 0x0220    # continuous, CONV 4, AVG 8
+
+    def __init__(self, clock, source, drift_ppm=0.0):
+        self.clock = clock
+        self.source = source
+        self.drift = 1.0 + drift_ppm * 1e-6
+        self.conversions = 0
+        self._reset()
+
+    def _reset(self):
+        self._config = self.POWER_UP_CONFIG
+        self._start = self.clock.monotonic()
+        self._done = 0          # conversions completed
+        self._read = 0          # conversions seen by a config or temperature read
+        self._temp = 0
+
+    def _cycle_s(self):
+        cycle = (self._config & self.T.CONFIG_CYCLE_MASK) >> self.T.CONFIG_CYCLE_BIT
+        avg = (self._config & self.T.CONFIG_AVG_MASK) >> self.T.CONFIG_AVG_BIT
+        return self.T.CYCLE_TIME_S[cycle][avg] * self.drift
+
+    def _update(self):
+        if self._config & self.T.CONFIG_MODE_MASK == self.T.MODE_SHUTDOWN:
+            return
+        done = int((self.clock.monotonic() - self._start) / self._cycle_s())
+        if done > self._done:
+            self._done = done
+            self.conversions += 1
+            counts = int(round(self.source(self.clock.time()) / self.T.TEMP_RESOLUTION_DEGC))
+            self._temp = counts & 0xffff
+
+    def read(self, reg, n):
+        self._update()
+        if reg == self.T.TMP117_TEMPERATURE_REG:
+            value = self._temp
+            self._read = self._done
+        elif reg == self.T.TMP117_CONFIG_REG:
+            value = self._config & self.T.CONFIG_WRITABLE_MASK
+            if self._done > self._read:
+                value |= self.T.CONFIG_READY_MASK
+            # Reading the config register clears the data ready flag
+            self._read = self._done
+        elif reg == self.T.TMP117_CHIP_ID_REG:
+            value = 0x0117
+        else:
+            value = 0
+        return [(value >> 8) & 0xff, value & 0xff][:n]
+
+    def write(self, reg, data):
+        if reg != self.T.TMP117_CONFIG_REG or len(data) != 2:
+            return
+        value = (data[0] << 8) | data[1]
+        if value & (1 << self.T.CONFIG_RESET_BIT):
+            self._reset()
+            return
+        self._update()
+        self._config = value & self.T.CONFIG_WRITABLE_MASK
+        # A config write restarts the conversion cycle
+        self._start = self.clock.monotonic()
+        self._done = self._read = 0
+
+class SimCcs811Device(object):
+    """
+    A register level CCS811, in application mode once APP_START is written.
+
+        :param clock: The simulation clock
+        :param tvoc: The TVOC source, in ppb
+        :param eco2: The eCO2 source, in ppm
+        :param error_rate: The probability that a STATUS read reports a
+                           device error
+        :param rng: A random.Random, for reproducible runs
+    """
+    STATUS = 0x00
+    MEAS_MODE = 0x01
+    ALG_RESULT_DATA = 0x02
+    ENV_DATA = 0x05
+    BASELINE = 0x11
+    HW_ID = 0x20
+    HW_VERSION = 0x21
+    FW_APP_VERSION = 0x24
+    ERROR_ID = 0xE0
+    APP_START = 0xF4
+    SW_RESET = 0xFF
+
+    STATUS_ERROR = 1 << 0
+    STATUS_DATA_READY = 1 << 3
+    STATUS_APP_VALID = 1 << 4
+    STATUS_FW_MODE = 1 << 7
+
+    # Measurement interval in seconds, by drive mode
+    DRIVE_PERIODS = {1: 1.0, 2: 10.0, 3: 60.0, 4: 0.25}
+
+    # The ERROR_ID codes
+    ERRORS = (1 << 0, 1 << 1, 1 << 2, 1 << 3, 1 << 4, 1 << 5)
+
+    def __init__(self, clock, tvoc, eco2, error_rate=0.0, rng=None):
+        self.clock = clock
+        self.tvoc = tvoc
+        self.eco2 = eco2
+        self.error_rate = error_rate
+        self.rng = rng if rng else random.Random()
+        self.env = None         # the latest (rh, degC) written to ENV_DATA
+        self._app = False
+        self._drive_mode = 0
+        self._error_id = 0
+        self._result = [0, 0, 0, 0]
+        # The baseline, which is lost on reset
+        self._baseline = [0x84, 0x3b]
+        self._done = 0
+        self._read = 0
+        self._start = clock.monotonic()
+
+    def inject_error(self, code):
+        """
+        Report a device error. Use 0xFF to mimic an unreadable ERROR_ID.
+        """
+        self._error_id = code
+
+    def _update(self):
+        if not self._app or not self._drive_mode:
+            return
+        done = int((self.clock.monotonic() - self._start) / self.DRIVE_PERIODS[self._drive_mode])
+        if done > self._done:
+            self._done = done
+            t = self.clock.time()
+            eco2 = max(0, min(int(self.eco2(t)), 0xffff))
+            tvoc = max(0, min(int(self.tvoc(t)), 0xffff))
+            self._result = [eco2 >> 8, eco2 & 0xff, tvoc >> 8, tvoc & 0xff]
+
+    def _status(self):
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self._error_id = self.rng.choice(self.ERRORS)
+        value = self.STATUS_APP_VALID
+        if self._app:
+            value |= self.STATUS_FW_MODE
+        if self._error_id:
+            value |= self.STATUS_ERROR
+        if self._done > self._read:
+            value |= self.STATUS_DATA_READY
+        return value
+
+    def read(self, reg, n):
+        self._update()
+        if reg == self.STATUS:
+            data = [self._status()]
+        elif reg == self.ALG_RESULT_DATA:
+            # The result, then STATUS and ERROR_ID as they were before the
+            # read; reading ERROR_ID here clears it too
+            status = self._status()
+            self._read = self._done
+            data = self._result + [status, self._error_id, 0, 0]
+            if n > 5:
+                self._error_id = 0
+        elif reg == self.MEAS_MODE:
+            data = [self._drive_mode << 4]
+        elif reg == self.BASELINE:
+            data = list(self._baseline)
+        elif reg == self.HW_ID:
+            data = [0x81]
+        elif reg == self.HW_VERSION:
+            data = [0x12]
+        elif reg == self.FW_APP_VERSION:
+            data = [0x20, 0x00]
+        elif reg == self.ERROR_ID:
+            # Reading ERROR_ID clears it
+            data = [self._error_id]
+            self._error_id = 0
+        else:
+            data = [0]
+        return (data + [0] * n)[:n]
+
+    def write(self, reg, data):
+        if reg == self.APP_START:
+            self._app = True
+        elif reg == self.MEAS_MODE and data:
+            self._drive_mode = (data[0] >> 4) & 0x7
+            self._start = self.clock.monotonic()
+            self._done = self._read = 0
+        elif reg == self.ENV_DATA and len(data) == 4:
+            rh = ((data[0] << 8) | data[1]) / 512.0
+            temp = ((data[2] << 8) | data[3]) / 512.0 - 25.0
+            self.env = (rh, temp)
+        elif reg == self.BASELINE and len(data) == 2:
+            self._baseline = list(data)
+        elif reg == self.SW_RESET:
+            self.__init__(self.clock, self.tvoc, self.eco2, self.error_rate, self.rng)
+
+class Ccs811Driver(object):
+    """
+    The part of the Sparkfun QwiicCcs811 interface used by airq, over
+    an I2C driver.
+    """
+    D = SimCcs811Device
+
+    def __init__(self, address, i2c_driver):
+        self.address = address
+        self._i2c = i2c_driver
+        self.CO2 = 0
+        self.TVOC = 0
+
+    def begin(self, drive_mode=1):
+        if self._i2c.readByte(self.address, self.D.HW_ID) != 0x81:
+            return False
+        self._i2c.writeCommand(self.address, self.D.APP_START)
+        self.set_drive_mode(drive_mode)
+        return True
+
+    def set_drive_mode(self, mode):
+        self._i2c.writeByte(self.address, self.D.MEAS_MODE, (mode & 0x7) << 4)
+
+    def data_available(self):
+        return bool(self._i2c.readByte(self.address, self.D.STATUS) & self.D.STATUS_DATA_READY)
+
+    def check_status_error(self):
+        return bool(self._i2c.readByte(self.address, self.D.STATUS) & self.D.STATUS_ERROR)
+
+    def get_error_register(self):
+        return self._i2c.readByte(self.address, self.D.ERROR_ID)
+
+    def read_algorithm_results(self):
+        data = self._i2c.readBlock(self.address, self.D.ALG_RESULT_DATA, 4)
+        self.CO2 = (data[0] << 8) | data[1]
+        self.TVOC = (data[2] << 8) | data[3]
+
+    def set_environmental_data(self, relativeHumidity, temperature):
+        rh = int(relativeHumidity * 512 + 0.5)
+        temp = int((temperature + 25) * 512 + 0.5)
+        self._i2c.writeBlock(self.address, self.D.ENV_DATA,
+                             [(rh >> 8) & 0xff, rh & 0xff, (temp >> 8) & 0xff, temp & 0xff])
+
+    def get_baseline(self):
+        data = self._i2c.readBlock(self.address, self.D.BASELINE, 2)
+        return (data[0] << 8) | data[1]
+
+    def set_baseline(self, input):
+        self._i2c.writeBlock(self.address, self.D.BASELINE, [(input >> 8) & 0xff, input & 0xff])
+
+class SimBme280(object):
+    """
+    A BME280, simulated after compensation. Each property read is one bus
+    transaction, like the burst read of the Sparkfun driver.
+
+        :param address: The I2C address
+        :param i2c_driver: The SimI2CBus, or a driver wrapping it
+        :param pres: The pressure source, in mb
+        :param rh: The relative humidity source, in %
+    """
+    def __init__(self, address, i2c_driver, pres, rh):
+        self.address = address
+        self._i2c = i2c_driver
+        self._pres = pres
+        self._rh = rh
+
+    def read(self, reg, n):
+        return [0] * n
+
+    def write(self, reg, data):
+        pass
+
+    def begin(self):
+        return self._i2c.isDeviceConnected(self.address)
+
+    @property
+    def humidity(self):
+        self._i2c.readBlock(self.address, 0xf7, 8)
+        return self._rh(self._i2c.clock.time())
+
+    @property
+    def pressure(self):
+        self._i2c.readBlock(self.address, 0xf7, 8)
+        # In Pa, like the Sparkfun driver
+        return self._pres(self._i2c.clock.time()) * 100.0
+
+class SimBackend(object):
+    """
+    Simulated sensors for airq.airq(backend=...).
+
+        :param speed: The simulated seconds per real second
+        :param sources: Optional dict of source functions by airq channel
+                        ("tvoc", "eco2", "pres", "tdry", "rh"), overriding
+                        the synthetic defaults
+        :param replay: Optional archive directory to replay all channels from
+        :param latency_s: The I2C transaction time
+        :param bus_error_rate: The probability that a transaction raises OSError
+        :param ccs811_error_rate: The probability of a CCS811 device error
+        :param tmp117_drift_ppm: The TMP117 oscillator drift
+        :param seed: The random seed, for reproducible runs
+    """
+    def __init__(self, speed=1.0, sources=None, replay=None, latency_s=0.0005,
+                 bus_error_rate=0.0, ccs811_error_rate=0.0, tmp117_drift_ppm=0.0, seed=None):
+        self.clock = SimClock(speed)
+        rng = random.Random(seed)
+        self.sources = {
+            "tvoc": Signal(20.0, 10.0, 3600.0, 2.0, spike_rate=0.001, spike=32768, rng=rng),
+            "eco2": Signal(450.0, 50.0, 3600.0, 5.0, spike_rate=0.001, spike=65021, rng=rng),
+            "pres": Signal(850.0, 2.0, 86400.0, 0.05, rng=rng),
+            "tdry": Signal(22.0, 1.5, 86400.0, 0.01, rng=rng),
+            "rh": Signal(40.0, 5.0, 86400.0, 0.2, rng=rng),
+        }
+        if replay:
+            trace = Replay(replay)
+            for name in self.sources:
+                self.sources[name] = trace.source(name)
+        if sources:
+            self.sources.update(sources)
+        self.bus = SimI2CBus(self.clock, latency_s, bus_error_rate, rng)
+        self.buses = {1: self.bus}
+        self.ccs811_error_rate = ccs811_error_rate
+        self.tmp117_drift_ppm = tmp117_drift_ppm
+        self.rng = rng
+        self.devices = {}
+
+    def i2c_bus(self, number=1):
+        """
+        Return the SimI2CBus with this bus number, creating it if needed.
+        """
+        bus = self.buses.get(number)
+        if bus is None:
+            bus = self.buses[number] = SimI2CBus(self.clock, self.bus.latency_s, self.bus.error_rate, self.rng)
+        return bus
+
+    def sensors(self, ccs811_address, bme280_address, tmp117_address,
+                i2c_driver=None, bus=1, mux_address=None, mux_channel=None):
+        """
+        Return the (ccs811, bme280, tmp117) sensor objects. The devices
+        of the latest call are in self.devices.
+
+            :param i2c_driver: The driver the sensors use, by default an
+                               i2cbus.BusDriver on the bus
+            :param bus: The bus number the devices are on
+            :param mux_address: The multiplexer address, if the devices
+                                are on mux_channel of one
+        """
+        s = self.sources
+        sim_bus = self.i2c_bus(bus)
+        if mux_channel is None:
+            attach = sim_bus.attach
+        else:
+            attach = lambda address, device: sim_bus.attach_mux(mux_address).attach(mux_channel, address, device)
+        if i2c_driver is None:
+            i2c_driver = i2cbus.I2CBus(sim_bus, self.clock).driver()
+        self.devices = {
+            "ccs811": attach(ccs811_address, SimCcs811Device(
+                self.clock, s["tvoc"], s["eco2"], self.ccs811_error_rate, self.rng)),
+            "tmp117": attach(tmp117_address, SimTmp117Device(
+                self.clock, s["tdry"], self.tmp117_drift_ppm)),
+            "bme280": attach(bme280_address, SimBme280(bme280_address, i2c_driver, s["pres"], s["rh"])),
+        }
+        return (Ccs811Driver(ccs811_address, i2c_driver),
+                self.devices["bme280"],
+                qwiic_tmp117.QwiicTmp117(tmp117_address, i2c_driver=i2c_driver, clock=self.clock))
+
+    def stack(self, **placement):
+        """
+        Return a backend for one stack of a fleet, whose sensors() places
+        the devices with these sensors() keyword arguments.
+        """
+        return SimStack(self, placement)
+
+class SimStack(object):
+    """
+    One sensor stack's view of a SimBackend. See SimBackend.stack().
+    """
+    def __init__(self, backend, placement):
+        self.backend = backend
+        self.clock = backend.clock
+        self.placement = placement
+
+    def sensors(self, ccs811_address, bme280_address, tmp117_address):
+        return self.backend.sensors(ccs811_address, bme280_address, tmp117_address, **self.placement)
+
+if __name__ == '__main__':
+    import sys
+    import airq
+    import logutil
+
+    # Ten simulated minutes, at 60 times real time
+    speed = float(sys.argv[1]) if len(sys.argv) > 1 else 60.0
+    logutil.configure("INFO")
+    backend = SimBackend(speed=speed, bus_error_rate=0.001, ccs811_error_rate=0.001, seed=1)
+    device = airq.airq(ccs811_n_samples=60, backend=backend)
+    as_strings = airq.Reading.serializer(airq.legacy_fields)
+    for i in range(10):
+        backend.clock.sleep(60)
+        print(as_strings(device.reading()))
+    # airq only checks for an error when a read finds no data ready,
+    # so slow the CCS811 down first
+    device.ccs811.set_drive_mode(2)
+    backend.devices["ccs811"].inject_error(0xFF)
+    backend.clock.sleep(30)
+    print(backend.bus.stats(), "TMP117 conversions:", backend.devices["tmp117"].conversions)
+    print(device.scheduler.tasks)
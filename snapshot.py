@@ -0,0 +1,128 @@
+"""
+Hand off data between the sampler thread and readers.
+"""
+import _thread
+import time
+
+class SnapshotCell(object):
+    """
+    Hold the latest published value, with a version number.
+
+    The writer replaces the whole (version, value) tuple with a single
+    reference assignment, which is atomic in CPython, so readers never
+    take a lock and never see a partly updated value. Published values
+    must not be modified afterwards.
+    """
+    def __init__(self, value=None):
+        self._current = (0, value)
+
+    def publish(self, value):
+        """
+        Publish a new value.
+
+        :return: Its version number
+        """
+        version = self._current[0] + 1
+        self._current = (version, value)
+        return version
+
+    def get(self):
+        """
+        Return the latest (version, value).
+        """
+        return self._current
+
+    @property
+    def version(self):
+        return self._current[0]
+
+    @property
+    def value(self):
+        return self._current[1]
+
+class TimedLock(object):
+    """
+    A lock which records how long callers waited for it, and how long it
+    was held. It can be used in place of _thread.allocate_lock(), or as
+    a context manager.
+    """
+    def __init__(self):
+        self._lock = _thread.allocate_lock()
+        self._acquired_at = 0.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.acquires = 0
+        self.contended = 0      # acquires which had to wait
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            wait = 0.0
+        else:
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            wait = time.perf_counter() - start
+            self.contended += 1
+        self._acquired_at = time.perf_counter()
+        self.acquires += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        return True
+
+    def release(self):
+        hold = time.perf_counter() - self._acquired_at
+        self.hold_total += hold
+        if hold > self.hold_max:
+            self.hold_max = hold
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def stats(self):
+        """
+        Return a dict of the wait and hold times, in seconds.
+        """
+        n = self.acquires
+        return {
+            "acquires": n,
+            "contended": self.contended,
+            "wait_mean_s": self.wait_total / n if n else 0.0,
+            "wait_max_s": self.wait_max,
+            "hold_mean_s": self.hold_total / n if n else 0.0,
+            "hold_max_s": self.hold_max,
+        }
+
+if __name__ == '__main__':
+    lock = TimedLock()
+    cell = SnapshotCell()
+
+    def writer(arg):
+        for i in range(5):
+            with lock:
+                time.sleep(0.01)
+                cell.publish({"i": i})
+            time.sleep(0.01)
+
+    _thread.start_new_thread(writer, (None,))
+    time.sleep(0.005)
+    for i in range(5):
+        with lock:
+            print(cell.get())
+        time.sleep(0.02)
+    print(lock.stats())
@@ -0,0 +1,130 @@
+"""
+Cold start timing, in the spirit of python -X importtime.
+
+Install the import timer as early as possible, then mark the
+startup milestones, and print the report once the first sample
+has been taken:
+
+    import startup
+    startup.install()
+    ...
+    startup.mark("device ready")
+    startup.report()
+"""
+import importlib.abc
+import os
+import sys
+import time
+
+_launch = time.perf_counter()
+_imports = []      # (depth, name, self_us, cumulative_us), in completion order
+_stack = []        # [start, child_us] for each module being executed
+_marks = []        # (name, seconds since launch)
+
+class _TimedLoader(importlib.abc.Loader):
+    """
+    Wrap a module loader, timing its exec_module().
+    """
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        frame = [time.perf_counter(), 0.0]
+        _stack.append(frame)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            _stack.pop()
+            cumulative = (time.perf_counter() - frame[0]) * 1e6
+            if _stack:
+                _stack[-1][1] += cumulative
+            _imports.append((len(_stack), module.__name__, cumulative - frame[1], cumulative))
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+    """
+    Find modules with the rest of sys.meta_path, and time their loading.
+    """
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
+
+def install():
+    """
+    Start timing imports. Only modules imported after this are timed.
+    """
+    if not any(isinstance(f, _TimingFinder) for f in sys.meta_path):
+        sys.meta_path.insert(0, _TimingFinder())
+
+def uninstall():
+    sys.meta_path[:] = [f for f in sys.meta_path if not isinstance(f, _TimingFinder)]
+
+def mark(name, t=None):
+    """
+    Record a startup milestone.
+
+    Parameters:
+    name - The milestone description
+    t - The time.perf_counter() value when it was reached. Now, if not given.
+    """
+    t = time.perf_counter() if t is None else t
+    _marks.append((name, t - _launch))
+
+def process_age():
+    """
+    Return the seconds since this process was started, or None
+    if it can't be determined (i.e. not on Linux).
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, so split after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return uptime - start
+    except (OSError, IndexError, ValueError):
+        return None
+
+# How long the interpreter ran before this module was imported
+_interpreter_s = process_age()
+
+def report(file=None, min_us=1000):
+    """
+    Print the import times and milestones.
+
+    Parameters:
+    file - Where to write the report, stderr by default
+    min_us - Imports with a smaller cumulative time are not listed
+    """
+    file = file if file else sys.stderr
+    if _interpreter_s is not None:
+        print("startup: interpreter start to launch: {:.3f} s".format(_interpreter_s), file=file)
+    print("import time: self [us] | cumulative | imported package", file=file)
+    for depth, name, self_us, cum_us in _imports:
+        if cum_us >= min_us:
+            print("import time: {:9.0f} | {:10.0f} | {}{}".format(self_us, cum_us, "  " * depth, name), file=file)
+    for name, t in _marks:
+        print("startup: {:.3f} s to {}".format(t, name), file=file)
+    file.flush()
+
+if __name__ == '__main__':
+    install()
+    import json
+    import IQR
+    mark("imports")
+    IQR.iqr_filter(list(range(1000)), 1.5)
+    mark("first IQR filter")
+    report(min_us=0)
@@ -0,0 +1,227 @@
+"""
+Batched uploading of queued CHORDS submissions.
+"""
+import _thread
+import http.client
+import random
+import threading
+import time
+
+import httppool
+import logutil
+
+log = logutil.get_logger("airq.uploader")
+
+class BatchUploader(object):
+    """
+    Send the URIs queued in an outbox.Outbox in batches, over pooled
+    keep-alive HTTP connections, rather than a new connection per
+    record. This lets a backlog drain quickly after an outage.
+
+    A batch is sent when batch_size entries are queued, or when the oldest
+    entry has waited flush_latency seconds. Entries are only removed from
+    the outbox once the server has accepted them, or has rejected them for
+    good (a 4xx status other than 408 or 429), in which case they are
+    dropped, so that one bad record cannot hold up the rest.
+
+    After a failure, the next attempt is delayed by an exponential backoff
+    with jitter, which is halved by each successful batch.
+
+        :param outbox: The outbox.Outbox to drain
+        :param batch_size: The maximum number of records per batch
+        :param flush_latency: The longest a record waits for a batch to fill, in seconds
+        :param timeout: The HTTP timeout, in seconds
+        :param min_backoff: The first retry delay, in seconds
+        :param max_backoff: The longest retry delay, in seconds
+        :param pool: The httppool.ConnectionPool to send with. One is created if not given.
+    """
+    def __init__(self, outbox, batch_size=50, flush_latency=10.0, timeout=30.0,
+                 min_backoff=5.0, max_backoff=600.0, pool=None):
+        self.outbox = outbox
+        self.pool = pool if pool else httppool.ConnectionPool(timeout=timeout)
+        self.batch_size = batch_size
+        self.flush_latency = flush_latency
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        # Set by stop(), and when run() has returned
+        self._stop = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+        self.batches = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.errors = 0
+
+    def send_batch(self, entries):
+        """
+        Send entries, reusing the pool's keep-alive connections.
+
+            :param entries: A list of (id, uri)
+
+            :return: The (accepted, dropped) ids, in order. Sending stops
+                     at the first failure which may succeed on a retry, so
+                     that records stay in order.
+        """
+        accepted = []
+        dropped = []
+        for entry_id, uri in entries:
+            try:
+                (status, reason, data) = self.pool.get(uri)
+            except (OSError, http.client.HTTPException) as error:
+                log.warning("send_error", error=error)
+                break
+            if 200 <= status < 300:
+                accepted.append(entry_id)
+            elif self.permanent(status):
+                log.error("send_dropped", status=status, reason=reason, uri=uri)
+                dropped.append(entry_id)
+            else:
+                log.warning("send_rejected", status=status, reason=reason)
+                break
+        return (accepted, dropped)
+
+    @staticmethod
+    def permanent(status):
+        """
+        Return True if a record rejected with an HTTP status would be
+        rejected again: any 4xx, other than 408 Request Timeout and 429
+        Too Many Requests.
+        """
+        return 400 <= status < 500 and status not in (408, 429)
+
+    def ready(self):
+        """
+        Return True if a batch should be sent now.
+        """
+        if len(self.outbox) >= self.batch_size:
+            return True
+        age = self.outbox.oldest_age()
+        return age is not None and age >= self.flush_latency
+
+    def run_once(self):
+        """
+        Send one batch, if one is ready.
+
+            :return: The number of records sent, or None if no batch was ready.
+        """
+        # Appends not yet committed are visible on the outbox's connection,
+        # so they can be sent without forcing a commit; durability is left
+        # to the outbox's sync_every and sync_interval
+        if not self.ready():
+            return None
+        entries = self.outbox.peek(self.batch_size)
+        (accepted, dropped) = self.send_batch(entries)
+        self.outbox.ack(accepted + dropped)
+        self.batches += 1
+        self.sent += len(accepted)
+        self.dropped += len(dropped)
+        if len(accepted) + len(dropped) < len(entries):
+            self.failures += 1
+            self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+        else:
+            self.backoff = self.backoff / 2 if self.backoff > self.min_backoff else 0.0
+        return len(accepted)
+
+    def run(self, poll_s=1.0):
+        """
+        Send batches until stop() is called. An unexpected error, e.g. a
+        full disk when the outbox is updated, is logged and backed off,
+        rather than ending the thread while reports keep being queued.
+        """
+        self._stopped.clear()
+        try:
+            self._run(poll_s)
+        finally:
+            self._stopped.set()
+
+    def _run(self, poll_s):
+        while not self._stop.is_set():
+            try:
+                sent = self.run_once()
+            except Exception as error:
+                self.errors += 1
+                self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+                log.error("upload_failed", error=repr(error), backoff_s=self.backoff)
+                sent = None
+            if self.backoff:
+                # Jitter, so that a fleet does not retry in lock step
+                self._stop.wait(self.backoff * random.uniform(0.5, 1.0))
+            elif not sent:
+                self._stop.wait(poll_s)
+
+    def start(self):
+        """
+        Run the uploader in a new thread.
+        """
+        self._stopped.clear()
+        _thread.start_new_thread(self.run, ())
+
+    def stop(self, timeout=None):
+        """
+        Stop run() for good, interrupting any back off. If timeout is given, wait up
+        to that many seconds for the batch in progress to finish, so that
+        the outbox can be closed.
+
+            :return: True if run() has returned.
+        """
+        self._stop.set()
+        if timeout is None:
+            return self._stopped.is_set()
+        return self._stopped.wait(timeout)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "errors": self.errors,
+            "backoff_s": self.backoff,
+            "queued": len(self.outbox),
+            "pool": self.pool.stats(),
+        }
+
+if __name__ == '__main__':
+    # Drain an outbox into a local stub CHORDS server
+    import http.server
+    import os
+    import tempfile
+    import outbox
+
+    class StubChords(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        requests = 0
+        connections = 0
+
+        def setup(self):
+            StubChords.connections += 1
+            http.server.BaseHTTPRequestHandler.setup(self)
+
+        def do_GET(self):
+            StubChords.requests += 1
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubChords)
+    _thread.start_new_thread(server.serve_forever, ())
+    host = "127.0.0.1:{}".format(server.server_address[1])
+
+    box = outbox.Outbox(os.path.join(tempfile.mkdtemp(), "outbox.db"))
+    for i in range(500):
+        box.append("http://{}/measurements/url_create?instrument_id=1&n={}".format(host, i))
+
+    uploader = BatchUploader(box, batch_size=100)
+    start = time.perf_counter()
+    while len(box):
+        uploader.run_once()
+    print("Sent 500 records in {:.3f} s".format(time.perf_counter() - start))
+    print(uploader.stats(), "server saw", StubChords.requests, "requests on", StubChords.connections, "connections")
+    server.shutdown()